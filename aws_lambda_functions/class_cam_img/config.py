@@ -5,3 +5,35 @@ FOLDER_OUTPUT = "path/to/output/"
 # config rekognition.detect_labels params
 MAX_LABELS = 10
 MIN_CONFIDENCE = 75
+
+# config batch (events with several records, e.g. from an SQS queue): records classified concurrently
+CLASSIFY_MAX_WORKERS = 8
+
+# config dedup: snapshots near-identical (perceptual hash hamming distance) to the recent ones of their camera
+# reuse their classification (no rekognition api call), requires numpy and Pillow
+# disabled by default: once enabled, every invocation imports numpy and Pillow and downloads its snapshots before
+# the api calls are validated, even those which then exit early (threshold exceeded, disabled until alert period)
+DEDUP_ENABLED = False
+DEDUP_DISTANCE_MAX = 4  # of 64 bits
+DEDUP_WINDOW_SECONDS = 300
+
+# config motion filter: snapshots without motion vs the reference frame of their camera (share of pixels changed,
+# in the mask regions [x0, y0, x1, y1], relative, None: all) are not classified, requires numpy and Pillow
+MOTION_FILTER_ENABLED = False
+MOTION_AREA_MIN = 0.01
+MOTION_MASK_REGIONS = None
+
+# config labels cache: snapshots with the same content (etag) as one classified before reuse its labels
+# (no rekognition api call), for LABELS_CACHE_TTL_SECONDS (rekognition_api_calls_service config)
+LABELS_CACHE_ENABLED = True
+
+# config fused classify and alert mode: the alert rules of alert_cams_img (alert_cams_img_service layer config) are
+# evaluated on the labels detected, and the alert email sent, by class_cam_img itself (no processed json round trip),
+# the json is still saved (concurrently) for archival, flagged 'alert_fused' so alert_cams_img does not alert again
+ALERT_FUSED = False
+
+# config processed records: compact schema (see processed_record: Classification and the labels only, without
+# whitespace), otherwise the full one (Classification, s3 event and the whole detect_labels response)
+# opt-in: the consumers of the processed json other than alert_cams_img and zipper_multiple (compact and index) may
+# rely on the fields of the full schema (e.g. ResponseMetadata, the s3 event)
+RECORD_COMPACT = False
@@ -1,51 +1,207 @@
-import boto3
 from datetime import datetime as dt
 import json
 
+from aws_clients import get_client
 from rekognition_api_calls_service import RekognitionApiCallsService
-from config import BUCKET_OUTPUT, FOLDER_OUTPUT, MAX_LABELS, MIN_CONFIDENCE
+from rekognition_labels_cache import RekognitionLabelsCache
+from alert_cams_img_service import AlertCamsImgService
+from alert_cams_img_email import build_ses_msg, send_ses_msg
+from alert_cams_img_rules import get_labels_alert_found
+from alert_cams_img_digest import build_detection, alert_digest
+from motion_filter import MotionFilter
+from snapshot_dedup import SnapshotDedup
+from processed_record import build_record, dumps_record
+from alert_cams_img_config import ALERT_PER_CAMERA, ALERT_DIGEST_ENABLED
+from config import BUCKET_OUTPUT, FOLDER_OUTPUT, MAX_LABELS, MIN_CONFIDENCE, CLASSIFY_MAX_WORKERS,\
+    MOTION_FILTER_ENABLED, MOTION_AREA_MIN, MOTION_MASK_REGIONS, DEDUP_ENABLED, DEDUP_DISTANCE_MAX,\
+    DEDUP_WINDOW_SECONDS, LABELS_CACHE_ENABLED, ALERT_FUSED, RECORD_COMPACT
 
-from logger_builder import build_logger
+from aws_metrics import set_stage, emit_metrics_on_return
+from logger_builder import build_logger, flush_logger_on_return
 import logging
 
 logger = logging.getLogger()
 
 
+@flush_logger_on_return
+@emit_metrics_on_return
 def lambda_handler(event, context):
     """
-    lambda layer dependencies:
+    lambda layer dependencies (at most 5 layers per function):
         - logger_builder
+        - common
         - rekognition_api_calls_service
             - alert_cams_img_service
+        - numpy and Pillow (motion_filter and snapshot_dedup of this package disabled without them)
     """
 
     # build_logger
     build_logger(log_level=logging.INFO, request_id=context.aws_request_id)
 
-    # get bucket, obj from event
+    # get the s3 records from event (s3 event, or sqs event with s3 events in the body of its messages)
+    records = get_s3_records(event)
+    logger.info(f"records: {len(records)}")
+    if len(records) == 0:
+        return {
+            'statusCode': 200,
+            'body': json.dumps("NO records to process, OK!")
+        }
+    s3_records = [record for _, record in records]
+
+    # pre-filters of the snapshots: motion filter and dedup (both with the snapshots downloaded once), labels cache
+    set_stage('prefilter')
+    rek_api_calls_service = RekognitionApiCallsService()
+    motion_filter = MotionFilter(rek_api_calls_service.params_loader, area_min=MOTION_AREA_MIN,
+                                 mask_regions=MOTION_MASK_REGIONS) if MOTION_FILTER_ENABLED else None
+    snapshot_dedup = SnapshotDedup(rek_api_calls_service.params_loader, distance_max=DEDUP_DISTANCE_MAX,
+                                   window_seconds=DEDUP_WINDOW_SECONDS) if DEDUP_ENABLED else None
+    labels_cache = RekognitionLabelsCache(MAX_LABELS, MIN_CONFIDENCE, rek_api_calls_service.params_loader)\
+        if LABELS_CACHE_ENABLED else None
+    # fused classify and alert mode: its PARAMS items (alert period and last date) are loaded with the rest
+    alert_service = rek_api_calls_service.alert_service if ALERT_FUSED else None
+
+    # all the PARAMS items needed (reference frames, recent hashes and labels cached too) with a single request
+    rek_api_calls_service.load_params(
+        ids_fresh_extra=((labels_cache.get_params_ids(s3_records) if labels_cache is not None else [])
+                         + (motion_filter.get_params_ids(s3_records) if motion_filter is not None else [])
+                         + (snapshot_dedup.get_params_ids(s3_records) if snapshot_dedup is not None else [])))
+    snapshots = [None] * len(records)
+    if motion_filter is not None or snapshot_dedup is not None:
+        snapshots = get_snapshots(s3_records)
+
+    # motion filter: the snapshots without motion (vs the reference frame of their camera) are not classified
+    responses = [None] * len(records)
+    if motion_filter is not None:
+        for i, motion in enumerate(motion_filter.filter(s3_records, snapshots)):
+            if motion is not None and not motion['motion']:
+                responses[i] = skip_record(s3_records[i], motion)
+    indexes = [i for i, response in enumerate(responses) if response is None]
+    s3_records_indexes = [s3_records[i] for i in indexes]
+
+    # dedup: the snapshots near-identical to recent ones (perceptual hash) reuse their classification
+    matches = [None] * len(indexes)
+    if snapshot_dedup is not None:
+        matches = snapshot_dedup.match(s3_records_indexes,
+                                       [get_key_dst(record['s3']['object']['key']) for record in s3_records_indexes],
+                                       [snapshots[i] for i in indexes])
+
+    # labels cache: the snapshots classified before (same content) reuse their labels, without api calls
+    responses_labels_cached = [None] * len(indexes)
+    if labels_cache is not None:
+        indexes_classify = [j for j, match in enumerate(matches) if match is None]
+        for j, response_labels in zip(indexes_classify, labels_cache.get(
+                [s3_records_indexes[j] for j in indexes_classify], [snapshots[indexes[j]] for j in indexes_classify])):
+            responses_labels_cached[j] = response_labels
+
+    # validate_and_alert for all the records to classify at once
+    # (if validated, the rekognition api calls are already reserved, counted in the current month)
+    api_calls = sum(1 for match, response_labels in zip(matches, responses_labels_cached)
+                    if match is None and response_labels is None)
+    api_calls_reserved, validate_cause = 0, None
+    set_stage('validate')
+    if api_calls > 0:
+        api_calls_reserved, (validate_cause, api_calls_month_current, api_calls_month_max_100)\
+            = rek_api_calls_service.validate_and_alert_batch(api_calls=api_calls)
+
+    # single record (the records classified are persisted, and alerted in fused mode, in this stage too)
+    set_stage('classify')
+    if len(records) == 1 and len(indexes) == 1:
+        if matches[0] is not None:
+            responses[0] = reuse_record(s3_records[0], matches[0], alert_service, snapshots[0])
+        else:
+            responses[0] = classify_record(s3_records[0], api_calls_reserved > 0, validate_cause,
+                                           responses_labels_cached[0], labels_cache, snapshots[0], alert_service)
+
+    # batch
+    elif len(indexes) > 0:
+        for i, response in zip(indexes, classify_records(s3_records_indexes, matches, api_calls_reserved,
+                                                         validate_cause, responses_labels_cached, labels_cache,
+                                                         [snapshots[i] for i in indexes], alert_service)):
+            responses[i] = response
+
+    # state of the pre-filters (recent hashes, reference frames)
+    set_stage('persist')
+    if snapshot_dedup is not None:
+        snapshot_dedup.save(s3_records_indexes, [responses[i]['statusCode'] for i in indexes])
+    if motion_filter is not None:
+        motion_filter.save()
+    if labels_cache is not None:
+        labels_cache.log_stats()
+    return responses[0] if len(records) == 1 else build_batch_response(records, responses)
+
+
+def get_s3_records(event):
+    """
+    :return: list of tuples (sqs message id, s3 record), the message id is None if event is an s3 event
+    """
+    records = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            records.extend((record['messageId'], s3_record) for s3_record in body.get('Records', []))
+        else:
+            records.append((None, record))
+    return records
+
+
+def get_snapshots(records):
+    """
+    :return: list of the bytes of the snapshot of every record (None if it can not be downloaded),
+             downloaded concurrently
+    """
+    # lazy imports, only needed for the pre-filters
+    from concurrent.futures import ThreadPoolExecutor
+
+    s3 = get_client('s3')
+
+    def get_snapshot(record):
+        try:
+            return s3.get_object(Bucket=record['s3']['bucket']['name'],
+                                 Key=record['s3']['object']['key'])['Body'].read()
+        except Exception as e:
+            logger.warning(f"snapshot '{record['s3']['object']['key']}' NOT downloaded: {e!r}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(CLASSIFY_MAX_WORKERS, len(records))) as executor:
+        return list(executor.map(get_snapshot, records))
+
+
+def get_key_dst(obj):
+    return f"{FOLDER_OUTPUT}{obj.split('/')[-1]}.json"
+
+
+def classify_record(record, validate, validate_cause, response_labels_cached=None, labels_cache=None,
+                    snapshot=None, alert_service=None):
+    """
+    Detects the labels of the s3 object of record and saves them, if validated (its api call already reserved),
+    or saves response_labels_cached (validation not needed).
+    If labels_cache is given, the labels detected are cached (snapshot: bytes of the s3 object, if downloaded).
+    If alert_service is given (fused classify and alert mode), they are alerted too (see save_json_dict_and_alert).
+    :return: lambda response of record
+    """
+
+    # get bucket, obj from record
     t_classification = f"{dt.utcnow().isoformat()}Z"
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    obj = event['Records'][0]['s3']['object']['key']
+    bucket = record['s3']['bucket']['name']
+    obj = record['s3']['object']['key']
     logger.info(f"bucket: {bucket}")
     logger.info(f"object: {obj}")
 
-    # validate_and_alert
-    rek_api_calls_service = RekognitionApiCallsService()
-    validate, (validate_cause, api_calls_month_current, api_calls_month_max_100)\
-        = rek_api_calls_service.validate_and_alert(return_metadata=True)
-
-    if validate:
+    if validate or response_labels_cached is not None:
 
         # get labels
-        response_labels = detect_labels(bucket, obj)
+        if response_labels_cached is not None:
+            response_labels = response_labels_cached
+        else:
+            response_labels = detect_labels(bucket, obj)
+            if labels_cache is not None:
+                labels_cache.put(record, response_labels, snapshot)
         print_labels_data(bucket, obj, response_labels)
 
-        # update rekognition api calls
-        rek_api_calls_service.increment_api_calls_month_current()
-
         # save json with labels data
-        json_dict = get_json_data(event, response_labels, bucket, obj, t_classification)
-        save_json_dict(json_dict)
+        json_dict = get_json_data({'Records': [record]}, response_labels, bucket, obj, t_classification)
+        json_dict['Classification']['cached'] = response_labels_cached is not None
+        save_json_dict_and_alert(json_dict, alert_service, snapshot)
         logger.info(
             f"json file created in '{json_dict['Classification']['s3_bucket_name_dst']}"
             f"/{json_dict['Classification']['s3_object_key_dst']}'")
@@ -65,8 +221,144 @@ def lambda_handler(event, context):
         }
 
 
+def skip_record(record, motion):
+    """
+    :return: lambda response of record, not classified (no motion)
+    """
+    bucket = record['s3']['bucket']['name']
+    obj = record['s3']['object']['key']
+    log_msg = f"File '{bucket}/{obj}' NOT processed, no motion detected" \
+              f" (score {motion['score']} < {MOTION_AREA_MIN}), OK!"
+    logger.info(log_msg)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(log_msg)
+    }
+
+
+def reuse_record(record, match, alert_service=None, snapshot=None):
+    """
+    Saves the labels of the snapshot near-identical to the one of record (match), instead of detecting them,
+    flagged as reused, so alert_cams_img processes the json the same way (or they are alerted right away,
+    if alert_service is given, see save_json_dict_and_alert).
+    :return: lambda response of record
+    """
+
+    # get bucket, obj from record
+    t_classification = f"{dt.utcnow().isoformat()}Z"
+    bucket = record['s3']['bucket']['name']
+    obj = record['s3']['object']['key']
+    logger.info(f"bucket: {bucket}")
+    logger.info(f"object: {obj}")
+
+    # get labels of the json reused
+    json_dict_reused = load_json_dict(BUCKET_OUTPUT, match['key_dst'])
+    response_labels = {key: value for key, value in json_dict_reused.items()
+                       if key not in ('Classification', 'Records')}
+    print_labels_data(bucket, obj, response_labels)
+
+    # save json with labels data
+    json_dict = get_json_data({'Records': [record]}, response_labels, bucket, obj, t_classification)
+    json_dict['Classification']['reused'] = True
+    json_dict['Classification']['reused_s3_object_key_src'] = json_dict_reused['Classification']['s3_object_key_src']
+    json_dict['Classification']['reused_distance'] = match['distance']
+    save_json_dict_and_alert(json_dict, alert_service, snapshot)
+    logger.info(
+        f"json file created in '{json_dict['Classification']['s3_bucket_name_dst']}"
+        f"/{json_dict['Classification']['s3_object_key_dst']}'"
+        f", reusing '{json_dict['Classification']['reused_s3_object_key_src']}' (distance {match['distance']})")
+
+    # return OK
+    return {
+        'statusCode': 200,
+        'body': json.dumps(
+            f"File '{bucket}/{obj}' processed, file '{json_dict['Classification']['s3_bucket_name_dst']}"
+            f"/{json_dict['Classification']['s3_object_key_dst']}' created (reused), OK!")
+    }
+
+
+def classify_records(records, matches, api_calls_reserved, validate_cause, responses_labels_cached,
+                     labels_cache=None, snapshots=None, alert_service=None):
+    """
+    Classifies the records not matched concurrently, with CLASSIFY_MAX_WORKERS threads: those with their labels
+    cached, and the first api_calls_reserved of the rest, which are not validated (rekognition api calls threshold
+    100% reached). Then the records matched reuse the classification of their match, if it is available.
+    :return: list of the lambda responses of records
+    """
+    # lazy imports, only needed for batches
+    from concurrent.futures import ThreadPoolExecutor
+
+    snapshots = snapshots if snapshots is not None else [None] * len(records)
+    indexes_cached = [i for i, match in enumerate(matches)
+                      if match is None and responses_labels_cached[i] is not None]
+    indexes_classify = [i for i, match in enumerate(matches)
+                        if match is None and responses_labels_cached[i] is None]
+    indexes_reuse = [i for i, match in enumerate(matches) if match is not None]
+    logger.info(f"classifying {len(records)} records in batch mode, {len(indexes_reuse)} reused"
+                f", {len(indexes_cached)} cached, {api_calls_reserved} of {len(indexes_classify)} validated"
+                f", max_workers {CLASSIFY_MAX_WORKERS}")
+
+    validate_cause = validate_cause if validate_cause is not None \
+        else "rekognition api calls threshold 100% reached by the previous records of the batch"
+    responses = [None] * len(records)
+
+    def collect(futures):
+        for i, future in futures.items():
+            try:
+                responses[i] = future.result()
+            except Exception as e:
+                logger.exception(f"record {records[i]['s3']['object']['key']} failed")
+                responses[i] = {'statusCode': 500, 'body': json.dumps(repr(e))}
+
+    with ThreadPoolExecutor(max_workers=CLASSIFY_MAX_WORKERS) as executor:
+        collect({i: executor.submit(classify_record, records[i], True, None, responses_labels_cached[i], labels_cache,
+                                    snapshots[i], alert_service)
+                 for i in sorted(indexes_cached + indexes_classify[:api_calls_reserved])})
+        for i in indexes_classify[api_calls_reserved:]:
+            responses[i] = classify_record(records[i], False, validate_cause)
+
+        # records matched with a record of the batch: only if it has been classified
+        futures = {}
+        for i in indexes_reuse:
+            index = matches[i]['index']
+            if index is None or responses[index]['statusCode'] == 200:
+                futures[i] = executor.submit(reuse_record, records[i], matches[i], alert_service, snapshots[i])
+            else:
+                responses[i] = {
+                    'statusCode': responses[index]['statusCode'],
+                    'body': json.dumps(f"File '{records[i]['s3']['bucket']['name']}/{records[i]['s3']['object']['key']}"
+                                       f"' NOT processed, near-identical to '{records[index]['s3']['object']['key']}'"
+                                       f", NOT processed either")
+                }
+        collect(futures)
+
+    return responses
+
+
+def build_batch_response(records, responses):
+    """
+    :return: lambda response, with the per-record results in its body,
+             and the sqs messages of the failed records in batchItemFailures (sqs partial batch response)
+    """
+    results = [{'bucket': record['s3']['bucket']['name'], 'object': record['s3']['object']['key'],
+                'statusCode': response['statusCode'], 'body': json.loads(response['body'])}
+               for (_, record), response in zip(records, responses)]
+    records_ok = sum(1 for result in results if result['statusCode'] == 200)
+    logger.info(f"batch mode done, {records_ok} of {len(results)} records OK")
+
+    response = {
+        'statusCode': 200 if records_ok == len(results) else 207,  # multi-status
+        'body': json.dumps(results)
+    }
+    message_ids_failed = list(dict.fromkeys(message_id for (message_id, _), record_response in zip(records, responses)
+                                            if message_id is not None and record_response['statusCode'] == 500))
+    if any(message_id is not None for message_id, _ in records):
+        response['batchItemFailures'] = [{'itemIdentifier': message_id} for message_id in message_ids_failed]
+    return response
+
+
 def detect_labels(bucket, obj):
-    client = boto3.client('rekognition')
+    client = get_client('rekognition')
 
     response = client.detect_labels(
         Image={'S3Object': {'Bucket': bucket, 'Name': obj}},
@@ -77,10 +369,13 @@ def detect_labels(bucket, obj):
 
 
 def print_labels_data(bucket, obj, response_labels):
-    labels_str_list = ["'{}' ({:.2f}%, #{})".format(label['Name'], label['Confidence'], len(label['Instances']))
-                       for label in response_labels['Labels']]
-    labels_str = ', '.join(labels_str_list)
-    logger.info(f"Detected labels for '{bucket}/{obj}': {labels_str}")
+    # formatted only if logged
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    labels_str = ', '.join("'{}' ({:.2f}%, #{})".format(label['Name'], label['Confidence'], len(label['Instances']))
+                           for label in response_labels['Labels'])
+    logger.info("Detected labels for '%s/%s': %s", bucket, obj, labels_str,
+                extra={'data': {'labels': [label['Name'] for label in response_labels['Labels']]}})
 
 
 def get_json_data(event, response_labels, bucket, obj, t_classification):
@@ -89,23 +384,96 @@ def get_json_data(event, response_labels, bucket, obj, t_classification):
             's3_bucket_name_src': bucket,
             's3_object_key_src': obj,
             's3_bucket_name_dst': BUCKET_OUTPUT,
-            's3_object_key_dst': f"{FOLDER_OUTPUT}{obj.split('/')[-1]}.json",
+            's3_object_key_dst': get_key_dst(obj),
             'eventTime': event['Records'][0]['eventTime'],
             'classificationTime': t_classification,
             'MaxLabels': MAX_LABELS,
             'MinConfidence': MIN_CONFIDENCE,
             'labels': [label['Name'] for label in response_labels['Labels']],
+            'reused': False,
+            'cached': False,
+            'alert_fused': False,
         }
     }
+    if RECORD_COMPACT:
+        return build_record(classification_dict['Classification'], response_labels)
     json_dict = {**classification_dict, **event, **response_labels}
     return json_dict
 
 
 def save_json_dict(json_dict):
-    s3 = boto3.client("s3")
+    s3 = get_client('s3')
     response = s3.put_object(
-        Body=json.dumps(json_dict),
+        Body=dumps_record(json_dict) if RECORD_COMPACT else json.dumps(json_dict),
         Bucket=json_dict['Classification']['s3_bucket_name_dst'],
         Key=json_dict['Classification']['s3_object_key_dst']
     )
     return response
+
+
+def save_json_dict_and_alert(json_dict, alert_service=None, snapshot=None):
+    """
+    Saves json_dict and, if alert_service is given (fused classify and alert mode), evaluates the alert rules of
+    alert_cams_img on its labels meanwhile, sending the alert email with snapshot attached (downloaded if None):
+    the json is only saved for archival, flagged 'alert_fused' so alert_cams_img does not alert it again.
+    The json is saved in a thread of its own, joined before returning (the lambda is frozen once it returns).
+    :return: response of send_ses_msg, None if no alert email was sent
+    """
+    if alert_service is None:
+        save_json_dict(json_dict)
+        return None
+
+    # lazy imports, only needed in fused mode
+    from concurrent.futures import ThreadPoolExecutor
+
+    json_dict['Classification']['alert_fused'] = True
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(save_json_dict, json_dict)
+        response = alert_class_dict(json_dict['Classification'], alert_service, snapshot, json_dict['Labels'])
+        future.result()
+    return response
+
+
+def alert_class_dict(class_dict, alert_service, snapshot=None, labels=()):
+    """
+    Alerts the labels of class_dict the same way alert_cams_img does: an email if any of them matches the alert rules
+    (see alert_cams_img_rules) and the alert period (of the camera, if ALERT_PER_CAMERA) is claimed, so only one of
+    the records of a batch and of concurrent invocations alerts within it (in digest mode, see alert_cams_img_digest,
+    added to the alert digest before the alert period, sent with it after).
+    :param labels: labels of the detect_labels response (with their confidence and instances), for the alert rules
+    :return: response of send_ses_msg, None if no alert email was sent
+    """
+    camera_id = AlertCamsImgService.get_camera_id(class_dict)
+    labels_alert_found = get_labels_alert_found(labels, camera_id)
+    if ALERT_DIGEST_ENABLED:
+        detections = [build_detection(class_dict, labels_alert_found, labels)] if len(labels_alert_found) > 0 else []
+        data_bytes_by_key = {class_dict['s3_object_key_src']: snapshot} if snapshot is not None else None
+        log_msg, response = alert_digest(alert_service, detections, data_bytes_by_key)
+        logger.info(log_msg)
+        return response
+
+    if len(labels_alert_found) == 0:
+        logger.info(f"label alerts NOT found in labels ({class_dict['labels']}), NO alert, OK!")
+        return None
+
+    camera_id = camera_id if ALERT_PER_CAMERA else None
+    alert_claimed, (alert_period, alert_last_date, alert_second_since_last) = \
+        alert_service.claim_period(camera_id, return_metadata=True)
+    if not alert_claimed:
+        logger.info(f"label alerts found ({labels_alert_found}) in labels, NOT alerting BEFORE alert period"
+                    f" ({alert_period} s) of camera '{camera_id}', last alert was on '{alert_last_date}'"
+                    f" ({alert_second_since_last} s ago)")
+        return None
+
+    logger.info(f"label alerts found ({labels_alert_found}) in labels, ALERT !!!")
+    msg = build_ses_msg(class_dict, labels_alert_found, snapshot)
+    response = send_ses_msg(msg)
+    if camera_id is not None:
+        alert_service.update_last_date()  # the global one too (class_cam_img_disable_until_alert_period)
+    return response
+
+
+def load_json_dict(bucket, key):
+    s3 = get_client('s3')
+    data = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    return json.loads(data)
@@ -0,0 +1,176 @@
+import io
+import time
+
+from params_loader import ParamsLoader
+from snapshot_utils import is_available, get_record_camera_id
+
+import logging
+logger = logging.getLogger()
+
+
+# config reference frames
+TABLE_NAME_DEFAULT = 'PARAMS'  # None to keep the reference frames only in memory (per container)
+ID_REFERENCE_PREFIX = 'motion_reference_'  # item of the reference frame of a camera: <ID_REFERENCE_PREFIX><camera_id>
+FRAME_SIZE = (64, 36)  # (width, height) of the downscaled grayscale frames compared
+FRAME_DRAFT_SIZE = (128, 72)  # jpeg decoded already downscaled (draft mode), much faster than a full decode
+REFERENCE_ALPHA = 0.2  # weight of every frame in the reference frame (running average of the background)
+REFERENCE_SECONDS_MAX = 3600  # older reference frames are not used (the frame is classified and becomes the reference)
+
+# config motion
+PIXEL_DIFF_MIN = 24  # min abs difference (0-255) of a pixel with motion, after the brightness normalization
+AREA_MIN_DEFAULT = 0.01  # min share of the pixels (in the mask) with motion of a frame with motion
+MASK_REGIONS_DEFAULT = None  # list of regions [x0, y0, x1, y1] (relative, 0-1) where motion is detected, None: all
+
+# in memory reference frames, if table_name is None: {camera_id: (t, frame bytes)}
+_references_local = {}
+
+
+def load_frame(data, frame_size=FRAME_SIZE):
+    """
+    :return: downscaled grayscale frame of the image data, float32 array of shape (height, width)
+    """
+    # lazy imports, optional dependencies (see snapshot_utils.is_available)
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', FRAME_DRAFT_SIZE)
+    return np.asarray(image.convert('L').resize(frame_size, Image.BILINEAR), dtype=np.float32)
+
+
+def build_mask(mask_regions, frame_size=FRAME_SIZE):
+    """
+    :return: bool array of shape (height, width), True in the pixels of mask_regions (all of them if None)
+    """
+    import numpy as np
+
+    width, height = frame_size
+    if mask_regions is None:
+        return np.ones((height, width), dtype=bool)
+    mask = np.zeros((height, width), dtype=bool)
+    for x0, y0, x1, y1 in mask_regions:
+        mask[int(round(y0 * height)):int(round(y1 * height)), int(round(x0 * width)):int(round(x1 * width))] = True
+    return mask
+
+
+def get_motion_score(frame, reference, mask):
+    """
+    :return: share of the pixels of mask with motion: those whose difference with the reference, once both are
+             normalized to the same mean brightness (global lighting changes do not count), exceeds PIXEL_DIFF_MIN
+    """
+    import numpy as np
+
+    diff = np.abs((frame - frame[mask].mean()) - (reference - reference[mask].mean()))
+    return float(np.count_nonzero(diff[mask] > PIXEL_DIFF_MIN)) / max(int(np.count_nonzero(mask)), 1)
+
+
+class MotionFilter:
+    """
+    Cheap motion pre-filter of the snapshots of a camera: a snapshot is classified only if its downscaled grayscale
+    frame differs enough from the reference frame of its camera (a running average of its previous frames),
+    in the regions of the mask, so lighting changes and small movements do not spend rekognition api calls.
+
+    The reference frame of every camera is kept in the item '<ID_REFERENCE_PREFIX><camera_id>' (value: binary)
+    of a PARAMS-like table, read with the params loader shared with the other daos (a single batch_get_item),
+    or only in memory if table_name is None.
+
+    Usage, per invocation: filter() the records (with their snapshots), save() the reference frames.
+
+    lambda layer dependencies:
+        - common
+    python dependencies: numpy and Pillow, the filter is disabled without them
+    """
+
+    def __init__(self, params_loader=None, table_name=TABLE_NAME_DEFAULT, area_min=AREA_MIN_DEFAULT,
+                 mask_regions=MASK_REGIONS_DEFAULT):
+        if params_loader is None and table_name is not None:
+            params_loader = ParamsLoader(table_name)
+        self.params_loader = params_loader
+        self.area_min = area_min
+        self.mask_regions = mask_regions
+        self.enabled = is_available('motion filter')
+        self.references = {}
+        self.cameras_updated = set()
+
+    def get_params_ids(self, records):
+        """
+        :return: ids of the items of the reference frames of the cameras of records, to be loaded with the rest
+        """
+        if not self.enabled or self.params_loader is None:
+            return []
+        return sorted({f"{ID_REFERENCE_PREFIX}{get_record_camera_id(record)}" for record in records})
+
+    def filter(self, records, snapshots):
+        """
+        Scores every snapshot (in key order, i.e. date order) against the reference frame of its camera,
+        and updates it.
+        :param snapshots: bytes of the snapshot of every record (None if not available)
+        :return: list of the motion of every record: None (unknown: no snapshot or no reference frame yet)
+                 or dict {'score': share of the pixels with motion, 'motion': bool}
+        """
+        motions = [None] * len(records)
+        if not self.enabled or len(records) == 0:
+            return motions
+
+        t_start = time.perf_counter()
+        mask = build_mask(self.mask_regions)
+        if self.params_loader is not None:
+            self.params_loader.load(ids_fresh=self.get_params_ids(records))  # no request if loaded with the rest
+        for camera_id in {get_record_camera_id(record) for record in records}:
+            self.references[camera_id] = self._load_reference(camera_id)
+
+        for i in sorted(range(len(records)), key=lambda i: records[i]['s3']['object']['key']):
+            if snapshots[i] is None:
+                continue
+            try:
+                frame = load_frame(snapshots[i])
+            except Exception as e:
+                logger.warning(f"snapshot '{records[i]['s3']['object']['key']}' NOT loaded: {e!r}")
+                continue
+            camera_id = get_record_camera_id(records[i])
+            reference = self.references[camera_id]
+            self.cameras_updated.add(camera_id)
+            if reference is None:
+                self.references[camera_id] = frame
+                continue
+            score = get_motion_score(frame, reference, mask)
+            motions[i] = {'score': round(score, 4), 'motion': score >= self.area_min}
+            self.references[camera_id] = (1 - REFERENCE_ALPHA) * reference + REFERENCE_ALPHA * frame
+
+        records_still = sum(1 for motion in motions if motion is not None and not motion['motion'])
+        logger.info(f"motion filter: {records_still} of {len(records)} records without motion"
+                    f" ({(time.perf_counter() - t_start) * 1000:.1f} ms)")
+        return motions
+
+    def save(self):
+        """
+        Saves the reference frames updated by filter().
+        """
+        import numpy as np
+
+        t_now = time.time()
+        for camera_id in sorted(self.cameras_updated):
+            frame_bytes = np.clip(np.round(self.references[camera_id]), 0, 255).astype(np.uint8).tobytes()
+            if self.params_loader is None:
+                _references_local[camera_id] = (t_now, frame_bytes)
+            else:
+                _id = f"{ID_REFERENCE_PREFIX}{camera_id}"
+                item = {'id': {'S': _id}, 'value': {'B': frame_bytes}, 't': {'N': str(round(t_now, 3))}}
+                self.params_loader.client.put_item(TableName=self.params_loader.table_name, Item=item)
+                self.params_loader.set_item(_id, item)
+
+    def _load_reference(self, camera_id):
+        """
+        :return: reference frame of camera_id (float32 array), None if there is none or it is too old
+        """
+        import numpy as np
+
+        if self.params_loader is None:
+            t, frame_bytes = _references_local.get(camera_id, (0, None))
+        else:
+            item = self.params_loader.items.get(f"{ID_REFERENCE_PREFIX}{camera_id}")
+            t, frame_bytes = (float(item['t']['N']), item['value']['B']) if item is not None else (0, None)
+        width, height = FRAME_SIZE
+        if frame_bytes is None or len(frame_bytes) != width * height or time.time() - t > REFERENCE_SECONDS_MAX:
+            return None
+        return np.frombuffer(frame_bytes, dtype=np.uint8).reshape((height, width)).astype(np.float32)
@@ -0,0 +1,183 @@
+import io
+import json
+import time
+
+from aws_clients import get_client
+from params_loader import ParamsLoader
+from snapshot_utils import is_available, get_record_camera_id
+
+import logging
+logger = logging.getLogger()
+
+
+# config hashes
+TABLE_NAME_DEFAULT = 'PARAMS'  # None to keep the hashes only in memory (per container, across warm invocations)
+ID_HASHES_PREFIX = 'snapshot_hashes_'  # item of the recent hashes of a camera: <ID_HASHES_PREFIX><camera_id>
+HASH_SIZE = 8  # dhash of HASH_SIZE x HASH_SIZE bits
+HASH_DRAFT_SIZE = (64, 64)  # jpeg decoded already downscaled (draft mode), much faster than a full decode
+
+# config dedup
+DISTANCE_MAX_DEFAULT = 4  # max hamming distance (of HASH_SIZE ** 2 bits) between near-identical snapshots
+WINDOW_SECONDS_DEFAULT = 300  # seconds the classification of a snapshot is reused
+HASHES_MAX_DEFAULT = 16  # recent hashes kept per camera
+MAX_WORKERS_DEFAULT = 8  # snapshots downloaded and hashed concurrently
+
+# in memory hashes, if table_name is None: {camera_id: [[hash hex, key_dst, t], ...]}
+_hashes_local = {}
+
+
+def compute_dhash(data, hash_size=HASH_SIZE):
+    """
+    :return: difference hash of the image data, an int of hash_size ** 2 bits: whether every pixel of a grayscale
+             thumbnail of (hash_size + 1) x hash_size is brighter than its right neighbour
+    """
+    # lazy imports, optional dependencies (see snapshot_utils.is_available)
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', HASH_DRAFT_SIZE)
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class SnapshotDedup:
+    """
+    Perceptual hash (dhash) dedup of near-identical snapshots of a camera (e.g. the bursts of frames of a motion
+    detection), so they reuse a previous classification instead of calling rekognition again.
+
+    The recent hashes of every camera, with the processed json of their classification, are kept in the item
+    '<ID_HASHES_PREFIX><camera_id>' (value: json string) of a PARAMS-like table, read with the params loader
+    shared with the other daos (a single batch_get_item), or only in memory if table_name is None.
+
+    Usage, per invocation: match() the records, classify those not matched, save() the hashes of the classified ones.
+
+    lambda layer dependencies:
+        - common
+    python dependencies: numpy and Pillow (checked on the first match()), every snapshot is classified without them
+    """
+
+    def __init__(self, params_loader=None, table_name=TABLE_NAME_DEFAULT, distance_max=DISTANCE_MAX_DEFAULT,
+                 window_seconds=WINDOW_SECONDS_DEFAULT, hashes_max=HASHES_MAX_DEFAULT, max_workers=MAX_WORKERS_DEFAULT):
+        if params_loader is None and table_name is not None:
+            params_loader = ParamsLoader(table_name)
+        self.params_loader = params_loader
+        self.distance_max = distance_max
+        self.window_seconds = window_seconds
+        self.hashes_max = hashes_max
+        self.max_workers = max_workers
+        self.enabled = None  # numpy and Pillow imported on the first match() only, not on every cold start
+        self.t_now = None
+        self.hashes = []
+        self.hashes_camera = {}
+
+    def get_params_ids(self, records):
+        """
+        :return: ids of the items of the recent hashes of the cameras of records, to be loaded with the rest of params
+        """
+        if self.enabled is False or self.params_loader is None:
+            return []
+        return sorted({f"{ID_HASHES_PREFIX}{get_record_camera_id(record)}" for record in records})
+
+    def compute_hashes(self, records, snapshots=None):
+        """
+        :param snapshots: bytes of the snapshot of every record (None if not available), downloaded if not given
+        :return: list of the dhash of the snapshot of every record (None if it can not be hashed),
+                 downloaded and hashed concurrently
+        """
+        # lazy imports, only needed to hash (not in the early exit paths)
+        from concurrent.futures import ThreadPoolExecutor
+
+        s3 = get_client('s3')
+
+        def compute_hash(record, data):
+            try:
+                if data is None and snapshots is None:
+                    response = s3.get_object(Bucket=record['s3']['bucket']['name'], Key=record['s3']['object']['key'])
+                    data = response['Body'].read()
+                return compute_dhash(data) if data is not None else None
+            except Exception as e:
+                logger.warning(f"snapshot '{record['s3']['object']['key']}' NOT hashed: {e!r}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(min(self.max_workers, len(records)), 1)) as executor:
+            return list(executor.map(compute_hash, records, snapshots or [None] * len(records)))
+
+    def match(self, records, keys_dst, snapshots=None):
+        """
+        Matches every snapshot (in key order, i.e. date order) with the recent ones of its camera: those classified
+        by previous invocations and those of records not matched themselves (to be classified by this invocation).
+        :param keys_dst: key of the processed json of every record
+        :param snapshots: bytes of the snapshot of every record (see compute_hashes)
+        :return: list of the match of every record: None (to be classified)
+                 or dict {'key_dst': processed json reused, 'index': index of the record reused (None if previous),
+                 'distance': hamming distance}
+        """
+        matches = [None] * len(records)
+        if self.enabled is None and len(records) > 0:
+            self.enabled = is_available('snapshot dedup')
+        if not self.enabled or len(records) == 0:
+            return matches
+
+        self.t_now = time.time()
+        self.hashes = self.compute_hashes(records, snapshots)
+        if self.params_loader is not None:
+            self.params_loader.load(ids_fresh=self.get_params_ids(records))  # no request if loaded with the rest
+        self.hashes_camera = {camera_id: self._load_hashes(camera_id)
+                              for camera_id in {get_record_camera_id(record) for record in records}}
+
+        for i in sorted(range(len(records)), key=lambda i: records[i]['s3']['object']['key']):
+            if self.hashes[i] is None:
+                continue
+            hashes_camera = self.hashes_camera[get_record_camera_id(records[i])]
+            distances = [(hamming_distance(self.hashes[i], entry['hash']), entry) for entry in hashes_camera]
+            distance, entry = min(distances, key=lambda distance_entry: distance_entry[0], default=(None, None))
+            if distance is not None and distance <= self.distance_max:
+                matches[i] = {'key_dst': entry['key_dst'], 'index': entry['index'], 'distance': distance}
+            else:
+                hashes_camera.append({'hash': self.hashes[i], 'key_dst': keys_dst[i], 't': self.t_now, 'index': i})
+
+        records_matched = sum(1 for match in matches if match is not None)
+        logger.info(f"snapshot dedup: {records_matched} of {len(records)} records near-identical to recent ones")
+        return matches
+
+    def save(self, records, status_codes):
+        """
+        Saves the recent hashes of the cameras of records, adding those of the records classified by this invocation
+        (status code 200), up to hashes_max per camera.
+        Concurrent invocations may overwrite the hashes saved by each other, so some snapshots could be classified
+        again instead of reused, which is safe.
+        """
+        if not self.enabled or len(records) == 0:
+            return
+        for camera_id, hashes_camera in self.hashes_camera.items():
+            entries = [entry for entry in hashes_camera
+                       if entry['index'] is None or status_codes[entry['index']] == 200]
+            if not any(entry['index'] is not None for entry in entries):
+                continue
+            entries = sorted(entries, key=lambda entry: entry['t'])[-self.hashes_max:]
+            value = [[format(entry['hash'], 'x'), entry['key_dst'], round(entry['t'], 3)] for entry in entries]
+            if self.params_loader is None:
+                _hashes_local[camera_id] = value
+            else:
+                _id = f"{ID_HASHES_PREFIX}{camera_id}"
+                item = {'id': {'S': _id}, 'value': {'S': json.dumps(value, separators=(',', ':'))}}
+                self.params_loader.client.put_item(TableName=self.params_loader.table_name, Item=item)
+                self.params_loader.set_item(_id, item)
+
+    def _load_hashes(self, camera_id):
+        """
+        :return: list of the hashes of camera_id within the window, dicts {'hash', 'key_dst', 't', 'index': None}
+        """
+        if self.params_loader is None:
+            value = _hashes_local.get(camera_id, [])
+        else:
+            item = self.params_loader.items.get(f"{ID_HASHES_PREFIX}{camera_id}")
+            value = json.loads(item['value']['S']) if item is not None else []
+        return [{'hash': int(hash_hex, 16), 'key_dst': key_dst, 't': t, 'index': None}
+                for hash_hex, key_dst, t in value if self.t_now - t <= self.window_seconds]
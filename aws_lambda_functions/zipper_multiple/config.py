@@ -3,3 +3,31 @@ VALID_CUSTOM_EVENT_LIST = [
     {"bucket_name": "bucket_name_example_01", "main_dir": "main_dir_example_01"},
     {"bucket_name": "bucket_name_example_02", "main_dir": "main_dir_example_02"},
 ]
+
+# config zip upload (multipart upload part size in bytes, min 5 MiB), it bounds the memory used to build the zip
+ZIP_PART_SIZE = 8 * 1024 * 1024
+
+# config zip downloads (concurrent workers and max bytes held in memory by the downloads in flight)
+ZIP_MAX_WORKERS = 16
+ZIP_MAX_BYTES_IN_FLIGHT = 64 * 1024 * 1024
+
+# config zip compression: policy ('deflated', 'stored', 'detect', 'trial') and level (None: zlib default, 0-9)
+ZIP_COMPRESSION_POLICY = 'detect'
+ZIP_COMPRESS_LEVEL = None
+
+# config zip shards (max bytes per <YYYY-MM>.partNN.zip, resumable with a manifest), None for a single <YYYY-MM>.zip
+ZIP_SHARD_SIZE_MAX = 1024 * 1024 * 1024
+
+# config batch mode (event "custom_events"): targets zipped concurrently, sharing ZIP_MAX_BYTES_IN_FLIGHT
+ZIP_BATCH_MAX_WORKERS = 4
+
+# config compact event (processed records of class_cam_img of a day, in processed_bucket/main_dir, rolled into a single
+# <main_dir>/jsonl/<YYYY-MM-DD>.jsonl.gz, deleted once uploaded if COMPACT_DELETE_FILES), gzip level 1-9
+VALID_COMPACT_EVENT_LIST = [
+    {"bucket_name": "bucket-output", "main_dir": "path/to/output"},
+]
+COMPACT_COMPRESS_LEVEL = 6
+COMPACT_DELETE_FILES = True
+# the detection index of main_dir (<main_dir>/index/detections.sqlite, see detection_index) updated after compacting
+# (also updated alone by the event "index_event", e.g. hourly, to index the records of the current day)
+COMPACT_INDEX_UPDATE = True
@@ -1,27 +1,58 @@
 import json
 
-from config import VALID_CUSTOM_EVENT_LIST
-from zipper_multiple import ZipperMultiple
+from config import VALID_CUSTOM_EVENT_LIST, ZIP_PART_SIZE, ZIP_MAX_WORKERS, ZIP_MAX_BYTES_IN_FLIGHT,\
+    ZIP_COMPRESSION_POLICY, ZIP_COMPRESS_LEVEL, ZIP_SHARD_SIZE_MAX, ZIP_BATCH_MAX_WORKERS, VALID_COMPACT_EVENT_LIST,\
+    COMPACT_COMPRESS_LEVEL, COMPACT_DELETE_FILES, COMPACT_INDEX_UPDATE
 
-from logger_builder import build_logger
+from aws_metrics import set_stage, emit_metrics_on_return
+from logger_builder import build_logger, flush_logger_on_return
 import logging
 
 logger = logging.getLogger()
 
 
+@flush_logger_on_return
+@emit_metrics_on_return
 def lambda_handler(event, context):
+    """
+    lambda layer dependencies:
+        - logger_builder
+        - common
+        - zipper_multiple
+    """
 
     # build_logger
     build_logger(log_level=logging.INFO, request_id=context.aws_request_id)
 
     logger.info(f"event: {event}")
+    set_stage('validate')
+
+    # compact event (processed records of a day into a single json lines file, then the detection index updated)
+    # or index event (detection index updated only)
+    if 'compact_event' in event or 'index_event' in event:
+        return compact_files_event(event)
+
+    # batch event
+    elif 'custom_events' in event:
+        max_workers = event.get('max_workers', ZIP_BATCH_MAX_WORKERS)
+        if not isinstance(event['custom_events'], list) or not is_int_min(max_workers, 1):
+            error_msg = "event json NOT valid, batch mode: \"custom_events\" must be a list and \"max_workers\"" \
+                        f" an int >= 1, got {event['custom_events']!r} and {max_workers!r}"
+            logger.info(error_msg)
+            return {
+                'statusCode': 400,
+                'body': json.dumps(error_msg)
+            }
+        set_stage('zip')
+        return zip_files_batch(event['custom_events'], max_workers)
 
     # valid event
-    if validate_event(event):
+    elif validate_event(event):
 
         logger.info("event json valid, OK!")
         bucket_name = event['custom_event']['bucket_name']
         main_dir = event['custom_event']['main_dir']
+        set_stage('zip')
         zip_files(bucket_name, main_dir)
 
         return {
@@ -33,7 +64,13 @@ def lambda_handler(event, context):
     else:
         error_msg = "event json NOT valid, you must specify an event json with the structure:" \
                     " {\"custom_event\": {\"bucket_name\": str, {\"main_dir\": str} }" \
-                    ", and it has be valid values: " + str(VALID_CUSTOM_EVENT_LIST)
+                    " (or, for the batch mode, {\"custom_events\": [{\"bucket_name\": str, \"main_dir\": str" \
+                    ", \"month_ago\": int (optional, 1 by default)}, ...], \"max_workers\": int (optional)})" \
+                    ", and it has be valid values: " + str(VALID_CUSTOM_EVENT_LIST) + \
+                    " (or, to compact the processed records of a day, {\"compact_event\": {\"bucket_name\": str" \
+                    ", \"main_dir\": str, \"day_ago\": int (optional, 1 by default)}}, or to update the detection" \
+                    " index only, {\"index_event\": {\"bucket_name\": str, \"main_dir\": str}}" \
+                    ", with the valid values: " + str(VALID_COMPACT_EVENT_LIST) + ")"
         logger.info(error_msg)
         return {
             'statusCode': 400,
@@ -41,23 +78,153 @@ def lambda_handler(event, context):
         }
 
 
-def validate_event(event):
+def compact_files_event(event):
+    compact_event = event['compact_event'] if 'compact_event' in event else event['index_event']
+    # day_ago of the compact event only (the index event indexes every json lines file not indexed yet)
+    day_ago = compact_event.get('day_ago', 1) if 'compact_event' in event and isinstance(compact_event, dict) else 1
+    if not isinstance(compact_event, dict) or not is_int_min(day_ago, 1)\
+            or not validate_event({'custom_event': compact_event}, VALID_COMPACT_EVENT_LIST):
+        error_msg = "event json NOT valid, you must specify an event json with the structure:" \
+                    " {\"compact_event\": {\"bucket_name\": str, \"main_dir\": str, \"day_ago\": int (optional" \
+                    ", 1 by default)}} (or {\"index_event\": {\"bucket_name\": str, \"main_dir\": str}})" \
+                    ", and it has be valid values: " + str(VALID_COMPACT_EVENT_LIST)
+        logger.info(error_msg)
+        return {
+            'statusCode': 400,
+            'body': json.dumps(error_msg)
+        }
+
+    summary = {}
+    if 'compact_event' in event:
+        set_stage('compact')
+        summary = compact_files(compact_event['bucket_name'], compact_event['main_dir'], day_ago)
+    if 'index_event' in event or COMPACT_INDEX_UPDATE:
+        set_stage('index')
+        summary['index'] = update_index(compact_event['bucket_name'], compact_event['main_dir'])
+    return {
+        'statusCode': 200,
+        'body': json.dumps(summary)
+    }
+
+
+def validate_event(event, valid_custom_event_list=VALID_CUSTOM_EVENT_LIST):
     if 'custom_event' not in event:
         return False
     else:
-        for d in VALID_CUSTOM_EVENT_LIST:
+        for d in valid_custom_event_list:
             if all([event['custom_event'].get(k) == d[k] for k in d]):
                 return True
         return False
 
 
-def zip_files(bucket_name, main_dir):
-    logger.info(f"zipping files for bucket '{bucket_name}', main_dir '{main_dir}'")
+def is_int_min(value, minimum):
+    # bool is an int subclass, True must not be taken as 1
+    return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+
+def zip_files_batch(custom_events, max_workers=ZIP_BATCH_MAX_WORKERS):
+    """
+    Zips every target (bucket_name, main_dir, month_ago) of custom_events concurrently, with max_workers threads.
+    The bytes in flight of the downloads (ZIP_MAX_BYTES_IN_FLIGHT) are split among the workers,
+    so the peak memory does not grow with max_workers.
+    A target repeated in custom_events is zipped once (two workers would race on its manifest and multipart upload),
+    every occurrence gets its result.
+    :return: lambda response, with the per-target results in its body
+    """
+    # lazy imports, only needed to zip (not in the NOT valid event path)
+    from concurrent.futures import ThreadPoolExecutor
+
+    logger.info(f"zipping files in batch mode, {len(custom_events)} targets, max_workers {max_workers}")
+
+    max_bytes_in_flight = ZIP_MAX_BYTES_IN_FLIGHT // max(max_workers, 1)
+    results = [None] * len(custom_events)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures, futures_target = {}, {}
+        for i, custom_event in enumerate(custom_events):
+            month_ago = custom_event.get('month_ago', 1) if isinstance(custom_event, dict) else None
+            if isinstance(custom_event, dict) and validate_event({'custom_event': custom_event}) \
+                    and is_int_min(month_ago, 1):
+                target = (custom_event['bucket_name'], custom_event['main_dir'], month_ago)
+                if target not in futures_target:
+                    futures_target[target] = executor.submit(zip_files, *target, max_bytes_in_flight)
+                futures[i] = futures_target[target]
+            else:
+                results[i] = {'custom_event': custom_event, 'statusCode': 400, 'body': "custom_event NOT valid"}
+
+        for i, future in futures.items():
+            try:
+                results[i] = {'custom_event': custom_events[i], 'statusCode': 200, 'body': future.result()}
+            except Exception as e:
+                logger.exception(f"custom_event {custom_events[i]} failed")
+                results[i] = {'custom_event': custom_events[i], 'statusCode': 500, 'body': repr(e)}
+
+    targets_ok = sum(1 for result in results if result['statusCode'] == 200)
+    logger.info(f"batch mode done, {targets_ok} of {len(results)} targets OK")
+    return {
+        'statusCode': 200 if targets_ok == len(results) else 207,  # multi-status
+        'body': json.dumps(results)
+    }
+
+
+def zip_files(bucket_name, main_dir, month_ago=1, max_bytes_in_flight=ZIP_MAX_BYTES_IN_FLIGHT):
+    # lazy imports, only needed to zip (not in the NOT valid event path): dateutil, zipfile, boto3...
+    from zipper_multiple import ZipperMultiple
+
+    logger.info(f"zipping files for bucket '{bucket_name}', main_dir '{main_dir}', month_ago {month_ago}")
 
     prefix = f"{main_dir}/{ZipperMultiple.TAG_YEAR}-{ZipperMultiple.TAG_MONTH}-"
     filename_regex = rf"^{ZipperMultiple.TAG_YEAR}-{ZipperMultiple.TAG_MONTH}-\d{{2}}-\d{{2}}-\d{{2}}-\d{{2}}.+"
     file_zip = f"{main_dir}/zip/{ZipperMultiple.TAG_YEAR}-{ZipperMultiple.TAG_MONTH}.zip"
     delete_files = True
 
-    zm = ZipperMultiple(bucket_name, prefix, filename_regex, file_zip)
-    zm.zip_files_month_ago(delete_files=delete_files)
+    zm = ZipperMultiple(bucket_name, prefix, filename_regex, file_zip, part_size=ZIP_PART_SIZE,
+                        max_workers=ZIP_MAX_WORKERS, max_bytes_in_flight=max_bytes_in_flight,
+                        compression_policy=ZIP_COMPRESSION_POLICY, compress_level=ZIP_COMPRESS_LEVEL,
+                        shard_size_max=ZIP_SHARD_SIZE_MAX)
+    return zm.zip_files_month_ago(month_ago=month_ago, delete_files=delete_files)
+
+
+def compact_files(bucket_name, main_dir, day_ago=1):
+    """
+    Rolls the processed records (json) of class_cam_img of the day day_ago in main_dir into a single gzip compressed
+    json lines file, <main_dir>/jsonl/<YYYY-MM-DD>.jsonl.gz, one compact record (see processed_record) per line
+    (<YYYY-MM-DD>.partNN.jsonl.gz if the day was already compacted, see JsonlCompactor).
+    """
+    # lazy imports, only needed to compact (not in the NOT valid event path)
+    from jsonl_compactor import JsonlCompactor
+    from processed_record import compact_record, dumps_record
+
+    logger.info(f"compacting files for bucket '{bucket_name}', main_dir '{main_dir}', day_ago {day_ago}")
+
+    tag_date = f"{JsonlCompactor.TAG_YEAR}-{JsonlCompactor.TAG_MONTH}-{JsonlCompactor.TAG_DAY}"
+    prefix = f"{main_dir}/{tag_date}-"
+    filename_regex = rf"^{tag_date}-\d{{2}}-\d{{2}}-\d{{2}}.+\.json$"
+    file_jsonl = f"{main_dir}/jsonl/{tag_date}.jsonl.gz"
+
+    jc = JsonlCompactor(bucket_name, prefix, filename_regex, file_jsonl,
+                        dumps_line=lambda data: dumps_record(compact_record(json.loads(data))),
+                        compress_level=COMPACT_COMPRESS_LEVEL, part_size=ZIP_PART_SIZE, max_workers=ZIP_MAX_WORKERS,
+                        max_bytes_in_flight=ZIP_MAX_BYTES_IN_FLIGHT)
+    return jc.compact_files_day_ago(day_ago=day_ago, delete_files=COMPACT_DELETE_FILES)
+
+
+def update_index(bucket_name, main_dir):
+    """
+    Updates the detection index of the processed records of main_dir (see detection_index) with the records and json
+    lines files added since its last update.
+    """
+    # lazy imports, only needed to index (not in the NOT valid event path): sqlite3, boto3...
+    from aws_clients import get_client
+    from detection_index import DetectionIndex
+
+    logger.info(f"updating detection index for bucket '{bucket_name}', main_dir '{main_dir}'")
+
+    s3_client = get_client('s3')
+    index = DetectionIndex.load(s3_client, bucket_name, main_dir)
+    try:
+        summary = index.update(s3_client, max_workers=ZIP_MAX_WORKERS, max_bytes_in_flight=ZIP_MAX_BYTES_IN_FLIGHT)
+        if summary['records'] > 0 or summary['jsonl_files'] > 0:
+            index.save(s3_client)
+    finally:
+        index.close()
+    return summary
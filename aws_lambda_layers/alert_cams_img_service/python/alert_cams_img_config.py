@@ -0,0 +1,77 @@
+# config dao
+TABLE_NAME = 'PARAMS'
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+ID_ALERTS_CAMS_IMG_PERIOD = 'alert_cams_img_period'
+ID_ALERTS_CAMS_IMG_LAST = 'alert_cams_img_last'
+ID_ALERTS_CAMS_IMG_DIGEST = 'alert_cams_img_digest'
+
+# config alert
+LABELS_ALERT = ['Person']
+# alert rules (see alert_cams_img_rules), compiled once per container, None for a rule without thresholds per label of
+# LABELS_ALERT. List of dicts, per label (case insensitive):
+#     - label: name of the label (required)
+#     - confidence_min: minimum confidence of the label (%)
+#     - instances_min: minimum number of instances (bounding boxes), passing the area and zone filters
+#     - area_min: minimum area of an instance, relative to the image (0-1)
+#     - zones_include / zones_exclude: dict {camera ('<bucket>/<folder>', or '*' for any): list of regions}, regions
+#       relative to the image [x0, y0, x1, y1], the center of an instance must be within (outside) one of them
+# the area and zone filters require at least an instance passing them (labels without bounding boxes never do)
+# e.g. [{'label': 'Person', 'confidence_min': 90, 'area_min': 0.01,
+#        'zones_exclude': {'my-bucket/cam-street': [[0.0, 0.0, 1.0, 0.25]]}}]
+ALERT_RULES = None
+# alert period per camera (the folder of its snapshots, PARAMS item alert_cams_img_last_<bucket>/<folder>), otherwise
+# global (alert_cams_img_last, which is always updated too, for class_cam_img_disable_until_alert_period)
+# global by default: alert_cams_img then exits before alert period without reading the processed json, whereas per
+# camera every invocation downloads and parses it first (the camera is only known from it)
+ALERT_PER_CAMERA = False
+
+# config alert digest: the detections worth alerting within the alert period (dropped otherwise) are accumulated, up to
+# ALERT_DIGEST_DETECTIONS_MAX, and sent in a single email once it is over (by the next invocation, or a scheduled one):
+# the best ALERT_DIGEST_FRAMES_MAX frames (highest confidence) attached, or a contact sheet of them (requires Pillow)
+ALERT_DIGEST_ENABLED = False
+ALERT_DIGEST_DETECTIONS_MAX = 200
+ALERT_DIGEST_FRAMES_MAX = 4
+ALERT_DIGEST_CONTACT_SHEET = False
+ALERT_DIGEST_THUMBNAIL_WIDTH = 640
+
+# config ses
+AWS_SES_REGION = "aws-region-1"
+#CONFIGURATION_SET = "ConfigSet"
+
+# config email
+SENDER = "AWS Alerts <example-sender@email.es>"
+RECIPIENT_LIST = ["example1@email.com", "example2@email.com"]
+SUBJECT = "AWS Alert Cam Detected Person"
+CHARSET = "utf-8"
+
+# config email attachment: snapshots bigger than ATT_BYTES_MAX are downscaled and re-encoded (jpeg) to fit it,
+# SES raw messages are limited to 10 MB once base64 encoded (4/3 of the attachment size), None: attached as they are,
+# requires Pillow (otherwise attached as they are)
+ATT_BYTES_MAX = 6 * 1024 * 1024
+ATT_JPEG_QUALITY = 80
+
+# config email text
+BODY_TEXT_TEMPLATE = "ALERT - Possible Intruder!!!" \
+    "\r\n" \
+    "\r\nThis ALERT has been triggered because some labels have been detected:" \
+    "\r\n  - Labels Alert: __labels_found__" \
+    "\r\n  - Time (UTC): __time__" \
+    "\r\nPlease, see the attached file with the capture of the possible intrusion." \
+    "\r\n" \
+    "\r\nThis email has been generated automatically using AWS services by me"
+BODY_HTML_TEMPLATE = """\
+<html>
+<head></head>
+<body>
+<h1><span style="color: #ff0000;">ALERT - Possible Intruder!!!</span></h1>
+<p>This ALERT has been triggered because some labels have been detected:</p>
+<ul>
+<li>Labels Alert: <strong>__labels_alert_found__</strong></li>
+<li>Time (UTC): <strong>__eventTime__</strong></li>
+</ul>
+<p>Please, see the <strong>attached file</strong> with the capture of the possible intrusion.</p>
+<p>&nbsp;</p>
+<p><em>This email has been generated automatically using <strong><span style="color: #ff9900;">AWS services</span></strong> by <strong><span style="color: #800080;">me</span></strong></em></p>
+</body>
+</html>
+"""
@@ -1,25 +1,43 @@
-from datetime import datetime as dt
-import boto3
+from datetime import datetime as dt, timedelta as td
+import json
 
-from config import TABLE_NAME, DATE_FORMAT, ID_ALERTS_CAMS_IMG_PERIOD, ID_ALERTS_CAMS_IMG_LAST
+from aws_clients import get_client
+from params_loader import ParamsLoader
+from alert_cams_img_config import TABLE_NAME, DATE_FORMAT, ID_ALERTS_CAMS_IMG_PERIOD, ID_ALERTS_CAMS_IMG_LAST,\
+    ID_ALERTS_CAMS_IMG_DIGEST, ALERT_DIGEST_ENABLED, ALERT_DIGEST_DETECTIONS_MAX
+
+# fields of every detection of the digest, stored as a compact json list
+DIGEST_DETECTION_FIELDS = ['s3_bucket_name_src', 's3_object_key_src', 'eventTime', 'labels_alert_found', 'score']
 
 
 class AlertCamsImgDAO:
+    """
+    lambda layer dependencies:
+        - common
+    """
+
+    # PARAMS items: static (cached across warm invocations) and fresh (read every invocation)
+    IDS_STATIC = [ID_ALERTS_CAMS_IMG_PERIOD]
+    IDS_FRESH = [ID_ALERTS_CAMS_IMG_LAST] + ([ID_ALERTS_CAMS_IMG_DIGEST] if ALERT_DIGEST_ENABLED else [])
+
+    def __init__(self, params_loader=None):
+        self.client = get_client('dynamodb') if params_loader is None else params_loader.client
+        self.params_loader = params_loader if params_loader is not None else ParamsLoader(TABLE_NAME, self.client)
 
-    def __init__(self):
-        self.client = boto3.client('dynamodb')
+    def load_params(self):
+        return self.params_loader.load(ids_static=AlertCamsImgDAO.IDS_STATIC, ids_fresh=AlertCamsImgDAO.IDS_FRESH)
     
     def get_period(self):
         _id = ID_ALERTS_CAMS_IMG_PERIOD
-        response = self.client.get_item(TableName=TABLE_NAME, Key={'id': {'S': _id}})
-        value = response['Item']['value']['N']
+        item = self.params_loader.get_item(_id, static=True)
+        value = item['value']['N']
         period = int(value)
         return period
 
     def get_last_date(self):
         _id = ID_ALERTS_CAMS_IMG_LAST
-        response = self.client.get_item(TableName=TABLE_NAME, Key={'id': {'S': _id}})
-        value = response['Item']['value']['S']
+        item = self.params_loader.get_item(_id)
+        value = item['value']['S']
         alarm_last_date = dt.strptime(value, DATE_FORMAT)
         return alarm_last_date
 
@@ -28,4 +46,101 @@ class AlertCamsImgDAO:
         value = dt.now().strftime(DATE_FORMAT)
         item = {'id': {'S': _id}, 'value': {'S': value}}
         response = self.client.put_item(TableName=TABLE_NAME, Item=item)
+        self.params_loader.set_item(_id, item)
         return response
+
+    def claim_last_date(self, period, camera_id=None):
+        """
+        Sets the last alert date of camera_id (global if None) to now, in a single conditional update_item, only if
+        period has elapsed since the previous one: only one of concurrent invocations claims every alert period.
+        :return: tuple (claimed, previous last alert date, None if there is none)
+        """
+        # lazy imports, only needed to alert (not in the early exit paths)
+        from botocore.exceptions import ClientError
+
+        _id = ID_ALERTS_CAMS_IMG_LAST if camera_id is None else f"{ID_ALERTS_CAMS_IMG_LAST}_{camera_id}"
+        dt_now = dt.now()
+        last_date_max = dt_now - td(seconds=period)
+        try:
+            # DATE_FORMAT dates are compared as strings in the same order as dates
+            response = self.client.update_item(
+                TableName=TABLE_NAME, Key={'id': {'S': _id}},
+                UpdateExpression='SET #value = :now',
+                ConditionExpression='attribute_not_exists(#value) OR #value <= :last_date_max',
+                ExpressionAttributeNames={'#value': 'value'},
+                ExpressionAttributeValues={':now': {'S': dt_now.strftime(DATE_FORMAT)},
+                                           ':last_date_max': {'S': last_date_max.strftime(DATE_FORMAT)}},
+                ReturnValues='ALL_OLD',
+                ReturnValuesOnConditionCheckFailure='ALL_OLD')
+            claimed, item = True, response.get('Attributes')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            claimed, item = False, e.response.get('Item')  # ok, expected (alert period not elapsed)
+        self.params_loader.set_item(_id, {'id': {'S': _id}, 'value': {'S': dt_now.strftime(DATE_FORMAT)}}
+                                    if claimed else item)
+        last_date = dt.strptime(item['value']['S'], DATE_FORMAT) if item is not None and 'value' in item else None
+        return claimed, last_date
+
+    def get_digest_detections(self):
+        _id = ID_ALERTS_CAMS_IMG_DIGEST
+        try:
+            item = self.params_loader.get_item(_id)
+        except KeyError:
+            return []  # ok, no detections since the last alert
+        return [dict(zip(DIGEST_DETECTION_FIELDS, json.loads(value['S']))) for value in item['value']['L']]
+
+    def append_digest_detection(self, detection, detections_max=ALERT_DIGEST_DETECTIONS_MAX):
+        """
+        Appends detection to the digest atomically (concurrent invocations do not lose any), if it has less than
+        detections_max.
+        :return: whether detection was appended
+        """
+        # lazy imports, only needed in digest mode (not in the early exit paths)
+        from botocore.exceptions import ClientError
+
+        _id = ID_ALERTS_CAMS_IMG_DIGEST
+        value = json.dumps([detection[field] for field in DIGEST_DETECTION_FIELDS], separators=(',', ':'))
+        try:
+            response = self.client.update_item(
+                TableName=TABLE_NAME, Key={'id': {'S': _id}},
+                UpdateExpression='SET #value = list_append(if_not_exists(#value, :empty), :detection)',
+                ConditionExpression='attribute_not_exists(#value) OR size(#value) < :detections_max',
+                ExpressionAttributeNames={'#value': 'value'},
+                ExpressionAttributeValues={':empty': {'L': []}, ':detection': {'L': [{'S': value}]},
+                                           ':detections_max': {'N': str(detections_max)}},
+                ReturnValues='UPDATED_NEW')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False  # ok, expected (digest full)
+            raise e
+        self.params_loader.set_item(_id, {'id': {'S': _id}, 'value': response['Attributes']['value']})
+        return True
+
+    def remove_digest_detections(self, detections_count):
+        """
+        Removes the first detections_count detections of the digest (those sent) atomically, if it still has them:
+        the detections appended since the digest was read (concurrent invocations) are kept.
+        :return: whether they were removed
+        """
+        # lazy imports, only needed in digest mode (not in the early exit paths)
+        from botocore.exceptions import ClientError
+
+        if detections_count == 0:
+            return True
+        _id = ID_ALERTS_CAMS_IMG_DIGEST
+        try:
+            response = self.client.update_item(
+                TableName=TABLE_NAME, Key={'id': {'S': _id}},
+                UpdateExpression='REMOVE ' + ', '.join(f"#value[{i}]" for i in range(detections_count)),
+                ConditionExpression='size(#value) >= :detections_count',
+                ExpressionAttributeNames={'#value': 'value'},
+                ExpressionAttributeValues={':detections_count': {'N': str(detections_count)}},
+                ReturnValues='ALL_NEW')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                self.params_loader.set_item(_id, None)
+                return False  # ok, expected (removed meanwhile)
+            raise e
+        self.params_loader.set_item(_id, response['Attributes'])
+        return True
@@ -0,0 +1,74 @@
+from alert_cams_img_email import build_ses_msg, build_ses_digest_msg, send_ses_msg
+
+import logging
+logger = logging.getLogger()
+
+
+# ------------------------------------------------------------------------------
+# alert digest of alert_cams_img (and class_cam_img, fused classify and alert mode), if ALERT_DIGEST_ENABLED:
+# the detections worth alerting within the alert period are accumulated in the PARAMS item alert_cams_img_digest
+# (instead of dropped), and sent in a single email once it is over, with the first detection after it (if any).
+# A single digest of all the cameras, so its alert period is the global one (alert_cams_img_last)
+#
+# lambda layer dependencies:
+#     - common
+# ------------------------------------------------------------------------------
+
+
+def build_detection(class_dict, labels_alert_found, labels=()):
+    """
+    :param labels: labels of the detect_labels response (with their confidence), the best detections are attached
+    :return: detection of the digest: dict with the fields of DIGEST_DETECTION_FIELDS (see alert_cams_img_dao)
+    """
+    confidences = [label['Confidence'] for label in labels if label['Name'] in labels_alert_found]
+    return {
+        's3_bucket_name_src': class_dict['s3_bucket_name_src'],
+        's3_object_key_src': class_dict['s3_object_key_src'],
+        'eventTime': class_dict['eventTime'],
+        'labels_alert_found': labels_alert_found,
+        'score': round(max(confidences, default=0.0), 2),
+    }
+
+
+def alert_digest(alert_service, detections, data_bytes_by_key=None):
+    """
+    Claims the alert period (see AlertCamsImgService.claim_period) if there are detections to alert: in this
+    invocation or in the digest. If claimed (the previous one is over), sends the digest and detections in a single
+    email (the same email as without digest if there is a single detection), otherwise appends detections to the
+    digest, to be sent once the alert period just claimed is over.
+    The detections of the digest are only removed from it once sent: if the email is not sent, they are kept and
+    detections are appended, so they are sent with the next alert instead of lost.
+    :param detections: detections worth alerting of this invocation (see build_detection), none in a scheduled one
+    :param data_bytes_by_key: bytes of the images already downloaded, by s3_object_key_src
+    :return: tuple (log message, response of send_ses_msg, None if no email was sent)
+    """
+    # the last alert date and the digest are read with a single request, the alert period is only claimed (a write)
+    # if it seems over
+    alert_validate = alert_service.validate_period()
+    detections_digest = alert_service.get_digest_detections()
+    if len(detections) == 0 and len(detections_digest) == 0:
+        return "NO detections worth alerting nor in the alert digest, NO alert, OK!", None
+
+    # only one of concurrent invocations claims the alert period, and sends the digest
+    alert_claimed = alert_validate and alert_service.claim_period()
+    if not alert_claimed and len(detections) == 0:
+        return "alert digest pending, NOT sent BEFORE alert period, OK!", None
+    if not alert_claimed:
+        appended = sum(1 for detection in detections if alert_service.append_digest_detection(detection))
+        return f"{appended} of {len(detections)} detections added to the alert digest, NO alert yet, OK!", None
+
+    detections_sent = detections_digest + detections
+    if len(detections_sent) == 1:
+        detection = detections_sent[0]
+        data_bytes = (data_bytes_by_key or {}).get(detection['s3_object_key_src'])
+        raw_msg = build_ses_msg(detection, detection['labels_alert_found'], data_bytes)
+    else:
+        raw_msg = build_ses_digest_msg(detections_sent, data_bytes_by_key=data_bytes_by_key)
+    response = send_ses_msg(raw_msg)
+    if response is False:
+        appended = sum(1 for detection in detections if alert_service.append_digest_detection(detection))
+        return f"alert digest of {len(detections_sent)} detections NOT sent, kept in the alert digest" \
+               f" ({appended} of {len(detections)} detections added), ERROR !!!", response
+
+    alert_service.remove_digest_detections(len(detections_digest))
+    return f"alert digest of {len(detections_sent)} detections sent, ALERT !!!", response
@@ -0,0 +1,251 @@
+import base64
+import io
+import math
+import os
+
+from aws_clients import get_client
+from snapshot_utils import is_available
+from alert_cams_img_config import AWS_SES_REGION, SENDER, RECIPIENT_LIST, SUBJECT, CHARSET,\
+    BODY_TEXT_TEMPLATE, BODY_HTML_TEMPLATE, ATT_BYTES_MAX, ATT_JPEG_QUALITY, ALERT_DIGEST_FRAMES_MAX,\
+    ALERT_DIGEST_CONTACT_SHEET, ALERT_DIGEST_THUMBNAIL_WIDTH
+
+import logging
+logger = logging.getLogger()
+
+
+# ------------------------------------------------------------------------------
+# alert email of alert_cams_img (and class_cam_img, fused classify and alert mode)
+# https://docs.aws.amazon.com/ses/latest/dg/send-email-raw.html
+#
+# lambda layer dependencies:
+#     - common
+# python dependencies (attachments not downscaled, nor digest contact sheets built, if not available):
+#     - Pillow
+# ------------------------------------------------------------------------------
+
+# raw message: every attachment is serialized as a placeholder, replaced by its base64 lines encoded a chunk at a time
+ATT_PLACEHOLDER = '__attachment_data_base64_{}__'
+ATT_BASE64_CHUNK = 57 * 1024  # whole base64 lines (57 bytes each, encoded as 76 chars and a newline)
+
+IMAGING_MODULES_ATT = {'PIL.Image': 'Pillow'}  # python dependencies of the attachment downscale (numpy not needed)
+
+
+def get_att_data_bytes(class_dict):
+    # read at once into a single bytes object (no intermediate stream copied afterwards)
+    s3 = get_client('s3')
+    response = s3.get_object(Bucket=class_dict['s3_bucket_name_src'], Key=class_dict['s3_object_key_src'])
+    data_bytes = response['Body'].read()
+
+    return data_bytes
+
+
+def fit_att_data_bytes(data_bytes, bytes_max=ATT_BYTES_MAX, quality=ATT_JPEG_QUALITY):
+    """
+    :return: data_bytes if it fits bytes_max (or bytes_max is None), otherwise the image re-encoded as jpeg (quality)
+             and downscaled as needed to fit bytes_max (the smallest encoding tried if none fits)
+    """
+    if bytes_max is None or len(data_bytes) <= bytes_max:
+        return data_bytes
+    if not is_available('attachment downscale', IMAGING_MODULES_ATT):
+        logger.warning(f"attachment of {len(data_bytes)} bytes NOT downscaled to {bytes_max} bytes")
+        return data_bytes
+
+    # lazy imports, optional dependency (see snapshot_utils.is_available)
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data_bytes))
+    image = image if image.mode in ('RGB', 'L') else image.convert('RGB')
+    scale = 1.0
+    for _ in range(4):  # the size of a jpeg is roughly proportional to its pixels, it usually fits in 1 or 2 tries
+        size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+        stream = io.BytesIO()
+        (image if scale == 1.0 else image.resize(size, Image.BILINEAR)).save(stream, format='JPEG', quality=quality)
+        if stream.tell() <= bytes_max:
+            break
+        scale *= 0.95 * (bytes_max / stream.tell()) ** 0.5
+    logger.info(f"attachment re-encoded: {len(data_bytes)} -> {stream.tell()} bytes"
+                f" ({image.width}x{image.height} -> {size[0]}x{size[1]}, jpeg quality {quality})")
+    return stream.getvalue()
+
+
+def build_ses_msg(class_dict, labels_alert_found, data_bytes=None, bytes_max=ATT_BYTES_MAX):
+    """
+    :param data_bytes: bytes of the image attached, downloaded from s3_object_key_src if not given,
+                       fitted to bytes_max (see fit_att_data_bytes)
+    :return: raw message (bytearray), with the image attached (see build_raw_msg)
+    """
+    event_time_str = class_dict['eventTime'].replace('T', ' ').replace('Z', ' ')
+    msg = build_mime_msg(labels_alert_found, event_time_str, [os.path.basename(class_dict['s3_object_key_src'])])
+
+    if data_bytes is None:
+        data_bytes = get_att_data_bytes(class_dict)
+    return build_raw_msg(msg, [fit_att_data_bytes(data_bytes, bytes_max)])
+
+
+def build_ses_digest_msg(detections, frames_max=ALERT_DIGEST_FRAMES_MAX, contact_sheet=ALERT_DIGEST_CONTACT_SHEET,
+                         bytes_max=ATT_BYTES_MAX, data_bytes_by_key=None):
+    """
+    :param detections: detections of the digest (see alert_cams_img_digest.build_detection)
+    :param data_bytes_by_key: bytes of the images already downloaded, by s3_object_key_src (the rest are downloaded)
+    :return: raw message (bytearray), with the best frames_max images (highest score) attached, in date order,
+             or a contact sheet of them (if contact_sheet and Pillow is available), fitted to bytes_max altogether
+    """
+    data_bytes_by_key = data_bytes_by_key or {}
+    detections = sorted(detections, key=lambda detection: detection['eventTime'])
+    detections_best = sorted(detections, key=lambda detection: -detection['score'])[:frames_max]
+    detections_best = sorted(detections_best, key=lambda detection: detection['eventTime'])
+    labels_alert_found = list(dict.fromkeys(label for detection in detections
+                                            for label in detection['labels_alert_found']))
+    event_time_str = f"{detections[0]['eventTime'].replace('T', ' ').replace('Z', '')}" \
+                     f" - {detections[-1]['eventTime'].replace('T', ' ').replace('Z', '')}" \
+                     f" ({len(detections)} detections, {len(detections_best)} best attached)"
+
+    frames = [data_bytes_by_key.get(detection['s3_object_key_src']) or get_att_data_bytes(detection)
+              for detection in detections_best]
+    if contact_sheet and is_available('attachment downscale', IMAGING_MODULES_ATT):
+        captions = [f"{detection['eventTime'].replace('T', ' ').replace('Z', '')} ({detection['score']:.1f}%)"
+                    for detection in detections_best]
+        msg = build_mime_msg(labels_alert_found, event_time_str, ['contact_sheet.jpg'])
+        return build_raw_msg(msg, [fit_att_data_bytes(build_contact_sheet(frames, captions), bytes_max)])
+
+    msg = build_mime_msg(labels_alert_found, event_time_str,
+                         [os.path.basename(detection['s3_object_key_src']) for detection in detections_best])
+    bytes_max_frame = bytes_max // len(frames) if bytes_max is not None else None
+    return build_raw_msg(msg, [fit_att_data_bytes(frame, bytes_max_frame) for frame in frames])
+
+
+def build_contact_sheet(frames, captions, thumbnail_width=ALERT_DIGEST_THUMBNAIL_WIDTH, quality=ATT_JPEG_QUALITY):
+    """
+    :return: jpeg (quality) of a grid of the frames downscaled to thumbnail_width, with their captions
+    """
+    # lazy imports, optional dependency (see snapshot_utils.is_available)
+    from PIL import Image, ImageDraw
+
+    thumbnails = []
+    for frame in frames:
+        image = Image.open(io.BytesIO(frame))
+        image.draft('RGB', (thumbnail_width, thumbnail_width))  # jpeg decoded already downscaled (draft mode)
+        image = image.convert('RGB')
+        thumbnails.append(image.resize((thumbnail_width, max(round(image.height * thumbnail_width / image.width), 1)),
+                                       Image.BILINEAR))
+
+    columns = math.ceil(math.sqrt(len(thumbnails)))
+    rows = math.ceil(len(thumbnails) / columns)
+    thumbnail_height = max(thumbnail.height for thumbnail in thumbnails)
+    sheet = Image.new('RGB', (columns * thumbnail_width, rows * thumbnail_height))
+    draw = ImageDraw.Draw(sheet)
+    for i, (thumbnail, caption) in enumerate(zip(thumbnails, captions)):
+        x, y = (i % columns) * thumbnail_width, (i // columns) * thumbnail_height
+        sheet.paste(thumbnail, (x, y))
+        draw.text((x + 8, y + 8), caption, fill=(255, 255, 0))
+
+    stream = io.BytesIO()
+    sheet.save(stream, format='JPEG', quality=quality)
+    return stream.getvalue()
+
+
+def build_mime_msg(labels_alert_found, event_time_str, filenames):
+    """
+    :return: email message, with an attachment per filename, their data serialized as placeholders
+             (see build_raw_msg)
+    """
+    # lazy imports, only needed to alert (not in the early exit paths)
+    from email.encoders import encode_noop
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.application import MIMEApplication
+
+    # Create a multipart/mixed parent container.
+    msg = MIMEMultipart('mixed')
+    # Add subject, from and to lines.
+    msg['Subject'] = SUBJECT
+    msg['From'] = SENDER
+    msg['To'] = ','.join(RECIPIENT_LIST)
+
+    # Create a multipart/alternative child container.
+    msg_body = MIMEMultipart('alternative')
+
+    # replace template strings with the corresponding data
+    labels_alert_found_str = ",".join(labels_alert_found)
+    body_text = BODY_TEXT_TEMPLATE\
+        .replace('__labels_alert_found__', labels_alert_found_str)\
+        .replace('__eventTime__', event_time_str)
+    body_html = BODY_HTML_TEMPLATE\
+        .replace('__labels_alert_found__', labels_alert_found_str)\
+        .replace('__eventTime__', event_time_str)
+
+    # Encode the text and HTML content and set the character encoding. This step is
+    # necessary if you're sending a message with characters outside the ASCII range.
+    textpart = MIMEText(body_text.encode(CHARSET), 'plain', CHARSET)
+    htmlpart = MIMEText(body_html.encode(CHARSET), 'html', CHARSET)
+
+    # Add the text and HTML parts to the child container.
+    msg_body.attach(textpart)
+    msg_body.attach(htmlpart)
+
+    # Attach the multipart/alternative child container to the multipart/mixed
+    # parent container.
+    msg.attach(msg_body)
+
+    for i, filename in enumerate(filenames):
+        # Define the attachment part, its data base64 encoded afterwards (see build_raw_msg).
+        att = MIMEApplication(ATT_PLACEHOLDER.format(i), _encoder=encode_noop)
+        att['Content-Transfer-Encoding'] = 'base64'
+
+        # Add a header to tell the email client to treat this part as an attachment,
+        # and to give the attachment a name.
+        att.add_header('Content-Disposition', 'attachment', filename=filename)
+
+        # Add the attachment to the parent container.
+        msg.attach(att)
+
+    return msg
+
+
+def build_raw_msg(msg, data_bytes_list):
+    """
+    Serializes msg, with every data_bytes of data_bytes_list base64 encoded in place of its ATT_PLACEHOLDER, a chunk
+    at a time into the raw message: the email generator would make several full size copies of every attachment
+    (decoded, encoded as str, split in lines, written and copied again), this way the peak memory is roughly
+    the images plus the raw message.
+    :return: raw message (bytearray)
+    """
+    tail = msg.as_bytes()
+    raw_msg = bytearray()
+    for i, data_bytes in enumerate(data_bytes_list):
+        head, tail = tail.split(ATT_PLACEHOLDER.format(i).encode('ascii'), 1)
+        raw_msg += head
+        data_view = memoryview(data_bytes)
+        for j in range(0, len(data_view), ATT_BASE64_CHUNK):
+            raw_msg += base64.encodebytes(data_view[j:j + ATT_BASE64_CHUNK])
+        tail = tail[1:] if tail.startswith(b'\n') else tail  # encodebytes ends with a newline already
+    raw_msg += tail
+    return raw_msg
+
+
+def send_ses_msg(raw_msg):
+    # lazy imports, only needed to alert (not in the early exit paths)
+    from botocore.exceptions import ClientError
+
+    # Create a new SES client and specify a region.
+    ses = get_client('ses', region_name=AWS_SES_REGION)
+
+    try:
+        # Provide the contents of the email.
+        response = ses.send_raw_email(
+            Source=SENDER,
+            Destinations=RECIPIENT_LIST,
+            RawMessage={
+                'Data': raw_msg,
+            },
+            # ConfigurationSetName=CONFIGURATION_SET
+        )
+    # Display an error if something goes wrong.
+    except ClientError as e:
+        logger.info(e.response['Error']['Message'])
+        response = False
+    else:
+        logger.info(f"Email sent! Message ID: {response['MessageId']}"),
+        logger.info(f"response: {response}")
+
+    return response
@@ -0,0 +1,116 @@
+from alert_cams_img_config import LABELS_ALERT, ALERT_RULES
+
+import logging
+logger = logging.getLogger()
+
+
+# ------------------------------------------------------------------------------
+# alert rules of alert_cams_img (and class_cam_img, fused classify and alert mode), compiled once at import time
+# from ALERT_RULES (or LABELS_ALERT), evaluated in a single pass over the labels of a detect_labels response
+#
+# lambda layer dependencies: none
+# ------------------------------------------------------------------------------
+
+RULE_KEYS = {'label', 'confidence_min', 'instances_min', 'area_min', 'zones_include', 'zones_exclude'}
+CAMERA_ANY = '*'
+
+
+def compile_zones(zones):
+    """
+    :param zones: dict {camera_id (or CAMERA_ANY): list of regions [x0, y0, x1, y1]}, or None
+    :return: dict {camera_id: tuple of regions (x0, y0, x1, y1)}
+    """
+    zones_compiled = {}
+    for camera_id, regions in (zones or {}).items():
+        regions_compiled = []
+        for region in regions:
+            x0, y0, x1, y1 = (float(x) for x in region)
+            if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+                raise ValueError(f"zone region {region} of camera '{camera_id}' NOT valid (relative, 0-1)")
+            regions_compiled.append((x0, y0, x1, y1))
+        zones_compiled[camera_id] = tuple(regions_compiled)
+    return zones_compiled
+
+
+def compile_rules(rules=ALERT_RULES, labels_alert=LABELS_ALERT):
+    """
+    :param rules: list of dicts (see ALERT_RULES), None for a rule without thresholds per label of labels_alert
+    :return: dict {label (lower case): compiled rule}
+    :raise ValueError: if a rule is not valid
+    """
+    if rules is None:
+        rules = [{'label': label_alert} for label_alert in labels_alert]
+
+    rules_compiled = {}
+    for rule in rules:
+        keys_unknown = set(rule) - RULE_KEYS
+        if 'label' not in rule or len(keys_unknown) > 0:
+            raise ValueError(f"alert rule {rule} NOT valid, 'label' required, unknown keys: {sorted(keys_unknown)}")
+        zones_include = compile_zones(rule.get('zones_include'))
+        zones_exclude = compile_zones(rule.get('zones_exclude'))
+        area_min = float(rule.get('area_min', 0.0))
+        instances_min = int(rule.get('instances_min', 0))
+        # the instance filters (area, zones) need at least an instance that passes them
+        if area_min > 0 or len(zones_include) > 0 or len(zones_exclude) > 0:
+            instances_min = max(instances_min, 1)
+        rules_compiled[rule['label'].lower()] = {
+            'label': rule['label'],
+            'confidence_min': float(rule.get('confidence_min', 0.0)),
+            'instances_min': instances_min,
+            'area_min': area_min,
+            'zones_include': zones_include,
+            'zones_exclude': zones_exclude,
+        }
+    return rules_compiled
+
+
+# compiled once per container (at import time), not per invocation
+RULES = compile_rules()
+
+
+def in_regions(x, y, regions):
+    return any(x0 <= x <= x1 and y0 <= y <= y1 for x0, y0, x1, y1 in regions)
+
+
+def count_instances(rule, instances, camera_id=None):
+    """
+    :return: number of instances (bounding boxes) of a label that pass the area and zone filters of rule: an area of
+             at least area_min, and a center within the include zones (if any) and outside the exclude zones
+             of camera_id (or of any camera)
+    """
+    zones_include = rule['zones_include'].get(camera_id, rule['zones_include'].get(CAMERA_ANY))
+    zones_exclude = rule['zones_exclude'].get(camera_id, rule['zones_exclude'].get(CAMERA_ANY))
+    count = 0
+    for instance in instances:
+        box = instance.get('BoundingBox')
+        if box is None:
+            continue
+        if box['Width'] * box['Height'] < rule['area_min']:
+            continue
+        x, y = box['Left'] + box['Width'] / 2, box['Top'] + box['Height'] / 2
+        if zones_include is not None and not in_regions(x, y, zones_include):
+            continue
+        if zones_exclude is not None and in_regions(x, y, zones_exclude):
+            continue
+        count += 1
+    return count
+
+
+def get_labels_alert_found(labels, camera_id=None, rules=None):
+    """
+    :param labels: labels of a detect_labels response (Name, Confidence, Instances)
+    :param camera_id: camera of the snapshot, for the zones of the rules (see AlertCamsImgService.get_camera_id)
+    :return: list of the names of the labels worth alerting, those matching their rule (RULES, case insensitive):
+             confidence, instances (with their area and zones filters)
+    """
+    rules = RULES if rules is None else rules
+    labels_alert_found = []
+    for label in labels:
+        rule = rules.get(label['Name'].lower())
+        if rule is None or label.get('Confidence', 100.0) < rule['confidence_min']:
+            continue
+        if rule['instances_min'] > 0 \
+                and count_instances(rule, label.get('Instances', []), camera_id) < rule['instances_min']:
+            continue
+        labels_alert_found.append(label['Name'])
+    return labels_alert_found
@@ -1,12 +1,20 @@
 from datetime import datetime as dt
 
+from snapshot_utils import get_camera_id
 from alert_cams_img_dao import AlertCamsImgDAO
 
 
 class AlertCamsImgService:
+    """
+    lambda layer dependencies:
+        - common
+    """
 
-    def __init__(self):
-        self.alert_dao = AlertCamsImgDAO()
+    def __init__(self, params_loader=None):
+        self.alert_dao = AlertCamsImgDAO(params_loader)
+
+    def load_params(self):
+        return self.alert_dao.load_params()
     
     def get_period(self):
         return self.alert_dao.get_period()
@@ -17,8 +25,40 @@ class AlertCamsImgService:
     def update_last_date(self):
         return self.alert_dao.update_last_date()
 
+    @staticmethod
+    def get_camera_id(class_dict):
+        return get_camera_id(class_dict['s3_bucket_name_src'], class_dict['s3_object_key_src'])
+
+    def claim_period(self, camera_id=None, return_metadata=False):
+        """
+        Claims the alert of the alert period of camera_id (global if None), atomically (see
+        AlertCamsImgDAO.claim_last_date): unlike validate_period and update_last_date, only one of concurrent
+        invocations alerts. Only the alert period is read (static, cached across warm invocations).
+        """
+        self.alert_dao.params_loader.load(ids_static=self.alert_dao.IDS_STATIC)
+        alert_period = self.alert_dao.get_period()
+        alert_claimed, alert_last_date = self.alert_dao.claim_last_date(alert_period, camera_id)
+        alert_second_since_last = int((dt.now() - alert_last_date).total_seconds()) \
+            if alert_last_date is not None else None
+
+        if return_metadata:
+            return alert_claimed, (alert_period, alert_last_date, alert_second_since_last)
+        else:
+            return alert_claimed
+
+    def get_digest_detections(self):
+        return self.alert_dao.get_digest_detections()
+
+    def append_digest_detection(self, detection):
+        return self.alert_dao.append_digest_detection(detection)
+
+    def remove_digest_detections(self, detections_count):
+        return self.alert_dao.remove_digest_detections(detections_count)
+
     def validate_period(self, return_metadata=False):
-        
+
+        # all the PARAMS items needed, with a single request (static ones cached)
+        self.alert_dao.load_params()
         alert_period = self.alert_dao.get_period()
         alert_last_date = self.alert_dao.get_last_date()
         dt_now = dt.now()
@@ -1,5 +0,0 @@
-# config dao
-TABLE_NAME = 'PARAMS'
-DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
-ID_ALERTS_CAMS_IMG_PERIOD = 'alert_cams_img_period'
-ID_ALERTS_CAMS_IMG_LAST = 'alert_cams_img_last'
@@ -0,0 +1,106 @@
+import threading
+
+# ------------------------------------------------------------------------------
+# USAGE:
+#
+#   # get the shared clients (and resources) instead of calling boto3.client / boto3.resource:
+#   from aws_clients import get_client, get_resource
+#   s3 = get_client('s3')
+#
+# clients are created once per container (lambda execution environment) and reused by warm invocations,
+# so they skip the client construction, the credentials resolution and the TLS handshakes (keep-alive).
+# clients are thread safe and shared by all threads, resources are not, so they are created once per thread.
+# boto3 is imported lazily, with the first client or resource, not when this module is imported.
+# the AWS calls of the clients and resources are recorded by aws_metrics (latency, retries and payload size).
+# ------------------------------------------------------------------------------
+
+
+# config clients
+MAX_POOL_CONNECTIONS = 64
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+RETRIES = {'mode': 'standard', 'max_attempts': 5}
+TCP_KEEPALIVE = True
+
+_session = None
+_client_config = None
+_clients = {}
+_resources_shared = {}
+_thread_local = threading.local()
+_lock = threading.Lock()
+
+
+def get_client(service_name, region_name=None):
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service_name, region_name=region_name, config=_get_client_config())
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name, region_name=None):
+    resources = getattr(_thread_local, 'resources', None)
+    if resources is None:
+        resources = _thread_local.resources = {}
+    key = (service_name, region_name)
+    resource = _resources_shared.get(key, resources.get(key))
+    if resource is None:
+        with _lock:
+            session = _get_session()
+            resource = session.resource(service_name, region_name=region_name, config=_get_client_config())
+        resources[key] = resource
+    return resource
+
+
+def set_client(service_name, client, region_name=None):
+    """
+    Replaces the shared client of service_name, e.g. with a botocore Stubber or a local stand-in.
+    """
+    with _lock:
+        _clients[(service_name, region_name)] = client
+
+
+def set_resource(service_name, resource, region_name=None):
+    """
+    Replaces the resource of service_name for all threads, e.g. with a local stand-in.
+    """
+    with _lock:
+        _resources_shared[(service_name, region_name)] = resource
+
+
+def clear():
+    """
+    Drops the shared session, clients and the resources of the current thread (they are created again when needed).
+    """
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources_shared.clear()
+        _thread_local.resources = {}
+
+
+def _get_session():
+    # the boto3 default session is not thread safe, a single session is created (under _lock) and shared
+    global _session
+    if _session is None:
+        import boto3.session
+        from aws_metrics import METRICS_ENABLED, register_hooks
+        _session = boto3.session.Session()
+        if METRICS_ENABLED:
+            # every AWS call of its clients and resources is recorded (see aws_metrics)
+            register_hooks(_session.events)
+    return _session
+
+
+def _get_client_config():
+    global _client_config
+    if _client_config is None:
+        from botocore.config import Config
+        _client_config = Config(max_pool_connections=MAX_POOL_CONNECTIONS, connect_timeout=CONNECT_TIMEOUT,
+                                read_timeout=READ_TIMEOUT, retries=RETRIES, tcp_keepalive=TCP_KEEPALIVE)
+    return _client_config
@@ -0,0 +1,251 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+# USAGE:
+#
+# lambda_function.py:
+#
+#   from aws_metrics import set_stage, emit_metrics_on_return
+#
+#   # decorate lambda_handler(), a metrics record is emitted when it returns
+#   @emit_metrics_on_return
+#   def lambda_handler(event, context):
+#       set_stage('validate')
+#       ...
+#       set_stage('classify')  # the previous stage ends where the next one starts
+#       ...
+#
+# Every AWS call of the clients and resources of aws_clients is recorded (botocore event hooks, registered once in
+# the shared session): its latency (retries included, until the response headers), retries, bytes sent and
+# received, and errors, per operation and per stage (the current stage of the invocation when the call is made).
+# A single metrics record per invocation is written to stdout in the CloudWatch embedded metric format (EMF),
+# so CloudWatch Logs extracts its metrics with no API call:
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+#
+# Calls of clients that are not botocore ones (e.g. the local stand-ins of the benchmarks) are recorded with
+# record_call().
+# ------------------------------------------------------------------------------
+
+
+# config metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true') == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'aws-ipcam-alert')
+METRICS_MAX = 100  # metrics per EMF record (CloudWatch limit), the rest are kept as properties only
+STAGE_DEFAULT = 'handler'  # stage before the first set_stage()
+CONTEXT_KEY = 'aws_metrics'  # key of the call in the request context of botocore
+
+
+class InvocationMetrics:
+    """
+    Stages and AWS calls of an invocation. Thread safe: the calls may be made by several threads (e.g. S3Prefetcher),
+    and they are attributed to the current stage of the invocation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.t_start = time.perf_counter()
+        self.stage = STAGE_DEFAULT
+        self.t_stage_start = self.t_start
+        self.stages = {}  # {stage: {'ms', 'aws_calls', 'aws_ms'}}
+        self.calls = {}  # {'service.Operation': {'calls', 'retries', 'errors', 'latency_ms', 'latency_max_ms', ...}}
+
+    def set_stage(self, stage):
+        """
+        Ends the current stage and starts stage (the time of a stage set more than once is added up).
+        """
+        with self._lock:
+            t_now = time.perf_counter()
+            self._get_stage(self.stage)['ms'] += (t_now - self.t_stage_start) * 1000
+            self.stage, self.t_stage_start = stage, t_now
+
+    def record_call(self, service, operation, latency_ms, retries=0, bytes_sent=0, bytes_received=0, error=False):
+        with self._lock:
+            call = self.calls.get(f"{service}.{operation}")
+            if call is None:
+                call = self.calls[f"{service}.{operation}"] = {
+                    'calls': 0, 'retries': 0, 'errors': 0, 'latency_ms': 0.0, 'latency_max_ms': 0.0,
+                    'bytes_sent': 0, 'bytes_received': 0}
+            call['calls'] += 1
+            call['retries'] += retries
+            call['errors'] += 1 if error else 0
+            call['latency_ms'] += latency_ms
+            call['latency_max_ms'] = max(call['latency_max_ms'], latency_ms)
+            call['bytes_sent'] += bytes_sent
+            call['bytes_received'] += bytes_received
+            stage = self._get_stage(self.stage)
+            stage['aws_calls'] += 1
+            stage['aws_ms'] += latency_ms
+
+    def _get_stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {'ms': 0.0, 'aws_calls': 0, 'aws_ms': 0.0}
+        return self.stages[stage]
+
+    def to_emf(self, function_name=None, request_id=None, namespace=METRICS_NAMESPACE):
+        """
+        Ends the current stage.
+        :return: dict metrics record, in the CloudWatch embedded metric format (dimension FunctionName)
+        """
+        self.set_stage(None)
+        with self._lock:
+            self.stages.pop(None, None)
+            values = {
+                'Duration': ((time.perf_counter() - self.t_start) * 1000, 'Milliseconds'),
+                'AwsCalls': (sum(call['calls'] for call in self.calls.values()), 'Count'),
+                'AwsRetries': (sum(call['retries'] for call in self.calls.values()), 'Count'),
+                'AwsErrors': (sum(call['errors'] for call in self.calls.values()), 'Count'),
+                'AwsLatency': (sum(call['latency_ms'] for call in self.calls.values()), 'Milliseconds'),
+                'AwsBytesSent': (sum(call['bytes_sent'] for call in self.calls.values()), 'Bytes'),
+                'AwsBytesReceived': (sum(call['bytes_received'] for call in self.calls.values()), 'Bytes'),
+            }
+            values.update({f"Stage.{stage}": (stage_dict['ms'], 'Milliseconds')
+                           for stage, stage_dict in self.stages.items()})
+            for name, call in sorted(self.calls.items()):
+                values[f"{name}.Calls"] = (call['calls'], 'Count')
+                values[f"{name}.Latency"] = (call['latency_ms'], 'Milliseconds')
+
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['FunctionName']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()][:METRICS_MAX],
+                    }],
+                },
+                'FunctionName': function_name,
+                'RequestId': request_id,
+                'Stages': {stage: _round(stage_dict) for stage, stage_dict in self.stages.items()},
+                'AwsCallsDetail': {name: _round(call) for name, call in sorted(self.calls.items())},
+            }
+            record.update({name: round(value, 3) for name, (value, _) in values.items()})
+            return record
+
+
+_metrics = InvocationMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def reset_metrics():
+    """
+    Starts the metrics of a new invocation (see emit_metrics_on_return).
+    """
+    global _metrics
+    _metrics = InvocationMetrics()
+    return _metrics
+
+
+def set_stage(stage):
+    _metrics.set_stage(stage)
+
+
+def record_call(service, operation, latency_ms, retries=0, bytes_sent=0, bytes_received=0, error=False):
+    _metrics.record_call(service, operation, latency_ms, retries=retries, bytes_sent=bytes_sent,
+                         bytes_received=bytes_received, error=error)
+
+
+def emit_metrics(function_name=None, request_id=None):
+    """
+    Writes the metrics record of the invocation to stdout, a single line on its own (not through the logger,
+    whose format would prefix it), as CloudWatch Logs expects an EMF record.
+    :return: dict metrics record
+    """
+    record = _metrics.to_emf(function_name, request_id)
+    sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+    sys.stdout.flush()
+    return record
+
+
+def emit_metrics_on_return(lambda_handler):
+    """
+    Decorator of lambda_handler, resets the metrics when it is called and emits them (see emit_metrics) when it
+    returns (or raises). No-op if METRICS_ENABLED is False.
+    """
+    if not METRICS_ENABLED:
+        return lambda_handler
+
+    @functools.wraps(lambda_handler)
+    def wrapper(event, context):
+        reset_metrics()
+        try:
+            return lambda_handler(event, context)
+        finally:
+            emit_metrics(getattr(context, 'function_name', os.environ.get('AWS_LAMBDA_FUNCTION_NAME')),
+                         getattr(context, 'aws_request_id', None))
+    return wrapper
+
+
+# ------------------------------------------------------------------------------
+# botocore event hooks
+# ------------------------------------------------------------------------------
+
+def register_hooks(event_emitter):
+    """
+    Registers the hooks that record every AWS call in event_emitter (of a session, so its clients inherit them).
+    """
+    event_emitter.register_first('before-parameter-build.*.*', _before_parameter_build, unique_id='aws_metrics_start')
+    event_emitter.register_first('before-call.*.*', _before_call, unique_id='aws_metrics_request')
+    event_emitter.register_last('after-call.*.*', _after_call, unique_id='aws_metrics_response')
+    event_emitter.register_last('after-call-error.*.*', _after_call_error, unique_id='aws_metrics_error')
+
+
+def _before_parameter_build(model, context, **kwargs):
+    context[CONTEXT_KEY] = {'t_start': time.perf_counter(), 'service': model.service_model.service_name,
+                            'operation': model.name, 'bytes_sent': 0}
+
+
+def _before_call(params, context, **kwargs):
+    # registered first, so it runs even if another handler returns the response (e.g. a botocore Stubber)
+    call = context.get(CONTEXT_KEY)
+    if call is not None:
+        call['bytes_sent'] = _get_payload_size(params.get('body'))
+
+
+def _after_call(http_response, parsed, context, **kwargs):
+    try:
+        bytes_received = int(http_response.headers.get('content-length', 0))
+    except (AttributeError, TypeError, ValueError):
+        bytes_received = 0
+    _record_context_call(context, bytes_received, http_response.status_code >= 300)
+
+
+def _after_call_error(context, **kwargs):
+    # the request failed (e.g. a connection error, after its retries), there is no response
+    _record_context_call(context, 0, True)
+
+
+def _record_context_call(context, bytes_received, error):
+    call = context.pop(CONTEXT_KEY, None)
+    if call is None:
+        return
+    # attempts made by botocore (endpoint), none if the response was returned by another handler
+    retries = max(context.get('retries', {}).get('attempt', 1) - 1, 0)
+    record_call(call['service'], call['operation'], (time.perf_counter() - call['t_start']) * 1000, retries=retries,
+                bytes_sent=call['bytes_sent'], bytes_received=bytes_received, error=error)
+
+
+def _get_payload_size(body):
+    if body is None or isinstance(body, dict):
+        return 0  # no body, or query parameters (encoded later, small)
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    try:
+        # file-like, without reading it
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def _round(d, digits=3):
+    return {k: round(v, digits) if isinstance(v, float) else v for k, v in d.items()}
@@ -0,0 +1,112 @@
+import time
+
+from aws_clients import get_client
+
+import logging
+logger = logging.getLogger()
+
+
+# config params loader
+BATCH_GET_ITEM_MAX_KEYS = 100  # dynamodb batch_get_item max keys per request
+CACHE_TTL_DEFAULT = 300  # seconds the static items are cached (across warm invocations)
+UNPROCESSED_KEYS_BACKOFF = 0.05  # seconds, doubled on every retry of the unprocessed keys
+
+# static items cache, at module level to be kept across warm invocations: {(table_name, id): (t_expiration, item)}
+_static_items_cache = {}
+
+
+def invalidate_cache(table_name=None, ids=None):
+    """
+    Invalidates the cached static items, all of them by default, or only those of table_name and/or ids.
+    """
+    for table_name_id in list(_static_items_cache):
+        if (table_name is None or table_name_id[0] == table_name) and (ids is None or table_name_id[1] in ids):
+            del _static_items_cache[table_name_id]
+
+
+class ParamsLoader:
+    """
+    Loads the items of a PARAMS-like table (key 'id') that an invocation needs, with a single batch_get_item.
+
+    Static items (thresholds, periods, flags) are cached at module level for cache_ttl seconds, so warm invocations
+    do not read them again. Fresh items (counters, dates) are always read, once per ParamsLoader instance,
+    which is meant to live for one invocation and keeps a snapshot of the items loaded (self.items).
+
+    lambda layer dependencies: none (aws_clients, same layer)
+    """
+
+    def __init__(self, table_name, client=None, cache_ttl=CACHE_TTL_DEFAULT):
+        self.table_name = table_name
+        self.client = client if client is not None else get_client('dynamodb')
+        self.cache_ttl = cache_ttl
+        self.items = {}
+
+    def load(self, ids_static=(), ids_fresh=()):
+        """
+        Loads into self.items the static ids (from cache if not expired) and the fresh ids not loaded yet,
+        reading from dynamodb all the missing ones with a single batch_get_item (per BATCH_GET_ITEM_MAX_KEYS).
+        """
+        t_now = time.monotonic()
+        ids_to_get = {_id for _id in ids_fresh if _id not in self.items}
+        for _id in ids_static:
+            t_expiration, item = _static_items_cache.get((self.table_name, _id), (0, None))
+            if t_now < t_expiration:
+                self.items[_id] = item
+            elif _id not in self.items:
+                ids_to_get.add(_id)
+
+        if len(ids_to_get) > 0:
+            items = self._batch_get_items(sorted(ids_to_get))
+            logger.debug("params loaded from table '%s': %s", self.table_name, sorted(items))
+            for _id in ids_to_get:
+                self.items[_id] = items.get(_id)
+        for _id in ids_static:
+            if _id in ids_to_get and self.items[_id] is not None:
+                _static_items_cache[(self.table_name, _id)] = (t_now + self.cache_ttl, self.items[_id])
+
+        return self.items
+
+    def get_item(self, _id, static=False):
+        """
+        :return: item _id, loaded (with a get request of its own) if it was not loaded yet
+        :raise KeyError: if the item does not exist in the table
+        """
+        if _id not in self.items or (static and self.items[_id] is None):
+            self.load(ids_static=[_id] if static else [], ids_fresh=[] if static else [_id])
+        item = self.items.get(_id)
+        if item is None:
+            raise KeyError(f"item '{_id}' NOT found in table '{self.table_name}'")
+        return item
+
+    def set_item(self, _id, item):
+        """
+        Keeps the snapshot consistent after writing item _id (None if it is not known anymore).
+        """
+        if item is None:
+            self.items.pop(_id, None)
+        else:
+            self.items[_id] = item
+
+    def invalidate(self, ids=None):
+        """
+        Invalidates the snapshot and the cache of ids (all of them by default).
+        """
+        for _id in list(self.items) if ids is None else ids:
+            self.items.pop(_id, None)
+        invalidate_cache(self.table_name, ids)
+
+    def _batch_get_items(self, ids):
+        items = {}
+        for i in range(0, len(ids), BATCH_GET_ITEM_MAX_KEYS):
+            keys = [{'id': {'S': _id}} for _id in ids[i:i + BATCH_GET_ITEM_MAX_KEYS]]
+            request_items = {self.table_name: {'Keys': keys}}
+            retry = 0
+            while len(request_items) > 0:
+                if retry > 0:
+                    time.sleep(UNPROCESSED_KEYS_BACKOFF * 2 ** (retry - 1))
+                response = self.client.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(self.table_name, []):
+                    items[item['id']['S']] = item
+                request_items = response.get('UnprocessedKeys', {})
+                retry += 1
+        return items
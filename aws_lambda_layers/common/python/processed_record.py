@@ -0,0 +1,58 @@
+import json
+
+import logging
+logger = logging.getLogger()
+
+
+# ------------------------------------------------------------------------------
+# processed records of class_cam_img (the json of every snapshot in processed_bucket), compact schema: the
+# Classification block and the labels of the detect_labels response, only the fields needed to alert and for analytics
+# (no s3 event, nor ResponseMetadata, already in the Classification block or useless), serialized without whitespace.
+# The full records written before (Classification, s3 event Records and the whole detect_labels response) are still
+# read the same way, and compacted by compact_record
+#
+# lambda layer dependencies: none
+# ------------------------------------------------------------------------------
+
+CONFIDENCE_DIGITS = 2  # %
+BOUNDING_BOX_DIGITS = 4  # relative to the image, 0.0001 is 0.2 px of a 1920 px wide snapshot
+
+
+def compact_labels(labels):
+    """
+    :param labels: labels of a detect_labels response
+    :return: labels with the fields of the alert rules and analytics only: Name, Confidence, Instances (BoundingBox,
+             Confidence) and Parents (Name), rounded
+    """
+    return [{
+        'Name': label['Name'],
+        'Confidence': round(label['Confidence'], CONFIDENCE_DIGITS),
+        'Instances': [{'BoundingBox': {k: round(v, BOUNDING_BOX_DIGITS) for k, v in instance['BoundingBox'].items()},
+                       'Confidence': round(instance['Confidence'], CONFIDENCE_DIGITS)}
+                      for instance in label.get('Instances', []) if 'BoundingBox' in instance],
+        'Parents': [{'Name': parent['Name']} for parent in label.get('Parents', [])],
+    } for label in labels]
+
+
+def build_record(classification, response_labels):
+    """
+    :param classification: Classification block (see class_cam_img get_json_data)
+    :param response_labels: detect_labels response (or the labels of a processed record)
+    :return: processed record, compact schema
+    """
+    return {
+        'Classification': classification,
+        'Labels': compact_labels(response_labels['Labels']),
+        'LabelModelVersion': response_labels.get('LabelModelVersion'),
+    }
+
+
+def compact_record(record):
+    """
+    :return: record (full or compact schema) in the compact schema
+    """
+    return build_record(record['Classification'], record)
+
+
+def dumps_record(record):
+    return json.dumps(record, separators=(',', ':'))
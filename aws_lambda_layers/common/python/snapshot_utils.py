@@ -0,0 +1,47 @@
+import importlib
+import os
+
+import logging
+logger = logging.getLogger()
+
+
+# ------------------------------------------------------------------------------
+# helpers shared by the modules that handle the snapshots of the cameras
+#
+# lambda layer dependencies: none
+# ------------------------------------------------------------------------------
+
+# optional python dependencies of the image processing: {module: package}
+IMAGING_MODULES = {'numpy': 'numpy', 'PIL.Image': 'Pillow'}
+
+# whether the python dependencies of every feature are available, checked once per container: {feature: bool}
+_available = {}
+
+
+def is_available(feature, modules=IMAGING_MODULES):
+    """
+    :param feature: name of the feature that needs modules, for the warning logged if they are not available
+    :param modules: dict {module: package} of the python dependencies of feature
+    :return: whether every module of modules can be imported
+    """
+    if feature not in _available:
+        try:
+            for module in modules:
+                importlib.import_module(module)
+            _available[feature] = True
+        except ImportError as e:
+            logger.warning(f"{feature} NOT available, {e} ({' and '.join(modules.values())} required)")
+            _available[feature] = False
+    return _available[feature]
+
+
+def get_camera_id(bucket_name, key):
+    # the snapshots of every camera are uploaded to a folder of their own
+    return f"{bucket_name}/{os.path.dirname(key)}"
+
+
+def get_record_camera_id(record):
+    """
+    :return: camera id of the snapshot of the s3 event record
+    """
+    return get_camera_id(record['s3']['bucket']['name'], record['s3']['object']['key'])
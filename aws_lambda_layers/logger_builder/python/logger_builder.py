@@ -1,5 +1,9 @@
+import copy
+import functools
+import json
 import logging
 import os
+import random
 import sys
 import uuid
 
@@ -21,31 +25,115 @@ import uuid
 #   # import the logger normally, from logging:
 #   import logging
 #   logger = logging.getLogger()
+#
+#   # messages formatted lazily (only if emitted), with structured fields (json format) and sampled if high-volume:
+#   logger.info("labels of '%s': %s", key, labels, extra={'data': {'key': key}, 'sample_rate': 0.1})
+#
+# The handler is built once per container and reused across warm invocations (only the request id changes).
+# In queue mode the records are written by a thread of their own, decorate lambda_handler() with
+# @flush_logger_on_return so they are all written before the lambda is frozen.
 # ------------------------------------------------------------------------------
 
 
 # config logger
 LOG_LEVEL_DEFAULT = logging.INFO
-LOGGER_FORMAT = '[%(asctime)s] [%(levelname)s] [__request_id__] %(module)s.%(funcName)s[#%(lineno)s]: %(message)s'
+LOG_FORMAT_DEFAULT = os.environ.get('LOG_FORMAT', 'text')  # 'text' or 'json' (a json object per line)
+LOG_QUEUE_DEFAULT = os.environ.get('LOG_QUEUE') == 'true'  # non-blocking: records written by a listener thread
+LOGGER_FORMAT = '[%(asctime)s] [%(levelname)s] [%(request_id)s] %(module)s.%(funcName)s[#%(lineno)s]: %(message)s'
 REQUEST_ID_DEFAULT_LEN = 8
 
+# handler cached across warm invocations: (handler, its queue listener if queue mode, build key)
+_handler = None
+_listener = None
+_handler_key = None
 
-def build_logger(log_level=LOG_LEVEL_DEFAULT, request_id=None):
-    
-    # clear logger
-    logger = logging.getLogger()
-    logger.handlers = []
-    
-    # formatter
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the request id of the current invocation to every record, and samples the records up to INFO:
+    a record is kept with its sample_rate (extra), or the one of its logger name or module in sampling
+    (e.g. {'s3_prefetcher': 0.1}), all of them if none. Warnings and errors are never sampled.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.request_id = None
+        self.sampling = {}
+
+    def filter(self, record):
+        record.request_id = self.request_id
+        if record.levelno <= logging.INFO:
+            sample_rate = getattr(record, 'sample_rate', None)
+            if sample_rate is None and len(self.sampling) > 0:
+                sample_rate = self.sampling.get(record.name, self.sampling.get(record.module))
+            if sample_rate is not None and random.random() >= sample_rate:
+                return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    A json object per record: time, level, request_id, location, message and the structured fields of extra 'data'.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'request_id': getattr(record, 'request_id', None),
+            'location': f"{record.module}.{record.funcName}[#{record.lineno}]",
+            'message': record.getMessage(),
+        }
+        data = getattr(record, 'data', None)
+        if data is not None:
+            entry.update(data)
+        # the exception may come already formatted (exc_text, see _build_handler queue mode)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    StreamHandler of the current sys.stdout (it may be replaced after the handler is built and cached).
+    """
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+_context_filter = ContextFilter()
+
+
+def build_logger(log_level=LOG_LEVEL_DEFAULT, request_id=None, log_format=LOG_FORMAT_DEFAULT, sampling=None,
+                 queue=LOG_QUEUE_DEFAULT):
+    """
+    :param log_format: 'text' or 'json'
+    :param sampling: dict {logger name or module: rate (0-1)} of the records up to INFO kept (see ContextFilter)
+    :param queue: whether the records are written by a listener thread (see flush_logger)
+    """
+    global _handler, _listener, _handler_key
+
+    # request id and sampling of this invocation
     if request_id is None:
         request_id = _get_request_id_default()
-    stdout_formatter = logging.Formatter(fmt=LOGGER_FORMAT.replace('__request_id__', request_id))
-    
-    # handler
-    stdout_handler = logging.StreamHandler(stream=sys.stdout)
-    stdout_handler.setLevel(log_level)
-    stdout_handler.setFormatter(stdout_formatter)
-    logger.addHandler(stdout_handler)
+    _context_filter.request_id = request_id
+    _context_filter.sampling = sampling or {}
+
+    # handler, built only if there is none yet (cold start) or its config changed
+    logger = logging.getLogger()
+    handler_key = (log_level, log_format, queue)
+    if _handler is None or _handler_key != handler_key or logger.handlers != [_handler]:
+        _handler, _listener = _build_handler(log_level, log_format, queue)
+        _handler_key = handler_key
+        logger.handlers = [_handler]
 
     if "DEBUG" in os.environ and os.environ["DEBUG"] == "true":
         logger.setLevel("DEBUG")
@@ -57,6 +145,67 @@ def build_logger(log_level=LOG_LEVEL_DEFAULT, request_id=None):
     return logger
 
 
+def _build_handler(log_level, log_format, queue):
+    # the listener of the previous handler (queue mode) writes its pending records and stops
+    if _listener is not None:
+        _listener.stop()
+
+    stdout_handler = StdoutHandler()
+    stdout_handler.setLevel(log_level)
+    stdout_handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(fmt=LOGGER_FORMAT))
+    if not queue:
+        stdout_handler.addFilter(_context_filter)
+        return stdout_handler, None
+
+    # lazy imports, only needed in queue mode
+    from logging.handlers import QueueHandler, QueueListener
+    import queue as queue_module
+
+    exc_formatter = logging.Formatter()
+
+    class ExcTextQueueHandler(QueueHandler):
+        # QueueHandler.prepare merges the exception into the message and clears it: it is formatted apart instead
+        # (exc_text, the traceback is not kept until the listener writes the record), so the formatter of the listener
+        # writes it as usual (e.g. the field 'exception' of JsonFormatter)
+        def prepare(self, record):
+            record = copy.copy(record)
+            record.message = record.getMessage()
+            record.msg, record.args = record.message, None
+            if record.exc_info:
+                record.exc_text = record.exc_text or exc_formatter.formatException(record.exc_info)
+                record.exc_info = None
+            return record
+
+    # the records are filtered (request id, sampling) and their message formatted by the caller, written by the listener
+    queue_handler = ExcTextQueueHandler(queue_module.Queue())
+    queue_handler.setLevel(log_level)
+    queue_handler.addFilter(_context_filter)
+    listener = QueueListener(queue_handler.queue, stdout_handler, respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+
+def flush_logger():
+    """
+    Waits until every record queued is written (queue mode), no-op otherwise.
+    """
+    if _listener is not None:
+        _listener.queue.join()
+
+
+def flush_logger_on_return(lambda_handler):
+    """
+    Decorator of lambda_handler, flushes the logger (see flush_logger) before returning.
+    """
+    @functools.wraps(lambda_handler)
+    def wrapper(event, context):
+        try:
+            return lambda_handler(event, context)
+        finally:
+            flush_logger()
+    return wrapper
+
+
 def _get_request_id_default(request_id_len=REQUEST_ID_DEFAULT_LEN):
     request_id = uuid.uuid4().hex
     request_id = request_id[:min(request_id_len, len(request_id))]
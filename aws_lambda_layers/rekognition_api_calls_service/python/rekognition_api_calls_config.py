@@ -8,3 +8,7 @@ ID_DISABLE_UNTIL_ALERT_PERIOD = 'class_cam_img_disable_until_alert_period'  # Al
 
 # config service
 SNS_TOPIC_ARN_DEFAULT = 'arn:aws:sns:aws-region-1:012345678890:sns_topic_name'
+
+# config labels cache
+ID_LABELS_CACHE_PREFIX = 'rekognition_labels_cache_'
+LABELS_CACHE_TTL_SECONDS = 7 * 24 * 3600  # dynamodb TTL attribute 'ttl' (expired entries are ignored anyway)
@@ -1,15 +1,23 @@
 from datetime import datetime as dt
-import boto3
-from botocore.exceptions import ClientError
 
-from config import TABLE_NAME, DATE_SUFFIX_FORMAT,\
+from aws_clients import get_client
+from params_loader import ParamsLoader
+from rekognition_api_calls_config import TABLE_NAME, DATE_SUFFIX_FORMAT,\
     ID_CALLS_MONTH_PREFIX, ID_CALLS_MONTH_MAX_50, ID_CALLS_MONTH_MAX_100, ID_DISABLE_UNTIL_ALERT_PERIOD
 
 
 class RekognitionApiCallsDAO:
+    """
+    lambda layer dependencies:
+        - common
+    """
 
-    def __init__(self, do_create_month_current_if_not_exists=True):
-        self.client = boto3.client('dynamodb')
+    # PARAMS items: static (cached across warm invocations), the current month calls item is updated atomically
+    IDS_STATIC = [ID_DISABLE_UNTIL_ALERT_PERIOD, ID_CALLS_MONTH_MAX_50, ID_CALLS_MONTH_MAX_100]
+
+    def __init__(self, do_create_month_current_if_not_exists=False, params_loader=None):
+        self.client = get_client('dynamodb') if params_loader is None else params_loader.client
+        self.params_loader = params_loader if params_loader is not None else ParamsLoader(TABLE_NAME, self.client)
         self.id_api_calls_month_current = RekognitionApiCallsDAO._build_id_api_calls_month_current()
         if do_create_month_current_if_not_exists:
             self.create_api_calls_month_current_if_not_exists()
@@ -19,13 +27,28 @@ class RekognitionApiCallsDAO:
         _id = f"{ID_CALLS_MONTH_PREFIX}" \
               f"{dt.now().strftime(DATE_SUFFIX_FORMAT)}"
         return _id
+
+    def get_params_ids(self):
+        """
+        :return: tuple (ids_static, ids_fresh) of the PARAMS items used by this dao
+        """
+        return RekognitionApiCallsDAO.IDS_STATIC, []
+
+    def load_params(self, ids_static_extra=(), ids_fresh_extra=()):
+        ids_static, ids_fresh = self.get_params_ids()
+        return self.params_loader.load(ids_static=ids_static + list(ids_static_extra),
+                                       ids_fresh=ids_fresh + list(ids_fresh_extra))
     
     def create_api_calls_month_current_if_not_exists(self):
+        # lazy imports, botocore loaded by the first request anyway (not on import)
+        from botocore.exceptions import ClientError
+
         _id = self.id_api_calls_month_current
         item = {'id': {'S': _id}, 'value': {'N': str(0)}}
         try:
             response = self.client.put_item(TableName=TABLE_NAME, Item=item,
                                             ConditionExpression='attribute_not_exists(id)')
+            self.params_loader.set_item(_id, item)
         except ClientError as e:  
             if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
                 pass  # ok, expected (attribute already exists)
@@ -36,36 +59,100 @@ class RekognitionApiCallsDAO:
     
     def get_api_calls_month_current(self):
         _id = self.id_api_calls_month_current
-        response = self.client.get_item(TableName=TABLE_NAME, Key={'id': {'S': _id}})
-        value = response['Item']['value']['N']
+        try:
+            item = self.params_loader.get_item(_id)
+        except KeyError:
+            return 0  # ok, not created yet for the current month
+        value = item['value']['N']
         api_calls_month_current = int(value)
         return api_calls_month_current
         
-    def increment_api_calls_month_current(self, api_calls_month_current=None):
-        if api_calls_month_current is None:
-            api_calls_month_current = self.get_api_calls_month_current()
+    def increment_api_calls_month_current(self, api_calls=1):
         _id = self.id_api_calls_month_current
-        item = {'id': {'S': _id}, 'value': {'N': str(api_calls_month_current + 1)}}
-        response = self.client.put_item(TableName=TABLE_NAME, Item=item)
+        response = self.client.update_item(
+            TableName=TABLE_NAME, Key={'id': {'S': _id}},
+            UpdateExpression='ADD #value :api_calls',
+            ExpressionAttributeNames={'#value': 'value'},
+            ExpressionAttributeValues={':api_calls': {'N': str(api_calls)}},
+            ReturnValues='UPDATED_NEW')
+        self.params_loader.set_item(_id, {'id': {'S': _id}, 'value': response['Attributes']['value']})
         return response
-    
+
+    def reserve_api_calls_month_current(self, api_calls_month_max_100, api_calls=1):
+        """
+        Reserves api_calls rekognition api calls of the current month in a single atomic update_item:
+        the item is created if it does not exist, and incremented only if it does not exceed api_calls_month_max_100,
+        so concurrent invocations can neither lose increments nor exceed the threshold.
+        A reservation is counted once made, even if the api calls reserved fail afterwards (e.g. detect_labels).
+        :return: tuple (reserved, api_calls_month_current), the latter after the reservation if reserved
+                 (None if unknown, e.g. not reserved without a request)
+        """
+        # lazy imports, botocore loaded by the first request anyway (not on import)
+        from botocore.exceptions import ClientError
+
+        _id = self.id_api_calls_month_current
+
+        # more api calls than the threshold: never reserved (the condition below does not bound the first reservation
+        # of the month, when the item does not exist yet)
+        if api_calls > api_calls_month_max_100:
+            return False, None
+
+        try:
+            response = self.client.update_item(
+                TableName=TABLE_NAME, Key={'id': {'S': _id}},
+                UpdateExpression='SET #value = if_not_exists(#value, :zero) + :api_calls',
+                ConditionExpression='attribute_not_exists(#value) OR #value <= :value_max',
+                ExpressionAttributeNames={'#value': 'value'},
+                ExpressionAttributeValues={':zero': {'N': '0'}, ':api_calls': {'N': str(api_calls)},
+                                           ':value_max': {'N': str(api_calls_month_max_100 - api_calls)}},
+                ReturnValues='UPDATED_NEW',
+                ReturnValuesOnConditionCheckFailure='ALL_OLD')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                item = e.response.get('Item')  # ok, expected (threshold exceeded)
+                self.params_loader.set_item(_id, item)
+                return False, int(item['value']['N']) if item is not None else None
+            raise e
+        item = {'id': {'S': _id}, 'value': response['Attributes']['value']}
+        self.params_loader.set_item(_id, item)
+        return True, int(item['value']['N'])
+
+    def reserve_api_calls_month_current_up_to(self, api_calls_month_max_100, api_calls):
+        """
+        Reserves as many of api_calls (e.g. the records of a batch) as api_calls_month_max_100 allows:
+        all of them with a single atomic update_item if they fit, otherwise the remaining ones (computed from the item
+        returned by the failed update), retried only while concurrent invocations keep reserving in between.
+        Never more than api_calls_month_max_100, even on the first reservation of the month (no item yet).
+        :return: tuple (api_calls_reserved, api_calls_month_current), the latter after the reservation if any
+        """
+        api_calls_to_reserve = min(api_calls, api_calls_month_max_100)
+        api_calls_month_current = None
+        while api_calls_to_reserve > 0:
+            reserved, api_calls_month_current = self.reserve_api_calls_month_current(api_calls_month_max_100,
+                                                                                     api_calls_to_reserve)
+            if reserved:
+                return api_calls_to_reserve, api_calls_month_current
+            api_calls_to_reserve = min(api_calls_to_reserve - 1,
+                                       api_calls_month_max_100 - (api_calls_month_current or 0))
+        return 0, api_calls_month_current
+
     def get_api_calls_month_max_50(self):
         _id = ID_CALLS_MONTH_MAX_50
-        response = self.client.get_item(TableName=TABLE_NAME, Key={'id': {'S': _id}})
-        value = response['Item']['value']['N']
+        item = self.params_loader.get_item(_id, static=True)
+        value = item['value']['N']
         api_calls_max_50 = int(value)
         return api_calls_max_50
     
     def get_api_calls_month_max_100(self):
         _id = ID_CALLS_MONTH_MAX_100
-        response = self.client.get_item(TableName=TABLE_NAME, Key={'id': {'S': _id}})
-        value = response['Item']['value']['N']
+        item = self.params_loader.get_item(_id, static=True)
+        value = item['value']['N']
         api_calls_max_100 = int(value)
         return api_calls_max_100
 
     def get_api_calls_disable_until_alert_period(self):
         _id = ID_DISABLE_UNTIL_ALERT_PERIOD
-        response = self.client.get_item(TableName=TABLE_NAME, Key={'id': {'S': _id}})
-        value = response['Item']['value']['BOOL']
+        item = self.params_loader.get_item(_id, static=True)
+        value = item['value']['BOOL']
         api_calls_disable_until_alert_period = bool(value)
         return api_calls_disable_until_alert_period
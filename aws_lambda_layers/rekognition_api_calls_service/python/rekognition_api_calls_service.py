@@ -1,9 +1,9 @@
-import boto3
-
+from aws_clients import get_client
 from rekognition_api_calls_dao import RekognitionApiCallsDAO
 from alert_cams_img_service import AlertCamsImgService
+from alert_cams_img_dao import AlertCamsImgDAO
 
-from config import SNS_TOPIC_ARN_DEFAULT
+from rekognition_api_calls_config import SNS_TOPIC_ARN_DEFAULT
 
 import logging
 logger = logging.getLogger()
@@ -13,12 +13,15 @@ class RekognitionApiCallsService:
     """
     lambda layer dependencies:
         - alert_cams_img_service
+        - common
     """
     
-    def __init__(self, do_create_month_current_if_not_exists=True, sns_topic_arn=SNS_TOPIC_ARN_DEFAULT):
+    def __init__(self, do_create_month_current_if_not_exists=False, sns_topic_arn=SNS_TOPIC_ARN_DEFAULT):
         self.rek_api_calls_dao = RekognitionApiCallsDAO(do_create_month_current_if_not_exists)
-        self.alert_service = AlertCamsImgService()
-        self.client_sns = boto3.client('sns') if sns_topic_arn is not None else None
+        # both daos share the PARAMS loader, so all their items are read with a single request
+        self.params_loader = self.rek_api_calls_dao.params_loader
+        self.alert_service = AlertCamsImgService(self.params_loader)
+        self.client_sns = get_client('sns') if sns_topic_arn is not None else None
         self.sns_topic_arn = sns_topic_arn if sns_topic_arn is not None else None
         
     def create_api_calls_month_current_if_not_exists(self):
@@ -27,8 +30,14 @@ class RekognitionApiCallsService:
     def get_api_calls_month_current(self):
         return self.rek_api_calls_dao.get_api_calls_month_current()
         
-    def increment_api_calls_month_current(self, api_calls_month_current=None):
-        return self.rek_api_calls_dao.increment_api_calls_month_current(api_calls_month_current)
+    def increment_api_calls_month_current(self, api_calls=1):
+        return self.rek_api_calls_dao.increment_api_calls_month_current(api_calls)
+
+    def reserve_api_calls_month_current(self, api_calls_month_max_100, api_calls=1):
+        return self.rek_api_calls_dao.reserve_api_calls_month_current(api_calls_month_max_100, api_calls)
+
+    def reserve_api_calls_month_current_up_to(self, api_calls_month_max_100, api_calls):
+        return self.rek_api_calls_dao.reserve_api_calls_month_current_up_to(api_calls_month_max_100, api_calls)
     
     def get_api_calls_month_max_50(self):
         return self.rek_api_calls_dao.get_api_calls_month_max_50()
@@ -39,9 +48,38 @@ class RekognitionApiCallsService:
     def get_api_calls_disable_until_alert_period(self):
         return self.rek_api_calls_dao.get_api_calls_disable_until_alert_period()
 
+    def load_params(self, ids_static_extra=(), ids_fresh_extra=()):
+        """
+        Loads the PARAMS items of both daos, and the extra ones of other users of self.params_loader, in one request.
+        """
+        return self.rek_api_calls_dao.load_params(ids_static_extra=AlertCamsImgDAO.IDS_STATIC + list(ids_static_extra),
+                                                  ids_fresh_extra=AlertCamsImgDAO.IDS_FRESH + list(ids_fresh_extra))
+
     def validate_and_alert(self, return_metadata=False):
+        """
+        Validates a rekognition api call and, if validated, reserves it (the current month calls are incremented),
+        so there is no need to call increment_api_calls_month_current afterwards.
+        """
+        api_calls_reserved, metadata = self.validate_and_alert_batch(api_calls=1)
+        validate = api_calls_reserved > 0
+
+        if return_metadata:
+            return validate, metadata
+        else:
+            return validate
+
+    def validate_and_alert_batch(self, api_calls):
+        """
+        Validates api_calls rekognition api calls (e.g. one per record of a batch) and reserves as many of them as
+        the 100% threshold allows, at once (see reserve_api_calls_month_current_up_to).
+        :return: tuple (api_calls_reserved, (validate_cause, api_calls_month_current, api_calls_month_max_100))
+        """
+
+        # all the PARAMS items needed, with a single request (static ones cached)
+        self.load_params()
         
         # return_metadata
+        api_calls_reserved = 0
         validate_cause = None
         api_calls_month_current = None
         api_calls_month_max_100 = None
@@ -67,57 +105,52 @@ class RekognitionApiCallsService:
         # validate according to api calls thresholds
         if validate:
             
-            # get api_calls_month current and thresholds
-            api_calls_month_current = self.get_api_calls_month_current()
+            # get api_calls_month thresholds and reserve these api calls:
+            # atomic increment of api_calls_month current, only up to the 100% threshold
             api_calls_month_max_50 = self.get_api_calls_month_max_50()
             api_calls_month_max_100 = self.get_api_calls_month_max_100()
-            logger.info(f"api_calls_month_current: {api_calls_month_current}")
+            api_calls_reserved, api_calls_month_current = \
+                self.reserve_api_calls_month_current_up_to(api_calls_month_max_100, api_calls)
+            logger.info(f"api_calls_month_current: {api_calls_month_current}"
+                        f" (reserved: {api_calls_reserved} of {api_calls})")
             logger.info(f"api_calls_month_max_50: {api_calls_month_max_50}")
             logger.info(f"api_calls_month_max_100: {api_calls_month_max_100}")
         
             alert_subject = "AWS Rekognition API calls Threshold {}%"
             alert_message = "The AWS Rekognition API calls Threshold {}% ({} calls) has been reached."
-            
-            if api_calls_month_current + 1 < api_calls_month_max_50:
-                # do nothing, OK
-                validate = True
-                
-            elif api_calls_month_current + 1 == api_calls_month_max_50:
-                # alert threshold 50% reached
-                logger.info(f"rekognition api calls threshold 50% reached just now"
-                            f" ({api_calls_month_max_50})! alert!")
-                validate = True
-                if self.client_sns is not None and self.sns_topic_arn is not None:
-                    self.client_sns.publish(
-                        TopicArn=self.sns_topic_arn,
-                        Message=alert_message.format(50, api_calls_month_max_50),
-                        Subject=alert_subject.format(50))
-                    
-            elif api_calls_month_max_50 < api_calls_month_current + 1 < api_calls_month_max_100:
-                # do nothing, OK
-                logger.info(f"rekognition api calls threshold 50% exceeded ({api_calls_month_max_50})!")
-                validate = True
-                
-            elif api_calls_month_current + 1 == api_calls_month_max_100:
-                # alert threshold 100% reached
-                logger.info(f"rekognition api calls threshold 100% reached just now"
-                            f" ({api_calls_month_max_100})! alert!")
-                validate = True
-                if self.client_sns is not None and self.sns_topic_arn is not None:
-                    self.client_sns.publish(
-                        TopicArn=self.sns_topic_arn,
-                        Message=f"{alert_message.format(100, api_calls_month_max_100)}"
-                                f"\n\nNO MORE REKOGNITION API CALLS WILL BE ALLOWED DURING CURRENT BILLING PERIOD",
-                        Subject=alert_subject.format(100))
-                    
-            elif api_calls_month_max_100 < api_calls_month_current + 1:
+
+            # every api_calls_month_current value is returned by a single reservation,
+            # so each threshold notification is sent exactly once, even with concurrent invocations
+            if api_calls_reserved == 0:
                 # do NOT validate
-                validate = False
                 validate_cause = f"rekognition api calls threshold 100% exceeded ({api_calls_month_max_100})!" \
                                  f" NOT validating rekognition calls!"
                 logger.info(validate_cause)
-                
-        if return_metadata:
-            return validate, (validate_cause, api_calls_month_current, api_calls_month_max_100)
-        else:
-            return validate
+
+            else:
+                if api_calls_month_current - api_calls_reserved < api_calls_month_max_50 <= api_calls_month_current:
+                    # alert threshold 50% reached (by this reservation)
+                    logger.info(f"rekognition api calls threshold 50% reached just now"
+                                f" ({api_calls_month_max_50})! alert!")
+                    if self.client_sns is not None and self.sns_topic_arn is not None:
+                        self.client_sns.publish(
+                            TopicArn=self.sns_topic_arn,
+                            Message=alert_message.format(50, api_calls_month_max_50),
+                            Subject=alert_subject.format(50))
+
+                elif api_calls_month_max_50 < api_calls_month_current < api_calls_month_max_100:
+                    # do nothing, OK
+                    logger.info(f"rekognition api calls threshold 50% exceeded ({api_calls_month_max_50})!")
+
+                if api_calls_month_current == api_calls_month_max_100:
+                    # alert threshold 100% reached (by this reservation, the last calls allowed)
+                    logger.info(f"rekognition api calls threshold 100% reached just now"
+                                f" ({api_calls_month_max_100})! alert!")
+                    if self.client_sns is not None and self.sns_topic_arn is not None:
+                        self.client_sns.publish(
+                            TopicArn=self.sns_topic_arn,
+                            Message=f"{alert_message.format(100, api_calls_month_max_100)}"
+                                    f"\n\nNO MORE REKOGNITION API CALLS WILL BE ALLOWED DURING CURRENT BILLING PERIOD",
+                            Subject=alert_subject.format(100))
+
+        return api_calls_reserved, (validate_cause, api_calls_month_current, api_calls_month_max_100)
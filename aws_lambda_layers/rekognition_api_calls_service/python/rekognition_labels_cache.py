@@ -0,0 +1,95 @@
+import hashlib
+import json
+import time
+
+from aws_clients import get_client
+from params_loader import ParamsLoader
+from rekognition_api_calls_config import TABLE_NAME, ID_LABELS_CACHE_PREFIX, LABELS_CACHE_TTL_SECONDS
+
+import logging
+logger = logging.getLogger()
+
+
+class RekognitionLabelsCache:
+    """
+    Content-addressed cache of the rekognition detect_labels responses: the same image bytes (s3 object etag,
+    or sha-256 if the event has no etag) with the same MaxLabels and MinConfidence return the stored response,
+    without calling rekognition nor reserving an api call (e.g. CloudSync retries and re-syncs).
+
+    Entries are the PARAMS items '<ID_LABELS_CACHE_PREFIX><content hash>_<max labels>_<min confidence>', with the
+    expiration in the attribute 'ttl' (enable the dynamodb TTL on it to evict them, expired entries are ignored),
+    read as fresh items with the params loader shared with the other daos (a single batch_get_item), so they are not
+    kept in the static items cache of the warm invocations (it would grow with every snapshot of the container).
+
+    lambda layer dependencies:
+        - common
+    """
+
+    def __init__(self, max_labels, min_confidence, params_loader=None, ttl_seconds=LABELS_CACHE_TTL_SECONDS):
+        self.params_loader = params_loader if params_loader is not None \
+            else ParamsLoader(TABLE_NAME, get_client('dynamodb'))
+        self.max_labels = max_labels
+        self.min_confidence = min_confidence
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_content_hash(record, snapshot=None):
+        """
+        :return: etag of the s3 object of record, sha-256 of snapshot if there is no etag, None if neither
+        """
+        etag = record['s3']['object'].get('eTag')
+        if etag:
+            return etag.strip('"')
+        if snapshot is not None:
+            return hashlib.sha256(snapshot).hexdigest()
+        return None
+
+    def get_id(self, content_hash):
+        return f"{ID_LABELS_CACHE_PREFIX}{content_hash}_{self.max_labels}_{self.min_confidence}"
+
+    def get_params_ids(self, records, snapshots=None):
+        """
+        :return: ids of the entries of records, to be loaded (as fresh items) with the rest of params
+        """
+        snapshots = snapshots if snapshots is not None else [None] * len(records)
+        content_hashes = [RekognitionLabelsCache.get_content_hash(record, snapshot)
+                          for record, snapshot in zip(records, snapshots)]
+        return sorted({self.get_id(content_hash) for content_hash in content_hashes if content_hash is not None})
+
+    def get(self, records, snapshots=None):
+        """
+        :return: list of the detect_labels response cached of every record, None if not cached (or expired)
+        """
+        snapshots = snapshots if snapshots is not None else [None] * len(records)
+        self.params_loader.load(ids_fresh=self.get_params_ids(records, snapshots))  # no request if loaded
+
+        responses_labels = []
+        for record, snapshot in zip(records, snapshots):
+            content_hash = RekognitionLabelsCache.get_content_hash(record, snapshot)
+            item = self.params_loader.items.get(self.get_id(content_hash)) if content_hash is not None else None
+            if item is not None and int(item['ttl']['N']) > time.time():
+                responses_labels.append(json.loads(item['value']['S']))
+                self.hits += 1
+            else:
+                responses_labels.append(None)
+                self.misses += 1
+        return responses_labels
+
+    def put(self, record, response_labels, snapshot=None):
+        content_hash = RekognitionLabelsCache.get_content_hash(record, snapshot)
+        if content_hash is None:
+            return None
+        _id = self.get_id(content_hash)
+        value = {key: value for key, value in response_labels.items() if key != 'ResponseMetadata'}
+        item = {'id': {'S': _id}, 'value': {'S': json.dumps(value, separators=(',', ':'))},
+                'ttl': {'N': str(int(time.time()) + self.ttl_seconds)}}
+        response = self.params_loader.client.put_item(TableName=self.params_loader.table_name, Item=item)
+        self.params_loader.set_item(_id, item)
+        return response
+
+    def log_stats(self):
+        hit_ratio = self.hits / (self.hits + self.misses) if self.hits + self.misses > 0 else 0
+        logger.info(f"rekognition labels cache: {self.hits} hits, {self.misses} misses (hit ratio {hit_ratio:.0%})"
+                    f", {self.hits} rekognition api calls saved")
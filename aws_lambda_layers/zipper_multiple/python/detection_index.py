@@ -0,0 +1,245 @@
+from botocore.exceptions import ClientError
+from datetime import datetime as dt, timezone as tz
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from s3_prefetcher import S3Prefetcher, MAX_WORKERS_DEFAULT, MAX_BYTES_IN_FLIGHT_DEFAULT
+
+import logging
+logger = logging.getLogger()
+
+
+# config index
+INDEX_VERSION = 1
+INDEX_KEY = 'index/detections.sqlite'  # relative to main_dir, next to the json lines archives (jsonl/)
+JSONL_DIR = 'jsonl/'  # relative to main_dir, see jsonl_compactor
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'  # eventTime, without fraction nor zone (UTC)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS jsonl_files (key TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cameras (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS labels (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY, camera_id INTEGER NOT NULL, time INTEGER NOT NULL, filename TEXT NOT NULL,
+    UNIQUE (camera_id, filename));
+CREATE TABLE IF NOT EXISTS detections (
+    label_id INTEGER NOT NULL, camera_id INTEGER NOT NULL, time INTEGER NOT NULL, snapshot_id INTEGER NOT NULL,
+    confidence REAL NOT NULL, instances INTEGER NOT NULL,
+    PRIMARY KEY (label_id, camera_id, time, snapshot_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS detections_label_time ON detections (label_id, time);
+CREATE INDEX IF NOT EXISTS detections_camera_time ON detections (camera_id, time);
+"""
+
+
+def parse_event_time(event_time):
+    """
+    :return: eventTime (e.g. '2022-05-24T21:03:12.123Z') as seconds since epoch
+    """
+    return int(dt.strptime(event_time[:19], EVENT_TIME_FORMAT).replace(tzinfo=tz.utc).timestamp())
+
+
+def to_time(value):
+    # datetime (naive ones are UTC) or seconds since epoch
+    if isinstance(value, dt):
+        return int((value if value.tzinfo is not None else value.replace(tzinfo=tz.utc)).timestamp())
+    return int(value)
+
+
+def is_record(record):
+    # processed record of class_cam_img (full or compact schema, see processed_record)
+    return isinstance(record, dict) and 'Classification' in record
+
+
+class DetectionIndex:
+    """
+    SQLite index of the detections (labels) of the processed records of class_cam_img, per camera, time and label,
+    with their confidence and number of instances: history queries (e.g. the snapshots of a camera with a Person
+    in a month) are answered from the index, without listing nor downloading the records.
+
+    The index file is kept in processed_bucket, <main_dir>/index/detections.sqlite, and updated incrementally:
+    only the records (<main_dir>/*.json) listed after the last key indexed (watermark, stored in the index) and the
+    json lines files (<main_dir>/jsonl/*.jsonl.gz, see jsonl_compactor) not indexed yet (their keys are stored in the
+    index) are downloaded. The json lines files are all listed, since the part of a day compacted again
+    (<YYYY-MM-DD>.partNN.jsonl.gz) or a day compacted late sorts before the days compacted after it. The keys start
+    with the date of their snapshots, so the records uploaded late are indexed once their day is compacted, and every
+    detection is stored once (by snapshot and label), no matter how many times it is indexed.
+    A single update must run at a time (e.g. after the daily compaction, see zipper_multiple compact event).
+    """
+
+    def __init__(self, path=':memory:', bucket_name=None, main_dir=None, temp_dir=None):
+        self.path = path
+        self.bucket_name = bucket_name
+        self.main_dir = main_dir
+        self.temp_dir = temp_dir  # removed by close() (see load)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+        self._ids = {'cameras': {}, 'labels': {}}
+
+    @classmethod
+    def load(cls, s3_client, bucket_name, main_dir, path=None):
+        """
+        Downloads the index of main_dir (a new one if there is none yet) to path (if None, a file in a temporary
+        directory, removed by close(), so the warm invocations do not fill /tmp).
+        """
+        temp_dir = tempfile.mkdtemp() if path is None else None
+        path = path if path is not None else os.path.join(temp_dir, os.path.basename(INDEX_KEY))
+        key = f"{main_dir}/{INDEX_KEY}"
+        try:
+            with open(path, 'wb') as f:
+                s3_client.download_fileobj(Bucket=bucket_name, Key=key, Fileobj=f)
+            logger.info(f"detection index '{bucket_name}/{key}' downloaded ({os.path.getsize(path)} bytes)")
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                if temp_dir is not None:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                raise e
+            os.remove(path)  # ok, expected (first update), a new index
+            logger.info(f"detection index '{bucket_name}/{key}' NOT found, new index")
+        return cls(path, bucket_name, main_dir, temp_dir=temp_dir)
+
+    def save(self, s3_client):
+        self.connection.commit()
+        key = f"{self.main_dir}/{INDEX_KEY}"
+        with open(self.path, 'rb') as f:
+            s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=f)
+        logger.info(f"detection index '{self.bucket_name}/{key}' uploaded ({os.path.getsize(self.path)} bytes)")
+
+    def close(self):
+        self.connection.close()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def get_watermark(self, source):
+        row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (f"watermark_{source}",)).fetchone()
+        return row[0] if row is not None else ''
+
+    def set_watermark(self, source, key):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (f"watermark_{source}", key))
+
+    def list_keys(self, s3_client, prefix, suffix, start_after=''):
+        """
+        :return: list of tuples (key, size) of the keys after start_after, directly in prefix (no subfolders)
+                 and ending with suffix
+        """
+        key_size_list = []
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix, 'StartAfter': max(start_after, prefix)}
+        while True:
+            response = s3_client.list_objects_v2(**kwargs)
+            key_size_list.extend((content['Key'], content['Size']) for content in response.get('Contents', [])
+                                 if '/' not in content['Key'][len(prefix):] and content['Key'].endswith(suffix))
+            if not response.get('IsTruncated', False):
+                return key_size_list
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def list_jsonl_new(self, s3_client, prefix):
+        """
+        :return: list of tuples (key, size) of the json lines files of prefix not indexed yet, all of them listed
+                 (a single request per 1000 keys, a file per day compacted)
+        """
+        key_size_list = self.list_keys(s3_client, prefix, '.jsonl.gz')
+
+        # index of a previous version (jsonl watermark, no keys stored): the days up to the watermark were indexed,
+        # not necessarily their parts (indexed again, the detections are stored once)
+        watermark = self.get_watermark('jsonl')
+        if watermark != '':
+            self.connection.executemany("INSERT OR IGNORE INTO jsonl_files VALUES (?)",
+                                        [(key,) for key, _ in key_size_list
+                                         if key <= watermark and '.part' not in os.path.basename(key)])
+            self.connection.execute("DELETE FROM meta WHERE name = 'watermark_jsonl'")
+
+        keys_indexed = {row[0] for row in self.connection.execute("SELECT key FROM jsonl_files")}
+        return [(key, size) for key, size in key_size_list if key not in keys_indexed]
+
+    def update(self, s3_client, max_workers=MAX_WORKERS_DEFAULT, max_bytes_in_flight=MAX_BYTES_IN_FLIGHT_DEFAULT):
+        """
+        Indexes the records of main_dir after the watermark (moved forward) and its json lines files not indexed yet.
+        :return: dict summary of the update
+        """
+        summary = {'records': 0, 'jsonl_files': 0, 'detections': 0, 'skipped': 0}
+        prefetcher = S3Prefetcher(s3_client, self.bucket_name, max_workers=max_workers,
+                                  max_bytes_in_flight=max_bytes_in_flight)
+        for source, prefix, suffix in [('records', f"{self.main_dir}/", '.json'),
+                                       ('jsonl', f"{self.main_dir}/{JSONL_DIR}", '.jsonl.gz')]:
+            if source == 'records':
+                key_size_list = self.list_keys(s3_client, prefix, suffix, self.get_watermark(source))
+            else:
+                key_size_list = self.list_jsonl_new(s3_client, prefix)
+            for key, data in prefetcher.fetch(key_size_list):
+                if source == 'records':
+                    records = [json.loads(data)]
+                else:
+                    records = [json.loads(line) for line in gzip.decompress(data).splitlines() if len(line) > 0]
+                    summary['jsonl_files'] += 1
+                # other json files in main_dir (e.g. the manifest of a zip, <file_zip>.manifest.json) are skipped
+                records_valid = [record for record in records if is_record(record)]
+                if len(records_valid) < len(records):
+                    logger.warning(f"'{key}': {len(records) - len(records_valid)} json NOT processed records, skipped")
+                    summary['skipped'] += len(records) - len(records_valid)
+                summary['records'] += len(records_valid) if source == 'records' else 0
+                summary['detections'] += sum(self.add_record(record) for record in records_valid)
+                if source == 'jsonl':
+                    self.connection.execute("INSERT OR IGNORE INTO jsonl_files VALUES (?)", (key,))
+            if source == 'records' and len(key_size_list) > 0:
+                self.set_watermark(source, key_size_list[-1][0])
+            self.connection.commit()
+        logger.info(f"detection index updated: {summary}")
+        return summary
+
+    def get_id(self, table, name):
+        ids = self._ids[table]
+        if name not in ids:
+            self.connection.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+            ids[name] = self.connection.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()[0]
+        return ids[name]
+
+    def add_record(self, record):
+        """
+        :param record: processed record (full or compact schema, see processed_record)
+        :return: number of detections (labels) of record
+        """
+        classification = record['Classification']
+        key_src = classification['s3_object_key_src']
+        camera_id = self.get_id('cameras', f"{classification['s3_bucket_name_src']}/{os.path.dirname(key_src)}")
+        time = parse_event_time(classification['eventTime'])
+        filename = os.path.basename(key_src)
+        self.connection.execute("INSERT OR IGNORE INTO snapshots (camera_id, time, filename) VALUES (?, ?, ?)",
+                                (camera_id, time, filename))
+        snapshot_id, time = self.connection.execute(
+            "SELECT id, time FROM snapshots WHERE camera_id = ? AND filename = ?", (camera_id, filename)).fetchone()
+        labels = record.get('Labels', [])
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?)",
+            [(self.get_id('labels', label['Name']), camera_id, time, snapshot_id, round(label['Confidence'], 2),
+              len(label.get('Instances', []))) for label in labels])
+        return len(labels)
+
+    def query(self, label=None, camera=None, time_from=None, time_to=None, confidence_min=None, limit=None):
+        """
+        :param time_from: datetime (naive ones are UTC) or seconds since epoch, included (time_to excluded)
+        :return: list of dicts (camera, time, filename, label, confidence, instances), sorted by time
+        """
+        conditions, params = [], []
+        for column, value in [('l.name = ?', label), ('c.name = ?', camera), ('d.confidence >= ?', confidence_min)]:
+            if value is not None:
+                conditions.append(column)
+                params.append(value)
+        for column, value in [('d.time >= ?', time_from), ('d.time < ?', time_to)]:
+            if value is not None:
+                conditions.append(column)
+                params.append(to_time(value))
+        sql = "SELECT c.name, d.time, s.filename, l.name, d.confidence, d.instances FROM detections d" \
+              " JOIN labels l ON l.id = d.label_id JOIN cameras c ON c.id = d.camera_id" \
+              " JOIN snapshots s ON s.id = d.snapshot_id" \
+              + (" WHERE " + " AND ".join(conditions) if len(conditions) > 0 else "") \
+              + " ORDER BY d.time, c.name, l.name" + (" LIMIT ?" if limit is not None else "")
+        params += [limit] if limit is not None else []
+        return [{'camera': row[0], 'time': dt.fromtimestamp(row[1], tz.utc).strftime(EVENT_TIME_FORMAT) + 'Z',
+                 'filename': row[2], 'label': row[3], 'confidence': row[4], 'instances': row[5]}
+                for row in self.connection.execute(sql, params)]
@@ -0,0 +1,101 @@
+from datetime import datetime as dt, timedelta as td
+import gzip
+import json
+import os
+
+from aws_clients import get_client
+from s3_multipart_writer import S3MultipartWriter
+from s3_prefetcher import S3Prefetcher
+from zipper_multiple import ZipperMultiple
+
+import logging
+logger = logging.getLogger()
+
+
+# config compaction
+COMPRESS_LEVEL_DEFAULT = 6  # gzip, json lines compress well at any level
+
+
+def dumps_line_default(data):
+    # the json as is, without whitespace
+    return json.dumps(json.loads(data), separators=(',', ':'))
+
+
+class JsonlCompactor(ZipperMultiple):
+    """
+    ZipperMultiple that rolls the matched json files (e.g. a day of processed records of class_cam_img)
+    into a single gzip compressed json lines file (file_zip, e.g. <YYYY-MM-DD>.jsonl.gz) instead of a zip:
+    one line per file, in the listing order, built by dumps_line (e.g. processed_record compact_record).
+    The listing, the concurrent downloads, the streamed multipart upload and the deletion of the files
+    are the ones of ZipperMultiple (single file_zip, no shards nor sidecar index).
+    A rerun for a day already compacted (e.g. records uploaded late) writes a part of its own,
+    <name>.partNN.<ext> (e.g. <YYYY-MM-DD>.part01.jsonl.gz), so it never overwrites the json lines of the files
+    deleted by the previous runs.
+    """
+
+    def __init__(self, bucket_name_with_tags, prefix_with_tags, filename_regex_with_tags, file_zip_with_tags,
+                 dumps_line=dumps_line_default, compress_level=COMPRESS_LEVEL_DEFAULT, **kwargs):
+        super().__init__(bucket_name_with_tags, prefix_with_tags, filename_regex_with_tags, file_zip_with_tags,
+                         compress_level=compress_level, shard_size_max=None, **kwargs)
+        self.dumps_line = dumps_line
+
+    def zip_shard(self, s3_client, file_zip, file_key_size_list):
+        """
+        Builds the json lines file file_zip with the files of file_key_size_list, gzip compressed and streamed
+        to s3 (multipart upload) while the lines are being written. The upload is aborted if anything fails
+        (e.g. a file that is not a valid json), so the files are not deleted.
+        """
+        prefetcher = S3Prefetcher(s3_client, self.bucket_name,
+                                  max_workers=self.max_workers, max_bytes_in_flight=self.max_bytes_in_flight)
+        stream = S3MultipartWriter(s3_client, self.bucket_name, file_zip, part_size=self.part_size)
+        bytes_in = 0
+        try:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=stream, compresslevel=self.compress_level) as gz:
+                for file_key, data in prefetcher.fetch(file_key_size_list):
+                    bytes_in += len(data)
+                    gz.write(self.dumps_line(data).encode('utf-8'))
+                    gz.write(b'\n')
+
+            # upload jsonl (complete the multipart upload)
+            stream.close()
+            logger.info(f"uploaded file_zip '{file_zip}' ({len(file_key_size_list)} files, {bytes_in} bytes"
+                        f" compacted into {stream.tell()} bytes) to bucket '{self.bucket_name}'")
+
+        except Exception:
+            stream.abort()
+            logger.error(f"file_zip '{file_zip}' NOT uploaded, multipart upload aborted")
+            raise
+
+    def get_part_file_zip(self, part_index):
+        # the part before the extensions (all of them, e.g. .jsonl.gz), so the parts keep them and sort after file_zip
+        file_zip_dir, file_zip_name = os.path.split(self.file_zip)
+        name, _, ext = file_zip_name.partition('.')
+        return os.path.join(file_zip_dir, f"{name}.part{part_index:02d}.{ext}")
+
+    def get_file_zip_free(self, s3_client):
+        """
+        Lists the keys of file_zip and its parts (a single request per 1000 keys).
+        :return: file_zip if it does not exist yet, otherwise its first part that does not exist
+        """
+        file_zip_dir, file_zip_name = os.path.split(self.file_zip)
+        prefix = os.path.join(file_zip_dir, f"{file_zip_name.partition('.')[0]}.")
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        key_set = set()
+        while True:
+            response = s3_client.list_objects_v2(**kwargs)
+            key_set.update(content['Key'] for content in response.get('Contents', []))
+            if not response.get('IsTruncated', False):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+        file_zip, part_index = self.file_zip, 1
+        while file_zip in key_set:
+            file_zip, part_index = self.get_part_file_zip(part_index), part_index + 1
+        return file_zip
+
+    def compact_files_day_ago(self, day_ago=1, delete_files=False):
+        dt_day_previous = dt.now() - td(days=day_ago)
+
+        self.replace_tags(dt_day_previous)
+        self.file_zip = self.get_file_zip_free(get_client('s3'))
+        return self.zip_files(delete_files)
@@ -0,0 +1,110 @@
+import io
+
+import logging
+logger = logging.getLogger()
+
+
+# config multipart upload
+MiB = 1024 * 1024
+PART_SIZE_MIN = 5 * MiB  # S3 minimum size for every part but the last one
+PART_SIZE_DEFAULT = 8 * MiB
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Write-only, non-seekable file object that streams its content to an S3 object using a multipart upload.
+
+    Data is buffered until a full part (part_size bytes) is available and then sent with upload_part,
+    so the memory used is bounded by part_size and not by the total size of the object.
+    The multipart upload is created lazily with the first part, close() uploads the last part and completes it,
+    and abort() (also called when an exception is raised inside a with block) discards it.
+
+    It can be passed to zipfile.ZipFile(..., mode='w'), which handles non-seekable streams using data descriptors.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, part_size=PART_SIZE_DEFAULT):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = None
+        self.parts = []
+        self.position = 0
+        self.completed = False
+        self.aborted = False
+        self._buffer = bytearray()
+        if part_size < PART_SIZE_MIN:
+            raise ValueError(f"part_size ({part_size}) must be at least {PART_SIZE_MIN} bytes")
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        self._buffer += b
+        self.position += len(b)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self.aborted:
+                self._complete()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            super().close()
+
+    def abort(self):
+        if self.completed or self.aborted:
+            return
+        self.aborted = True
+        self._buffer = bytearray()
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            logger.warning(f"multipart upload aborted for '{self.bucket_name}/{self.key}' ({len(self.parts)} parts)")
+        super().close()
+
+    def __del__(self):
+        # never complete a partially written object when the writer is garbage collected without close()
+        self.abort()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=bytes(data))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        logger.debug("uploaded part #%s (%s bytes) of '%s/%s'", part_number, len(data), self.bucket_name, self.key)
+
+    def _complete(self):
+        # the last part may be smaller than PART_SIZE_MIN, and it is also sent for empty objects (1 part required)
+        if len(self._buffer) > 0 or len(self.parts) == 0:
+            self._upload_part(self._buffer)
+            self._buffer = bytearray()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        self.completed = True
+        logger.info(f"multipart upload completed for '{self.bucket_name}/{self.key}'"
+                    f" ({len(self.parts)} parts, {self.position} bytes)")
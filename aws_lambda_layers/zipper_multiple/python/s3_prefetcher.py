@@ -0,0 +1,62 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger()
+
+
+# config prefetch
+MiB = 1024 * 1024
+MAX_WORKERS_DEFAULT = 16
+MAX_BYTES_IN_FLIGHT_DEFAULT = 64 * MiB
+
+
+class S3Prefetcher:
+    """
+    Downloads S3 objects concurrently with a thread pool and yields their content in the same order they were given.
+
+    The objects being downloaded, or downloaded but not consumed yet, never add up to more than max_bytes_in_flight
+    (according to the sizes from the s3 listing), except for a single object bigger than the limit,
+    which is downloaded alone. This way the memory used is bounded no matter how many objects there are.
+    """
+
+    def __init__(self, s3_client, bucket_name, max_workers=MAX_WORKERS_DEFAULT,
+                 max_bytes_in_flight=MAX_BYTES_IN_FLIGHT_DEFAULT):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.max_bytes_in_flight = max_bytes_in_flight
+
+    def fetch(self, key_size_list):
+        """
+        :param key_size_list: list of tuples (key, size), size as reported by the s3 listing
+        :return: generator of tuples (key, data_bytes), in the same order as key_size_list
+        """
+        pending = deque()
+        bytes_in_flight = 0
+        i_next = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while i_next < len(key_size_list) or len(pending) > 0:
+
+                    # submit as many downloads as the bytes in flight limit allows
+                    while i_next < len(key_size_list) and \
+                            (len(pending) == 0 or
+                             bytes_in_flight + key_size_list[i_next][1] <= self.max_bytes_in_flight):
+                        key, size = key_size_list[i_next]
+                        pending.append((key, size, executor.submit(self._get_object_bytes, key)))
+                        bytes_in_flight += size
+                        i_next += 1
+
+                    # consume the oldest download (deterministic order)
+                    key, size, future = pending.popleft()
+                    yield key, future.result()
+                    # released once the consumer is done with the data
+                    bytes_in_flight -= size
+            finally:
+                # generator closed early or download failed: do not wait for nor keep the remaining downloads
+                for _, _, future in pending:
+                    future.cancel()
+
+    def _get_object_bytes(self, key):
+        return self.s3_client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
@@ -0,0 +1,149 @@
+from datetime import datetime as dt
+import gzip
+import json
+import struct
+import zipfile
+import zlib
+
+import logging
+logger = logging.getLogger()
+
+
+# config index
+INDEX_VERSION = 1
+INDEX_KEY_SUFFIX = '.index.json.gz'
+
+# config reader
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_HEADER_EXTRA_MARGIN = 64  # bytes fetched for the local header extra field, refetched if it is bigger
+RANGE_SIZE_MAX = 64 * 1024 * 1024  # max bytes of a ranged GET covering several consecutive entries
+FILENAME_DT_FORMAT = '%Y-%m-%d-%H-%M-%S'  # snapshot filenames start with their date, e.g. 2022-05-24-21-03-12-...
+FILENAME_DT_LEN = 19
+
+
+def get_index_key(file_zip):
+    return f"{file_zip}{INDEX_KEY_SUFFIX}"
+
+
+def build_index_entry(zinfo):
+    """
+    :return: compact index entry of a zip entry: [local header offset, compress size, file size, compress type, crc]
+    """
+    return [zinfo.header_offset, zinfo.compress_size, zinfo.file_size, zinfo.compress_type, zinfo.CRC]
+
+
+def save_index(s3_client, bucket_name, file_zip, index_entries):
+    """
+    Uploads the sidecar index (gzip json) of file_zip, index_entries is a dict {filename: index entry}.
+    """
+    index = {'version': INDEX_VERSION, 'file_zip': file_zip, 'entries': index_entries}
+    body = gzip.compress(json.dumps(index, separators=(',', ':')).encode('utf-8'))
+    s3_client.put_object(Bucket=bucket_name, Key=get_index_key(file_zip), Body=body, ContentType='application/gzip')
+    logger.info(f"uploaded index '{get_index_key(file_zip)}' ({len(index_entries)} entries, {len(body)} bytes)")
+
+
+class ZipArchiveReader:
+    """
+    Reads single files, or a time range of files, from a zip archive in s3 (built by ZipperMultiple)
+    with HTTP Range requests, using its sidecar index, so the whole archive is never downloaded.
+    """
+
+    def __init__(self, s3_client, bucket_name, file_zip):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.file_zip = file_zip
+        self.index_entries = None
+
+    def load_index(self):
+        if self.index_entries is None:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=get_index_key(self.file_zip))
+            index = json.loads(gzip.decompress(response['Body'].read()).decode('utf-8'))
+            self.index_entries = index['entries']
+        return self.index_entries
+
+    def list_files(self):
+        index_entries = self.load_index()
+        return sorted(index_entries, key=lambda filename: index_entries[filename][0])
+
+    def get_file(self, filename):
+        """
+        :return: bytes of the file filename, fetched with a single ranged GET (usually)
+        """
+        index_entry = self.load_index()[filename]
+        offset, compress_size = index_entry[0], index_entry[1]
+        range_end = offset + LOCAL_HEADER_SIZE + len(filename.encode('utf-8')) + LOCAL_HEADER_EXTRA_MARGIN \
+            + compress_size
+        buffer = self._get_range(offset, range_end)
+        data = self._extract_file(buffer, offset, filename, index_entry)
+        if data is None:
+            # local header extra field bigger than the margin, fetch the exact range
+            name_len, extra_len = struct.unpack('<HH', buffer[26:30])
+            buffer = self._get_range(offset, offset + LOCAL_HEADER_SIZE + name_len + extra_len + compress_size)
+            data = self._extract_file(buffer, offset, filename, index_entry)
+        return data
+
+    def get_files_between(self, dt_from, dt_to):
+        """
+        Files whose filename date is in [dt_from, dt_to], consecutive entries are fetched with a single ranged GET
+        (up to RANGE_SIZE_MAX bytes each).
+        :return: generator of tuples (filename, bytes), in the archive order
+        """
+        filename_list = [filename for filename in self.list_files()
+                         if dt_from <= ZipArchiveReader.get_filename_dt(filename, dt.max) <= dt_to]
+        i = 0
+        while i < len(filename_list):
+
+            # coalesce the following entries into a single range
+            j = i
+            range_start = self.index_entries[filename_list[i]][0]
+            range_end = self._get_entry_range_end(filename_list[i])
+            while j + 1 < len(filename_list) and self._get_entry_range_end(filename_list[j + 1]) - range_start \
+                    <= RANGE_SIZE_MAX:
+                j += 1
+                range_end = self._get_entry_range_end(filename_list[j])
+
+            buffer = self._get_range(range_start, range_end)
+            for filename in filename_list[i:j + 1]:
+                data = self._extract_file(buffer, range_start, filename, self.index_entries[filename])
+                yield filename, data if data is not None else self.get_file(filename)
+            i = j + 1
+
+    @staticmethod
+    def get_filename_dt(filename, dt_default=None):
+        try:
+            return dt.strptime(filename[:FILENAME_DT_LEN], FILENAME_DT_FORMAT)
+        except ValueError:
+            return dt_default
+
+    def _get_entry_range_end(self, filename):
+        offset, compress_size = self.index_entries[filename][0], self.index_entries[filename][1]
+        return offset + LOCAL_HEADER_SIZE + len(filename.encode('utf-8')) + LOCAL_HEADER_EXTRA_MARGIN + compress_size
+
+    def _get_range(self, range_start, range_end):
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.file_zip,
+                                             Range=f"bytes={range_start}-{range_end - 1}")
+        return response['Body'].read()
+
+    @staticmethod
+    def _extract_file(buffer, buffer_offset, filename, index_entry):
+        """
+        :return: bytes of the file (decompressed and crc checked), None if buffer does not contain all its data
+        :raise zipfile.BadZipFile: bad header, size or crc, or compress type not supported (neither stored nor deflated)
+        """
+        offset, compress_size, file_size, compress_type, crc = index_entry
+        i = offset - buffer_offset
+        if buffer[i:i + 4] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"bad local file header of '{filename}' in '{buffer_offset + i}'")
+        name_len, extra_len = struct.unpack('<HH', buffer[i + 26:i + 30])
+        data_start = i + LOCAL_HEADER_SIZE + name_len + extra_len
+        if data_start + compress_size > len(buffer):
+            return None
+        data = buffer[data_start:data_start + compress_size]
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        elif compress_type != zipfile.ZIP_STORED:
+            raise zipfile.BadZipFile(f"compress type {compress_type} of '{filename}' NOT supported")
+        if len(data) != file_size or zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile(f"bad size or crc of '{filename}'")
+        return data
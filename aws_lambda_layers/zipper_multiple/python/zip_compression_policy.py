@@ -0,0 +1,116 @@
+import os
+import time
+import zipfile
+import zlib
+
+import logging
+logger = logging.getLogger()
+
+
+# config compression policies
+COMPRESSION_POLICY_DEFLATED = 'deflated'  # always ZIP_DEFLATED (previous behaviour)
+COMPRESSION_POLICY_STORED = 'stored'  # always ZIP_STORED
+COMPRESSION_POLICY_DETECT = 'detect'  # ZIP_STORED for already compressed formats (extension or magic bytes)
+COMPRESSION_POLICY_TRIAL = 'trial'  # ZIP_STORED if a trial compression of a sample barely shrinks it
+COMPRESSION_POLICY_LIST = [COMPRESSION_POLICY_DEFLATED, COMPRESSION_POLICY_STORED,
+                           COMPRESSION_POLICY_DETECT, COMPRESSION_POLICY_TRIAL]
+COMPRESSION_POLICY_DEFAULT = COMPRESSION_POLICY_DETECT
+COMPRESS_LEVEL_DEFAULT = None  # zlib default (6), from 0 (none) to 9 (best)
+
+# config detect policy
+STORED_EXTENSION_SET = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.mkv', '.zip', '.gz', '.bz2', '.xz'}
+STORED_MAGIC_BYTES_LIST = [
+    b'\xff\xd8\xff',  # jpeg
+    b'\x89PNG\r\n\x1a\n',  # png
+    b'GIF8',  # gif
+    b'PK\x03\x04',  # zip
+    b'\x1f\x8b',  # gzip
+    b'BZh',  # bzip2
+    b'\xfd7zXZ\x00',  # xz
+]
+
+# config trial policy
+TRIAL_SAMPLE_SIZE = 16 * 1024
+TRIAL_COMPRESS_LEVEL = 1
+TRIAL_RATIO_MAX = 0.95  # compressed / original size of the sample, above it the entry is stored
+
+
+class ZipCompressionPolicy:
+    """
+    Chooses the compression (ZIP_STORED or ZIP_DEFLATED) of every zip entry and keeps statistics of the result:
+    entries, bytes in, bytes out and cpu time (of the writing thread) per compress type.
+    """
+
+    COMPRESS_TYPE_NAMES = {zipfile.ZIP_STORED: 'stored', zipfile.ZIP_DEFLATED: 'deflated'}
+
+    def __init__(self, policy=COMPRESSION_POLICY_DEFAULT, compress_level=COMPRESS_LEVEL_DEFAULT):
+        if policy not in COMPRESSION_POLICY_LIST:
+            raise ValueError(f"compression policy '{policy}' NOT valid, valid values: {COMPRESSION_POLICY_LIST}")
+        self.policy = policy
+        self.compress_level = compress_level
+        self.stats = {compress_type: {'entries': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0}
+                      for compress_type in ZipCompressionPolicy.COMPRESS_TYPE_NAMES}
+
+    def get_compress_type(self, filename, data):
+        if self.policy == COMPRESSION_POLICY_DEFLATED:
+            return zipfile.ZIP_DEFLATED
+        elif self.policy == COMPRESSION_POLICY_STORED:
+            return zipfile.ZIP_STORED
+        elif self.policy == COMPRESSION_POLICY_DETECT:
+            return zipfile.ZIP_STORED if self._is_compressed_format(filename, data) else zipfile.ZIP_DEFLATED
+        else:
+            return zipfile.ZIP_STORED if self._is_trial_incompressible(data) else zipfile.ZIP_DEFLATED
+
+    def writestr(self, zip_archive, filename, data):
+        """
+        Writes data as the entry filename of zip_archive, with the compression chosen by the policy.
+        :return: zipfile.ZipInfo of the entry written
+        """
+        t_cpu_start = time.thread_time()
+        compress_type = self.get_compress_type(filename, data)
+        zip_archive.writestr(filename, data, compress_type=compress_type, compresslevel=self.compress_level)
+        zinfo = zip_archive.getinfo(filename)
+        stats = self.stats[compress_type]
+        stats['entries'] += 1
+        stats['bytes_in'] += zinfo.file_size
+        stats['bytes_out'] += zinfo.compress_size
+        stats['cpu_seconds'] += time.thread_time() - t_cpu_start
+        return zinfo
+
+    def get_stats_summary(self):
+        bytes_in = sum(stats['bytes_in'] for stats in self.stats.values())
+        bytes_out = sum(stats['bytes_out'] for stats in self.stats.values())
+        return {
+            'policy': self.policy,
+            'compress_level': self.compress_level,
+            'entries': sum(stats['entries'] for stats in self.stats.values()),
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'bytes_saved': bytes_in - bytes_out,
+            'cpu_seconds': round(sum(stats['cpu_seconds'] for stats in self.stats.values()), 6),
+            'by_compress_type': {ZipCompressionPolicy.COMPRESS_TYPE_NAMES[compress_type]: stats
+                                 for compress_type, stats in self.stats.items()},
+        }
+
+    def log_stats(self):
+        summary = self.get_stats_summary()
+        logger.info(f"compression policy '{summary['policy']}' (level {summary['compress_level']})"
+                    f": {summary['entries']} entries, {summary['bytes_in']} bytes in, {summary['bytes_out']} bytes out"
+                    f", {summary['bytes_saved']} bytes saved, {summary['cpu_seconds']} s cpu")
+        for compress_type_name, stats in summary['by_compress_type'].items():
+            logger.info(f"  - {compress_type_name}: {stats['entries']} entries, {stats['bytes_in']} bytes in"
+                        f", {stats['bytes_out']} bytes out, {stats['cpu_seconds']:.6f} s cpu")
+
+    @staticmethod
+    def _is_compressed_format(filename, data):
+        if os.path.splitext(filename)[1].lower() in STORED_EXTENSION_SET:
+            return True
+        return any(data.startswith(magic_bytes) for magic_bytes in STORED_MAGIC_BYTES_LIST)
+
+    @staticmethod
+    def _is_trial_incompressible(data):
+        sample = data[:TRIAL_SAMPLE_SIZE]
+        if len(sample) == 0:
+            return False
+        ratio = len(zlib.compress(sample, TRIAL_COMPRESS_LEVEL)) / len(sample)
+        return ratio > TRIAL_RATIO_MAX
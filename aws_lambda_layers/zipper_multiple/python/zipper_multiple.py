@@ -1,15 +1,24 @@
-import boto3
+from botocore.exceptions import ClientError
 from datetime import datetime as dt
-from dateutil.relativedelta import relativedelta as rd
-from io import BytesIO
+import json
 import os
 import re
 import zipfile
 
+from aws_clients import get_client, get_resource
+from s3_multipart_writer import S3MultipartWriter, PART_SIZE_DEFAULT
+from s3_prefetcher import S3Prefetcher, MAX_WORKERS_DEFAULT, MAX_BYTES_IN_FLIGHT_DEFAULT
+from zip_archive_index import build_index_entry, save_index
+from zip_compression_policy import ZipCompressionPolicy, COMPRESSION_POLICY_DEFAULT, COMPRESS_LEVEL_DEFAULT
+
 import logging
 logger = logging.getLogger()
 
 
+# config delete
+DELETE_BATCH_SIZE = 1000  # s3 delete_objects max keys per request
+
+
 class ZipperMultiple:
 
     TAG_YEAR = '__ZIPPER-MULTIPLE_YEAR__'
@@ -19,7 +28,10 @@ class ZipperMultiple:
     TAG_MINUTE = '__ZIPPER-MULTIPLE_MINUTE__'
     TAG_SECOND = '__ZIPPER-MULTIPLE_SECOND__'
 
-    def __init__(self, bucket_name_with_tags, prefix_with_tags, filename_regex_with_tags, file_zip_with_tags):
+    def __init__(self, bucket_name_with_tags, prefix_with_tags, filename_regex_with_tags, file_zip_with_tags,
+                 part_size=PART_SIZE_DEFAULT, max_workers=MAX_WORKERS_DEFAULT,
+                 max_bytes_in_flight=MAX_BYTES_IN_FLIGHT_DEFAULT, compression_policy=COMPRESSION_POLICY_DEFAULT,
+                 compress_level=COMPRESS_LEVEL_DEFAULT, shard_size_max=None):
         # with tags
         self.bucket_name_with_tags = bucket_name_with_tags
         self.prefix_with_tags = prefix_with_tags
@@ -32,6 +44,16 @@ class ZipperMultiple:
         self.file_zip = file_zip_with_tags
         # tags_replaced
         self.tags_replaced = False
+        # multipart upload part size (bytes), it bounds the memory used to build the zip
+        self.part_size = part_size
+        # concurrent downloads of the files to zip, bounded by the bytes held in memory
+        self.max_workers = max_workers
+        self.max_bytes_in_flight = max_bytes_in_flight
+        # per entry compression (see zip_compression_policy)
+        self.compression_policy = compression_policy
+        self.compress_level = compress_level
+        # max size (bytes, from the listing) of every zip shard, None for a single zip without manifest
+        self.shard_size_max = shard_size_max
 
     def replace_tags(self, dt_tags):
         # restore tags
@@ -70,57 +92,229 @@ class ZipperMultiple:
             logger.warning(
                 f"self.tags_replaced: '{self.tags_replaced}', you may call replace_tags before zipping files")
 
-        s3 = boto3.resource('s3')
+        # shared client (thread safe), the resource (only used to list) is a per thread one
+        s3_client = get_client('s3')
+        file_key_size_match_list = self.list_files(get_resource('s3'))
+        file_key_match_list = [file_key for file_key, _ in file_key_size_match_list]
+
+        logger.info(f"files to zip (#)   : {len(file_key_match_list)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("files to zip (list): %s", ', '.join(os.path.basename(fk) for fk in file_key_match_list))
+
+        summary = {
+            'bucket_name': self.bucket_name,
+            'file_zip': self.file_zip,
+            'files_matched': len(file_key_match_list),
+            'files_deleted': 0,
+            'file_zip_uploaded_list': [],
+        }
+
+        if len(file_key_match_list) == 0:
+            logger.info("file_zip NOT uploaded")
+            logger.info("files NOT deleted")
+
+        # single zip
+        elif self.shard_size_max is None:
+            self.zip_shard(s3_client, self.file_zip, file_key_size_match_list)
+            summary['file_zip_uploaded_list'].append(self.file_zip)
+
+            # delete_files (the matched keys come from the single listing above, no need to list the bucket again)
+            if delete_files:
+                delete_errors = self.delete_files(s3_client, set(file_key_match_list))
+                summary['files_deleted'] = len(file_key_match_list) - len(delete_errors)
+                logger.warning(f"files deleted ({summary['files_deleted']} of {len(file_key_match_list)})")
+            else:
+                logger.info("files NOT deleted")
+
+        # zip shards, resumable with the manifest
+        else:
+            summary['file_zip_uploaded_list'], summary['files_deleted'] = \
+                self.zip_shards(s3_client, file_key_size_match_list, delete_files)
+
+        logger.info(f"ZipperMultiple.zip_files, done!")
+        return summary
+
+    def list_files(self, s3):
+        """
+        Lists the bucket once, filtering by prefix and filename_regex.
+        :return: list of tuples (key, size) of the matched files, in the listing order
+        """
         bucket = s3.Bucket(self.bucket_name)
         files_collection = bucket.objects.filter(Prefix=self.prefix).all()
+        filename_pattern = None if self.filename_regex is None else re.compile(self.filename_regex)
+        file_key_size_match_list = [
+            (file.key, file.size) for file in files_collection
+            if filename_pattern is None or filename_pattern.match(os.path.basename(file.key))]
+        return file_key_size_match_list
 
-        # build zip
+    def zip_shard(self, s3_client, file_zip, file_key_size_list):
+        """
+        Builds the zip file_zip with the files of file_key_size_list, streamed to s3 (multipart upload)
+        while the entries are being written. The upload is aborted if anything fails.
+        Once uploaded, its sidecar index (see zip_archive_index) is uploaded too, to read single files with ranged GETs.
+        """
 
-        file_key_match_list = []
-        stream = BytesIO()
-        filename_pattern = None if self.filename_regex is None else re.compile(self.filename_regex)
-        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_archive:
+        # the files are downloaded concurrently (prefetch) but written to the zip in the listing order
+        prefetcher = S3Prefetcher(s3_client, self.bucket_name,
+                                  max_workers=self.max_workers, max_bytes_in_flight=self.max_bytes_in_flight)
+        compression = ZipCompressionPolicy(self.compression_policy, self.compress_level)
+        stream = S3MultipartWriter(s3_client, self.bucket_name, file_zip, part_size=self.part_size)
+        index_entries = {}
+        try:
+            with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_archive:
 
-            for file in files_collection:
-                filename = os.path.basename(file.key)
-                if filename_pattern is None or filename_pattern.match(filename):
-                    file_key_match_list.append(file.key)
-                    with zip_archive.open(filename, 'w') as f:
-                        f.write(file.get()['Body'].read())
+                for file_key, data in prefetcher.fetch(file_key_size_list):
+                    zinfo = compression.writestr(zip_archive, os.path.basename(file_key), data)
+                    index_entries[zinfo.filename] = build_index_entry(zinfo)
 
-        stream.seek(0)
+            compression.log_stats()
 
-        logger.info(f"files to zip (#)   : {len(file_key_match_list)}")
-        logger.info(f"files to zip (list): {', '.join([os.path.basename(fk) for fk in file_key_match_list])}")
+            # upload zip (complete the multipart upload)
+            stream.close()
+            logger.info(f"uploaded file_zip '{file_zip}' ({len(file_key_size_list)} files)"
+                        f" to bucket '{self.bucket_name}'")
 
-        # upload zip
-        if len(file_key_match_list) > 0:
-            s3.Object(self.bucket_name, self.file_zip).upload_fileobj(stream)
-            logger.info(f"uploaded file_zip '{self.file_zip}' to bucket '{self.bucket_name}'")
-        else:
-            logger.info("file_zip NOT uploaded")
+        except Exception:
+            stream.abort()
+            logger.error(f"file_zip '{file_zip}' NOT uploaded, multipart upload aborted")
+            raise
 
-        stream.close()
+        save_index(s3_client, self.bucket_name, file_zip, index_entries)
 
-        # delete_files
-        if len(file_key_match_list) > 0 and delete_files:
-            for file in files_collection:
-                if file.key in file_key_match_list:
-                    file.delete()
-            logger.warning("files deleted")
-        else:
-            logger.info("files NOT deleted")
+    def zip_shards(self, s3_client, file_key_size_match_list, delete_files=False):
+        """
+        Splits the files into shards of up to shard_size_max bytes (sizes from the listing, nothing is downloaded)
+        and zips every shard into its own file_zip (<file_zip>.partNN.zip).
 
-        logger.info(f"ZipperMultiple.zip_files, done!")
+        The plan and the completed shards are recorded in the manifest (<file_zip>.manifest.json), so a rerun
+        keeps the same shards and skips the completed ones. The files of a shard are deleted only after
+        its zip has been uploaded and recorded as completed in the manifest. A shard none of whose files is listed
+        anymore is completed without any zip uploaded.
+        :return: tuple (list of file_zip uploaded in this run, number of files deleted in this run)
+        """
+
+        # plan: shards from the manifest (previous runs), plus new shards for the files not planned yet
+        manifest = self.load_manifest(s3_client)
+        if manifest is None:
+            manifest = {'file_zip': self.file_zip, 'shard_size_max': self.shard_size_max, 'shards': []}
+        file_key_planned_set = {file_key for shard in manifest['shards'] for file_key in shard['keys']}
+        file_key_size_unplanned_list = [(file_key, size) for file_key, size in file_key_size_match_list
+                                        if file_key not in file_key_planned_set]
+        if len(file_key_size_unplanned_list) > 0:
+            for file_key_size_list in ZipperMultiple.plan_shards(file_key_size_unplanned_list, self.shard_size_max):
+                manifest['shards'].append({
+                    'file_zip': self.get_shard_file_zip(len(manifest['shards'])),
+                    'size': sum(size for _, size in file_key_size_list),
+                    'keys': [file_key for file_key, _ in file_key_size_list],
+                    'completed': False,
+                    'deleted': False,
+                })
+            self.save_manifest(s3_client, manifest)
+        logger.info(f"shards planned: {len(manifest['shards'])}"
+                    f" ({len(file_key_size_unplanned_list)} files planned in this run)")
+
+        # zip shards
+        file_zip_uploaded_list = []
+        files_deleted = 0
+        file_key_size_match_dict = dict(file_key_size_match_list)
+        for shard in manifest['shards']:
+
+            if shard['completed']:
+                logger.info(f"shard '{shard['file_zip']}' already completed, skipped")
+            else:
+                file_key_size_list = [(file_key, file_key_size_match_dict[file_key]) for file_key in shard['keys']
+                                      if file_key in file_key_size_match_dict]
+                if len(file_key_size_list) > 0:
+                    self.zip_shard(s3_client, shard['file_zip'], file_key_size_list)
+                    file_zip_uploaded_list.append(shard['file_zip'])
+                else:
+                    # none of its files listed anymore (e.g. deleted by hand): no empty zip uploaded, the shard is
+                    # kept in the manifest (flagged empty) so its part number is not reused
+                    logger.warning(f"shard '{shard['file_zip']}' NOT zipped, none of its files listed anymore")
+                    shard['empty'] = True
+                shard['completed'] = True
+                self.save_manifest(s3_client, manifest)
+
+            # delete_files, only once the shard is completed
+            if delete_files and not shard['deleted']:
+                file_key_set = {file_key for file_key in shard['keys'] if file_key in file_key_size_match_dict}
+                delete_errors = self.delete_files(s3_client, file_key_set)
+                files_deleted += len(file_key_set) - len(delete_errors)
+                logger.warning(f"files of shard '{shard['file_zip']}' deleted"
+                               f" ({len(file_key_set) - len(delete_errors)} of {len(file_key_set)})")
+                if len(delete_errors) == 0:
+                    shard['deleted'] = True
+                    self.save_manifest(s3_client, manifest)
+
+        return file_zip_uploaded_list, files_deleted
+
+    @staticmethod
+    def plan_shards(file_key_size_list, shard_size_max):
+        """
+        Splits file_key_size_list, keeping its order, into lists whose total size is up to shard_size_max bytes
+        (a file bigger than shard_size_max makes a shard by itself).
+        :return: list of lists of tuples (key, size)
+        """
+        shards = []
+        shard = []
+        shard_size = 0
+        for file_key, size in file_key_size_list:
+            if len(shard) > 0 and shard_size + size > shard_size_max:
+                shards.append(shard)
+                shard = []
+                shard_size = 0
+            shard.append((file_key, size))
+            shard_size += size
+        if len(shard) > 0:
+            shards.append(shard)
+        return shards
+
+    def get_shard_file_zip(self, shard_index):
+        file_zip_root, file_zip_ext = os.path.splitext(self.file_zip)
+        return f"{file_zip_root}.part{shard_index:02d}{file_zip_ext}"
+
+    def get_manifest_key(self):
+        return f"{os.path.splitext(self.file_zip)[0]}.manifest.json"
+
+    def load_manifest(self, s3_client):
+        try:
+            response = s3_client.get_object(Bucket=self.bucket_name, Key=self.get_manifest_key())
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None  # ok, expected (first run)
+            raise e
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def save_manifest(self, s3_client, manifest):
+        s3_client.put_object(Bucket=self.bucket_name, Key=self.get_manifest_key(),
+                             Body=json.dumps(manifest).encode('utf-8'), ContentType='application/json')
+
+    def delete_files(self, s3_client, file_key_set):
+        """
+        Deletes the files with batched delete_objects calls (up to DELETE_BATCH_SIZE keys each).
+        :return: list of per-key errors, dicts with keys 'Key', 'Code' and 'Message' (empty list if all deleted)
+        """
+        delete_errors = []
+        file_key_list = sorted(file_key_set)
+        for i in range(0, len(file_key_list), DELETE_BATCH_SIZE):
+            response = s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': file_key} for file_key in file_key_list[i:i + DELETE_BATCH_SIZE]],
+                        'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.error(f"file '{error['Key']}' NOT deleted: {error['Code']} ({error['Message']})")
+                delete_errors.append(error)
+        return delete_errors
 
     def zip_files_month_ago(self, month_ago=1, delete_files=False):
+        # lazy import, only needed for the relative months
+        from dateutil.relativedelta import relativedelta as rd
 
         dt_now = dt.now()
         dt_month_previous = dt_now - rd(months=month_ago)
 
         self.replace_tags(dt_month_previous)
-        self.zip_files(delete_files)
+        return self.zip_files(delete_files)
 
     def zip_files_months_ago(self, months_ago, delete_files=False):
-        for month_ago in months_ago:
-            self.zip_files_month_ago(month_ago, delete_files)
+        return [self.zip_files_month_ago(month_ago, delete_files) for month_ago in months_ago]
@@ -0,0 +1,121 @@
+"""
+Alert email attachment of alert_cams_img (see alert_cams_img_email): peak memory (tracemalloc) and build time of the
+raw SES message (download of the snapshot, attachment and serialization), per snapshot size, for the previous pipeline
+(download_fileobj into a stream copied with getvalue, MIMEApplication, as_string) and the current one (a single read,
+the attachment base64 encoded a chunk at a time into the raw message), without and with a byte budget (the snapshot
+downscaled and re-encoded to fit it).
+
+usage:
+    python benchmarks/bench_attachment.py [--resolutions 1280x720,1920x1080,3840x2160] [--bytes-max 1048576] [--runs 5]
+
+The snapshots are synthetic noisy jpeg images (quality 95, hard to compress, so the worst case). Pillow and NumPy are
+required.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import local_aws  # noqa: E402
+
+BUCKET = 'bucket-input'
+KEY = 'main_dir_example_00/2022-05-24-21-03-12-cam.jpg'
+
+
+def build_snapshot(width, height):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    background = np.kron(rng.integers(0, 256, size=(height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8),
+                         np.ones((8, 8, 1), dtype=np.uint8))[:height, :width]
+    noise = rng.integers(-24, 25, size=(height, width, 3))
+    stream = io.BytesIO()
+    Image.fromarray(np.clip(background + noise, 0, 255).astype(np.uint8)).save(stream, format='JPEG', quality=95)
+    return stream.getvalue()
+
+
+def build_raw_msg_previous(email, class_dict, labels_alert_found):
+    """
+    Previous pipeline: download_fileobj into a stream copied with getvalue, the whole message serialized as str
+    (the text parts are left out, they are small).
+    """
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    data_stream = io.BytesIO()
+    email.get_client('s3').download_fileobj(class_dict['s3_bucket_name_src'], class_dict['s3_object_key_src'],
+                                            data_stream)
+    data_stream.seek(0)
+    data_bytes = data_stream.getvalue()
+    msg = MIMEMultipart('mixed')
+    msg.attach(MIMEText(f"label alerts found: {labels_alert_found}", 'plain', 'utf-8'))
+    att = MIMEApplication(data_bytes)
+    att.add_header('Content-Disposition', 'attachment', filename=os.path.basename(class_dict['s3_object_key_src']))
+    msg.attach(att)
+    return msg.as_string()
+
+
+def build_raw_msg_current(email, class_dict, labels_alert_found, bytes_max=None):
+    return email.build_ses_msg(class_dict, labels_alert_found, bytes_max=bytes_max)
+
+
+def measure(build, runs):
+    """
+    :return: tuple (median build ms, peak memory bytes, raw message bytes)
+    """
+    latencies = []
+    for _ in range(runs):
+        t_start = time.perf_counter()
+        build()
+        latencies.append(time.perf_counter() - t_start)
+
+    tracemalloc.start()
+    raw_msg = build()
+    raw_msg_size = len(raw_msg)
+    del raw_msg
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(latencies) * 1000, peak, raw_msg_size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions', default='1280x720,1920x1080,2560x1440,3840x2160')
+    parser.add_argument('--bytes-max', type=int, default=1024 * 1024)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    local_aws.load_lambda('alert_cams_img')
+    email = sys.modules['alert_cams_img_email']
+    aws = local_aws.LocalAWS()
+    aws.install()
+    class_dict = {'s3_bucket_name_src': BUCKET, 's3_object_key_src': KEY, 'eventTime': '2022-05-24T21:03:12.000Z'}
+    labels_alert_found = ['Person']
+
+    pipelines = [
+        ('previous', lambda: build_raw_msg_previous(email, class_dict, labels_alert_found)),
+        ('current', lambda: build_raw_msg_current(email, class_dict, labels_alert_found)),
+        (f"current, {args.bytes_max} B max",
+         lambda: build_raw_msg_current(email, class_dict, labels_alert_found, args.bytes_max)),
+    ]
+    print(f"{'resolution':>10} {'snapshot B':>11} {'pipeline':>26} {'build ms':>9} {'peak MB':>8} {'peak/snapshot':>14}"
+          f" {'message B':>10}")
+    for resolution in args.resolutions.split(','):
+        width, height = (int(x) for x in resolution.split('x'))
+        snapshot = build_snapshot(width, height)
+        aws.s3.objects[(BUCKET, KEY)] = snapshot
+        for name, build in pipelines:
+            latency_ms, peak, raw_msg_size = measure(build, args.runs)
+            print(f"{resolution:>10} {len(snapshot):>11} {name:>26} {latency_ms:>9.1f} {peak / 2 ** 20:>8.1f}"
+                  f" {peak / len(snapshot):>14.2f} {raw_msg_size:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Cold start of the lambda functions (class_cam_img, alert_cams_img, zipper_multiple): import time of lambda_function
+(with its layers), latency of the first and the warm invocations, heavy modules loaded, and a per-package import time
+breakdown (python -X importtime), for an early exit and a full scenario of every function.
+With --check, exits with status 1 if an early exit scenario exceeds its bounds (EARLY_EXIT_BOUNDS).
+
+Every measure runs in a fresh python process, with the AWS services replaced by the local stand-ins of local_aws,
+so the boto3 session and clients creation are not included (they are shared across warm invocations, see aws_clients).
+
+usage:
+    python benchmarks/bench_cold_start.py [--runs 5] [--warm 20] [--top 10] [--check]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules deferred to the code paths that need them
+HEAVY_MODULE_LIST = ['boto3', 'botocore', 'email.mime.multipart', 'dateutil', 'zipfile', 'concurrent.futures', 'numpy',
+                     'PIL']
+
+# scenarios of every function: early exit and full
+SCENARIO_LIST = [
+    ('class_cam_img', 'budget_exceeded'),
+    ('class_cam_img', 'classify'),
+    ('alert_cams_img', 'period_not_elapsed'),
+    ('alert_cams_img', 'alert'),
+    ('zipper_multiple', 'event_not_valid'),
+    ('zipper_multiple', 'zip'),
+]
+
+# bounds of the early exit scenarios (--check): heavy modules allowed to be loaded by the first invocation (none on
+# import), and max ms of the import and the first invocation (median), loose enough for a loaded machine
+EARLY_EXIT_BOUNDS = {
+    ('class_cam_img', 'budget_exceeded'): (['botocore'], 150),
+    ('alert_cams_img', 'period_not_elapsed'): ([], 100),
+    ('zipper_multiple', 'event_not_valid'): ([], 60),
+}
+
+# written to stderr by the child process before loading the function, the benchmark imports are not measured
+IMPORTTIME_MARKER = 'bench_cold_start: load_lambda'
+
+BUCKET = 'bucket-input'
+MAIN_DIR = 'main_dir_example_00'
+
+
+# ------------------------------------------------------------------------------
+# child process: a single cold start
+# ------------------------------------------------------------------------------
+
+def build_scenario(aws, function_name, scenario):
+    """
+    Seeds the local services for scenario.
+    :return: event
+    """
+    from datetime import datetime as dt, timedelta as td
+
+    rekognition_config = sys.modules.get('rekognition_api_calls_config')  # layer config (None for zipper_multiple)
+    date_suffix = dt.now().strftime(getattr(rekognition_config, 'DATE_SUFFIX_FORMAT', '_%Y_%m'))
+    alert_last = dt.now() if scenario == 'period_not_elapsed' else dt.now() - td(days=1)
+    aws.dynamodb.put_params('PARAMS', {
+        'alert_cams_img_period': {'N': '3600'},
+        'alert_cams_img_last': {'S': alert_last.strftime('%Y-%m-%d %H:%M:%S')},
+        f"alert_cams_img_last_{BUCKET}/{MAIN_DIR}": {'S': alert_last.strftime('%Y-%m-%d %H:%M:%S')},
+        'class_cam_img_disable_until_alert_period': {'BOOL': False},
+        'rekognition_api_calls_month_max_50': {'N': '500'},
+        'rekognition_api_calls_month_max_100': {'N': '1000'},
+        f"rekognition_api_calls{date_suffix}": {'N': '1000' if scenario == 'budget_exceeded' else '10'},
+    })
+    aws.rekognition.default_labels = [{'Name': 'Person', 'Confidence': 99.0, 'Instances': [{}], 'Parents': []}]
+
+    key = f"{MAIN_DIR}/{dt.now().strftime('%Y-%m-%d-%H-%M-%S')}-cam.jpg"
+    aws.s3.put_bytes(BUCKET, key, os.urandom(200 * 1024))
+    event = {'Records': [{'eventTime': f"{dt.utcnow().isoformat()}Z",
+                          's3': {'bucket': {'name': BUCKET}, 'object': {'key': key}}}]}
+
+    if function_name == 'alert_cams_img':
+        class_dict = {'s3_bucket_name_src': BUCKET, 's3_object_key_src': key, 's3_bucket_name_dst': BUCKET,
+                      's3_object_key_dst': f"{key}.json", 'eventTime': event['Records'][0]['eventTime'],
+                      'labels': ['Person']}
+        output_dict = {'Labels': aws.rekognition.default_labels, 'Classification': class_dict}
+        aws.s3.put_bytes(BUCKET, f"{key}.json", json.dumps(output_dict).encode('utf-8'))
+        event = {'Records': [{'s3': {'bucket': {'name': BUCKET}, 'object': {'key': f"{key}.json"}}}]}
+
+    elif function_name == 'zipper_multiple':
+        custom_event = sys.modules['config'].VALID_CUSTOM_EVENT_LIST[0]
+        dt_month_previous = dt.now().replace(day=1) - td(days=1)
+        for i in range(20):
+            filename = f"{dt_month_previous.strftime('%Y-%m')}-01-00-00-{i:02d}-cam.jpg"
+            aws.s3.put_bytes(custom_event['bucket_name'], f"{custom_event['main_dir']}/{filename}",
+                             os.urandom(200 * 1024))
+        event = {'custom_event': custom_event if scenario == 'zip' else {'bucket_name': 'bucket_not_valid'}}
+
+    return event
+
+
+def run_child(function_name, scenario, warm):
+    import local_aws
+    sys.stderr.write(f"{IMPORTTIME_MARKER}\n")
+    sys.stderr.flush()
+    t_start = time.perf_counter()
+    lambda_function = local_aws.load_lambda(function_name)
+    t_import = time.perf_counter() - t_start
+    modules_loaded_import = [module for module in HEAVY_MODULE_LIST if module in sys.modules]
+
+    aws = local_aws.LocalAWS()
+    region_names = (None, getattr(sys.modules.get('alert_cams_img_config'), 'AWS_SES_REGION', None))
+    aws.install(region_names)
+
+    def invoke():
+        event = build_scenario(aws, function_name, scenario)
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                t_invoke = time.perf_counter()
+                response = lambda_function.lambda_handler(event, local_aws.LocalContext())
+                return time.perf_counter() - t_invoke, response
+            finally:
+                sys.stdout = stdout
+
+    t_first, response = invoke()
+    modules_loaded_first = [module for module in HEAVY_MODULE_LIST if module in sys.modules]
+    t_warm_list = [invoke()[0] for _ in range(warm)]
+
+    return {
+        'import_ms': t_import * 1000,
+        'first_ms': t_first * 1000,
+        'warm_ms': statistics.median(t_warm_list) * 1000 if t_warm_list else None,
+        'status_code': response['statusCode'],
+        'modules_loaded_import': modules_loaded_import,
+        'modules_loaded_first': modules_loaded_first,
+    }
+
+
+# ------------------------------------------------------------------------------
+# parent process
+# ------------------------------------------------------------------------------
+
+def run_cold_start(function_name, scenario, warm, importtime=False):
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) \
+        + [os.path.abspath(__file__), '--child', function_name, scenario, '--warm', str(warm)]
+    process = subprocess.run(cmd, cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def parse_importtime(stderr):
+    """
+    :return: dict {top level package: import microseconds}, sum of the self times of all its modules imported
+             by the function (load and invocations)
+    """
+    packages = {}
+    for line in stderr.split(IMPORTTIME_MARKER)[-1].splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        us_self, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(us_self)
+    return packages
+
+
+def check_bounds(function_name, scenario, results):
+    """
+    :return: list of the bounds of EARLY_EXIT_BOUNDS exceeded by the results of scenario (empty if none)
+    """
+    if (function_name, scenario) not in EARLY_EXIT_BOUNDS:
+        return []
+    modules_allowed, ms_max = EARLY_EXIT_BOUNDS[(function_name, scenario)]
+    modules_import = [module for module in HEAVY_MODULE_LIST
+                      if any(module in result['modules_loaded_import'] for result in results)]
+    modules_first = [module for module in HEAVY_MODULE_LIST if module not in modules_allowed + modules_import
+                     and any(module in result['modules_loaded_first'] for result in results)]
+    exceeded = [f"{module} loaded on import" for module in modules_import]\
+        + [f"{module} loaded by the first invocation" for module in modules_first]
+    ms = statistics.median(r['import_ms'] + r['first_ms'] for r in results)
+    if ms > ms_max:
+        exceeded.append(f"{ms:.1f} ms > {ms_max} ms")
+    return [f"{function_name} {scenario}: {bound}" for bound in exceeded]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help="cold starts per scenario")
+    parser.add_argument('--warm', type=int, default=20, help="warm invocations per cold start")
+    parser.add_argument('--top', type=int, default=10, help="packages of the import time breakdown")
+    parser.add_argument('--check', action='store_true', help="exit 1 if an early exit scenario exceeds its bounds")
+    parser.add_argument('--child', nargs=2, metavar=('FUNCTION', 'SCENARIO'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        sys.path.insert(0, BENCHMARKS_DIR)
+        print(json.dumps(run_child(*args.child, args.warm)))
+        return
+
+    print(f"{'function':<16} {'scenario':<20} {'status':>6} {'import ms':>10} {'first ms':>10} {'warm ms':>9}"
+          f"  heavy modules loaded (import / first invocation)")
+    bounds_exceeded = []
+    for function_name, scenario in SCENARIO_LIST:
+        results = [run_cold_start(function_name, scenario, args.warm)[0] for _ in range(args.runs)]
+        bounds_exceeded += check_bounds(function_name, scenario, results)
+        print(f"{function_name:<16} {scenario:<20} {results[0]['status_code']:>6}"
+              f" {statistics.median(r['import_ms'] for r in results):>10.1f}"
+              f" {statistics.median(r['first_ms'] for r in results):>10.1f}"
+              f" {statistics.median(r['warm_ms'] for r in results):>9.2f}"
+              f"  {','.join(results[0]['modules_loaded_import']) or '-'}"
+              f" / {','.join(results[0]['modules_loaded_first']) or '-'}")
+
+    print(f"\nimport time breakdown (ms per top level package, early exit scenario of every function)")
+    for function_name in dict(SCENARIO_LIST):
+        scenario = dict(SCENARIO_LIST[::-1])[function_name]
+        packages = parse_importtime(run_cold_start(function_name, scenario, 0, importtime=True)[1])
+        packages_top = sorted(packages.items(), key=lambda package: -package[1])[:args.top]
+        print(f"{function_name} ({scenario}): "
+              + ', '.join(f"{package} {us / 1000:.1f}" for package, us in packages_top))
+
+    if args.check:
+        print(f"\nearly exit bounds exceeded: {len(bounds_exceeded)}")
+        for bound in bounds_exceeded:
+            print(f"    {bound}")
+        if len(bounds_exceeded) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
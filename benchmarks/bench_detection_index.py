@@ -0,0 +1,137 @@
+"""
+Detection index of the processed records of class_cam_img (see detection_index): time and S3 requests of its first
+build and of an incremental update (zipper_multiple index event), and latency of history queries on the index
+vs a scan of the records (listing and downloading every record and json lines file).
+
+The records are built and saved by class_cam_img, the past days compacted by zipper_multiple (compact event),
+with the AWS services replaced by the local stand-ins of local_aws (no latency, the S3 requests are counted).
+
+usage:
+    python benchmarks/bench_detection_index.py [--days 30] [--snapshots 500] [--cameras 3] [--queries 200]
+"""
+import argparse
+import contextlib
+from datetime import datetime as dt, timedelta as td
+import gzip
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+import local_aws
+from bench_processed_records import build_s3_record, build_response_labels
+
+
+def save_records(aws, dt_day, snapshots, cameras, labels=8):
+    class_cam_img = local_aws.load_lambda('class_cam_img')
+    aws.install()
+    for i in range(snapshots):
+        dt_snapshot = dt_day + td(seconds=i * 86400 // snapshots)
+        camera = f"cam{i % cameras}"
+        key = f"{camera}/{dt_snapshot.strftime('%Y-%m-%d-%H-%M-%S')}-{camera}.jpg"
+        event_time = f"{dt_snapshot.isoformat()}Z"
+        event = {'Records': [build_s3_record('bucket-input', key, event_time, 200 * 1024)]}
+        class_cam_img.save_json_dict(
+            class_cam_img.get_json_data(event, build_response_labels(labels), 'bucket-input', key, event_time))
+
+
+def invoke_zipper_multiple(aws, event_name, day_ago=1, index_update=True):
+    """
+    :return: tuple (response, ms) of the compact or index event (event_name) of the first target of
+             VALID_COMPACT_EVENT_LIST
+    """
+    zipper_multiple = local_aws.load_lambda('zipper_multiple')
+    aws.install()
+    zipper_multiple.COMPACT_INDEX_UPDATE = index_update
+    event = {event_name: {**sys.modules['config'].VALID_COMPACT_EVENT_LIST[0], 'day_ago': day_ago}}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        t_start = time.perf_counter()
+        response = zipper_multiple.lambda_handler(event, local_aws.LocalContext())
+        return response, (time.perf_counter() - t_start) * 1000
+
+
+def scan(aws, bucket, main_dir, label, camera, t_from, t_to):
+    """
+    :return: detections of label in camera between t_from and t_to, from every record and json lines file
+    """
+    s3 = aws.s3
+    detections = []
+    keys = [content['Key'] for content in s3.list_objects_v2(Bucket=bucket, Prefix=f"{main_dir}/",
+                                                              MaxKeys=10 ** 9)['Contents']]
+    for key in keys:
+        data = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        if key.endswith('.jsonl.gz'):
+            records = [json.loads(line) for line in gzip.decompress(data).splitlines()]
+        elif key.endswith('.json'):
+            records = [json.loads(data)]
+        else:
+            continue
+        for record in records:
+            classification = record['Classification']
+            if not classification['s3_object_key_src'].startswith(f"{camera.split('/', 1)[1]}/") \
+                    or not t_from <= classification['eventTime'] < t_to:
+                continue
+            detections += [(classification['s3_object_key_src'], item['Confidence']) for item in record['Labels']
+                           if item['Name'] == label]
+    return detections
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=30, help="days of records (the past ones compacted)")
+    parser.add_argument('--snapshots', type=int, default=500, help="snapshots per day")
+    parser.add_argument('--cameras', type=int, default=3)
+    parser.add_argument('--queries', type=int, default=200, help="queries on the index (median latency)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    aws = local_aws.LocalAWS()
+    dt_today = dt.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for day_ago in range(args.days - 1, 0, -1):
+        save_records(aws, dt_today - td(days=day_ago), args.snapshots, args.cameras)
+        invoke_zipper_multiple(aws, 'compact_event', day_ago, index_update=False)
+    save_records(aws, dt_today, args.snapshots // 2, args.cameras)
+
+    print(f"{'index update':<34} {'ms':>9} {'S3 GetObject':>13} {'S3 list':>8}  summary")
+    for name, new_records in [('first build', 0), ('incremental (new records)', args.snapshots // 10),
+                              ('incremental (nothing new)', 0)]:
+        if new_records > 0:
+            save_records(aws, dt_today + td(days=1), new_records, args.cameras)
+        aws.reset_calls()
+        response, t_update = invoke_zipper_multiple(aws, 'index_event')
+        calls = aws.get_calls()
+        print(f"{name:<34} {t_update:>9.1f} {calls.get('s3.GetObject', 0):>13} {calls.get('s3.ListObjectsV2', 0):>8}"
+              f"  {json.loads(response['body'])['index']}")
+
+    from detection_index import DetectionIndex
+    logging.disable(logging.INFO)  # the logger of the lambda functions writes to their (closed) stdout
+    target = sys.modules['config'].VALID_COMPACT_EVENT_LIST[0]
+    bucket, main_dir = target['bucket_name'], target['main_dir']
+    index = DetectionIndex.load(aws.s3, bucket, main_dir)
+    print(f"\nindex: {os.path.getsize(index.path)} bytes,"
+          f" {index.connection.execute('SELECT COUNT(*) FROM detections').fetchone()[0]} detections")
+
+    camera, label = 'bucket-input/cam0', 'Person'
+    dt_from, dt_to = dt_today - td(days=7), dt_today
+    t_query_list = []
+    for _ in range(args.queries):
+        t_start = time.perf_counter()
+        detections = index.query(label=label, camera=camera, time_from=dt_from, time_to=dt_to)
+        t_query_list.append((time.perf_counter() - t_start) * 1000)
+    aws.reset_calls()
+    t_start = time.perf_counter()
+    detections_scan = scan(aws, bucket, main_dir, label, camera, f"{dt_from.isoformat()}Z", f"{dt_to.isoformat()}Z")
+    t_scan = (time.perf_counter() - t_start) * 1000
+
+    print(f"\nquery: '{label}' in '{camera}', last 7 days")
+    print(f"{'index':<8} {statistics.median(t_query_list):>9.2f} ms  {len(detections)} detections, no S3 requests")
+    print(f"{'scan':<8} {t_scan:>9.2f} ms  {len(detections_scan)} detections,"
+          f" {aws.get_calls().get('s3.GetObject', 0)} S3 GetObject")
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
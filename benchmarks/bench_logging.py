@@ -0,0 +1,108 @@
+"""
+Overhead of logger_builder: build_logger per invocation (handler rebuilt every time, as before, vs cached across warm
+invocations) and cost per record of the text, json, sampled and queue modes, and of a disabled level.
+
+The records are written to os.devnull, so the cost of the stdout of the lambda runtime is not included.
+
+usage:
+    python benchmarks/bench_logging.py [--invocations 10000] [--records 20000]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+import uuid
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'aws_lambda_layers', 'logger_builder', 'python'))
+
+import logger_builder  # noqa: E402
+
+# labels of a detect_labels response, logged per snapshot (see class_cam_img print_labels_data)
+LABELS = [{'Name': f"Label{i}", 'Confidence': 90.0 + i, 'Instances': [{}] * (i % 3)} for i in range(10)]
+
+
+def build_logger_previous(log_level=logging.INFO, request_id=None):
+    # handler and formatter rebuilt on every invocation
+    logger = logging.getLogger()
+    logger.handlers = []
+    stdout_formatter = logging.Formatter(fmt=logger_builder.LOGGER_FORMAT.replace('%(request_id)s', request_id))
+    stdout_handler = logging.StreamHandler(stream=sys.stdout)
+    stdout_handler.setLevel(log_level)
+    stdout_handler.setFormatter(stdout_formatter)
+    logger.addHandler(stdout_handler)
+    logger.setLevel(log_level)
+    logging.getLogger("boto3").setLevel(logging.WARNING)
+    logging.getLogger("botocore").setLevel(logging.WARNING)
+    return logger
+
+
+def bench_build(build, invocations):
+    t_start = time.perf_counter()
+    for _ in range(invocations):
+        build(log_level=logging.INFO, request_id=uuid.uuid4().hex)
+    return (time.perf_counter() - t_start) / invocations * 1e6
+
+
+def log_labels_eager(logger):
+    labels_str = ', '.join("'{}' ({:.2f}%, #{})".format(label['Name'], label['Confidence'], len(label['Instances']))
+                           for label in LABELS)
+    logger.debug(f"Detected labels for 'bucket/key': {labels_str}")
+
+
+def log_labels(logger, level=logging.INFO):
+    if not logger.isEnabledFor(level):
+        return
+    labels_str = ', '.join("'{}' ({:.2f}%, #{})".format(label['Name'], label['Confidence'], len(label['Instances']))
+                           for label in LABELS)
+    logger.log(level, "Detected labels for '%s/%s': %s", 'bucket', 'key', labels_str,
+               extra={'data': {'labels': [label['Name'] for label in LABELS]}})
+
+
+def bench_records(log, records):
+    # time of the caller (in queue mode, the records are written meanwhile by the listener thread)
+    t_start = time.perf_counter()
+    for _ in range(records):
+        log()
+    t_records = time.perf_counter() - t_start
+    logger_builder.flush_logger()
+    return t_records / records * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invocations', type=int, default=10000)
+    parser.add_argument('--records', type=int, default=20000)
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            results_build = [(name, bench_build(build, args.invocations)) for name, build in [
+                ('rebuilt (previous)', build_logger_previous), ('cached', logger_builder.build_logger)]]
+
+            results_records = []
+            for name, kwargs, log in [
+                    ('disabled level, eager f-string', {}, log_labels_eager),
+                    ('disabled level, lazy', {}, lambda logger: log_labels(logger, logging.DEBUG)),
+                    ('text', {}, log_labels),
+                    ('json', {'log_format': 'json'}, log_labels),
+                    ('json, sampled 10%', {'log_format': 'json', 'sampling': {'bench_logging': 0.1}}, log_labels),
+                    ('json, queue', {'log_format': 'json', 'queue': True}, log_labels)]:
+                logger = logger_builder.build_logger(log_level=logging.INFO, request_id='bench', **kwargs)
+                results_records.append((name, bench_records(lambda: log(logger), args.records)))
+            logger_builder.build_logger(log_level=logging.INFO, request_id='bench')
+        finally:
+            sys.stdout = stdout
+
+    print(f"{'build_logger per invocation':<34} {'us':>8}")
+    for name, us in results_build:
+        print(f"{name:<34} {us:>8.2f}")
+    print(f"\n{'per record (labels of a snapshot)':<34} {'us':>8}")
+    for name, us in results_records:
+        print(f"{name:<34} {us:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+AWS calls and stages instrumentation (aws_metrics): overhead per AWS call of the botocore event hooks (a botocore
+s3 client with a Stubber, no network, with and without the hooks), and the metrics record (CloudWatch EMF) of an
+invocation of every function, with the AWS services replaced by the local stand-ins of local_aws (fake latencies).
+
+With --check, only checks the metrics record written by the hooks of real botocore clients, and exits with status 1
+if any check fails: its EMF structure and metrics limit, its stages, and the calls, errors and bytes sent per operation
+(a Stubber), and the retries and bytes received (a local HTTP endpoint failing the first request, the Stubber
+responses never reach the retry handler).
+
+usage:
+    python benchmarks/bench_metrics.py [--calls 2000] [--latency-ms 20] [--check]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import local_aws
+from bench_cold_start import build_scenario
+
+EMF_METRICS_MAX = 100  # metrics per EMF record, CloudWatch limit
+
+# scenarios of bench_cold_start with the full pipeline of every function
+SCENARIO_LIST = [('class_cam_img', 'classify'), ('alert_cams_img', 'alert'), ('zipper_multiple', 'zip')]
+
+
+def bench_hooks(calls, hooks):
+    """
+    :return: us per put_object call of a stubbed botocore s3 client, with or without the hooks of aws_metrics
+    """
+    import boto3.session
+    from botocore.stub import Stubber
+    import aws_metrics
+
+    session = boto3.session.Session(aws_access_key_id='bench', aws_secret_access_key='bench', region_name='eu-west-1')
+    if hooks:
+        aws_metrics.register_hooks(session.events)
+    s3 = session.client('s3')
+    body = os.urandom(1024)
+    with Stubber(s3) as stubber:
+        for _ in range(calls):
+            stubber.add_response('put_object', {'ETag': '"bench"'})
+        aws_metrics.reset_metrics()
+        t_start = time.perf_counter()
+        for i in range(calls):
+            s3.put_object(Bucket='bucket', Key=f"key{i}", Body=body)
+        t_calls = time.perf_counter() - t_start
+    return t_calls / calls * 1e6, aws_metrics.get_metrics().calls.get('s3.PutObject', {}).get('calls', 0)
+
+
+def build_session():
+    import boto3.session
+    import aws_metrics
+
+    session = boto3.session.Session(aws_access_key_id='bench', aws_secret_access_key='bench', region_name='eu-west-1')
+    aws_metrics.register_hooks(session.events)
+    return session
+
+
+def emit_record(function_name):
+    """
+    :return: dict metrics record of the calls made since the last aws_metrics.reset_metrics(), parsed from stdout
+    """
+    import aws_metrics
+
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        aws_metrics.emit_metrics(function_name, 'check')
+        lines = sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = stdout
+    assert len(lines) == 1, f"a single line expected, {len(lines)} written"
+    return json.loads(lines[0])
+
+
+class FailFirstHandler(BaseHTTPRequestHandler):
+    """
+    S3-like endpoint: PUT fails with a 500 the first time (retried by botocore), GET returns GET_BODY_SIZE bytes.
+    """
+
+    protocol_version = 'HTTP/1.1'  # Expect: 100-continue of PutObject
+    GET_BODY_SIZE = 2048
+    puts = 0
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        FailFirstHandler.puts += 1
+        if FailFirstHandler.puts == 1:
+            self._respond(500, b'<Error><Code>InternalError</Code><Message>fail first</Message></Error>')
+        else:
+            self._respond(200, b'', {'ETag': '"check"'})
+
+    def do_GET(self):
+        self._respond(200, b'x' * self.GET_BODY_SIZE, {'ETag': '"check"'})
+
+    def _respond(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check_emf():
+    """
+    :return: list of tuples (check, passed, detail)
+    """
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+    from botocore.stub import Stubber
+    import aws_metrics
+
+    checks = []
+
+    def check(name, passed, detail=''):
+        checks.append((name, bool(passed), detail))
+
+    # stubbed calls: calls, errors and bytes sent per operation, and their stages
+    session = build_session()
+    s3, dynamodb = session.client('s3'), session.client('dynamodb')
+    aws_metrics.reset_metrics()
+    with Stubber(s3) as stubber_s3, Stubber(dynamodb) as stubber_dynamodb:
+        stubber_dynamodb.add_response('get_item', {'Item': {'id': {'S': 'check'}}})
+        for _ in range(2):
+            stubber_s3.add_response('put_object', {'ETag': '"check"'})
+        stubber_s3.add_client_error('get_object', 'NoSuchKey', http_status_code=404)
+        aws_metrics.set_stage('validate')
+        dynamodb.get_item(TableName='PARAMS', Key={'id': {'S': 'check'}})
+        aws_metrics.set_stage('persist')
+        s3.put_object(Bucket='bucket', Key='key0', Body=b'x' * 100)
+        s3.put_object(Bucket='bucket', Key='key1', Body=io.BytesIO(b'x' * 200))
+        try:
+            s3.get_object(Bucket='bucket', Key='missing')
+        except ClientError:
+            pass
+    record = emit_record('check_stubbed')
+
+    emf = record.get('_aws', {}).get('CloudWatchMetrics', [{}])[0]
+    check("EMF _aws.CloudWatchMetrics", isinstance(record['_aws'].get('Timestamp'), int)
+          and emf.get('Namespace') == aws_metrics.METRICS_NAMESPACE and emf.get('Dimensions') == [['FunctionName']]
+          and record.get('FunctionName') == 'check_stubbed', json.dumps(record['_aws'])[:200])
+    metric_names_missing = [metric['Name'] for metric in emf.get('Metrics', []) if metric['Name'] not in record]
+    check("EMF every metric has a value", len(emf.get('Metrics', [])) > 0 and len(metric_names_missing) == 0,
+          f"missing: {metric_names_missing}")
+    calls = record.get('AwsCallsDetail', {})
+    expected = {'dynamodb.GetItem': {'calls': 1, 'errors': 0, 'retries': 0},
+                's3.PutObject': {'calls': 2, 'errors': 0, 'retries': 0, 'bytes_sent': 300},
+                's3.GetObject': {'calls': 1, 'errors': 1, 'retries': 0}}
+    for name, fields in expected.items():
+        actual = {field: calls.get(name, {}).get(field) for field in fields}
+        check(f"calls {name}", actual == fields, f"{actual} != {fields}")
+    check("bytes sent dynamodb.GetItem", calls.get('dynamodb.GetItem', {}).get('bytes_sent', 0) > 0, f"{calls}")
+    totals = [(record.get(total), sum(call[field] for call in calls.values()))
+              for total, field in [('AwsCalls', 'calls'), ('AwsErrors', 'errors'), ('AwsBytesSent', 'bytes_sent')]]
+    check("totals", totals[0][0] == 4 and all(value == value_sum for value, value_sum in totals), f"{totals}")
+    stages = {stage: stage_dict['aws_calls'] for stage, stage_dict in record.get('Stages', {}).items()}
+    check("stages", stages == {'handler': 0, 'validate': 1, 'persist': 3} and 'Stage.persist' in record,
+          f"{stages}")
+
+    # local endpoint: retries and bytes received
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FailFirstHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        s3 = build_session().client(
+            's3', endpoint_url=f"http://127.0.0.1:{server.server_address[1]}",
+            config=Config(retries={'mode': 'standard', 'max_attempts': 3}, s3={'addressing_style': 'path'}))
+        aws_metrics.reset_metrics()
+        aws_metrics.set_stage('persist')
+        s3.put_object(Bucket='bucket', Key='key', Body=b'x' * 100)
+        s3.get_object(Bucket='bucket', Key='key')['Body'].read()
+        record = emit_record('check_endpoint')
+    finally:
+        server.shutdown()
+        server.server_close()
+    calls = record.get('AwsCallsDetail', {})
+    actual = {field: calls.get('s3.PutObject', {}).get(field) for field in ['calls', 'retries', 'errors']}
+    check("retries s3.PutObject", actual == {'calls': 1, 'retries': 1, 'errors': 0}, f"{actual}")
+    check("bytes received s3.GetObject",
+          calls.get('s3.GetObject', {}).get('bytes_received') == FailFirstHandler.GET_BODY_SIZE, f"{calls}")
+
+    # metrics limit: the stages and operations beyond it are kept as properties only
+    aws_metrics.reset_metrics()
+    for i in range(EMF_METRICS_MAX + 20):
+        aws_metrics.set_stage(f"stage{i:03d}")
+        aws_metrics.record_call('check', f"Operation{i:03d}", 1.0)
+    record = emit_record('check_limit')
+    metrics = record['_aws']['CloudWatchMetrics'][0]['Metrics']
+    check("EMF metrics limit", len(metrics) == EMF_METRICS_MAX and 'check.Operation119.Calls' in record,
+          f"{len(metrics)} metrics")
+    return checks
+
+
+def invoke(function_name, scenario, latency_s):
+    """
+    :return: dict metrics record of an invocation of function_name (scenario of bench_cold_start)
+    """
+    lambda_function = local_aws.load_lambda(function_name)
+    aws = local_aws.LocalAWS(latency={'s3': latency_s, 'dynamodb': latency_s, 'rekognition': latency_s * 10,
+                                      'ses': latency_s, 'sns': latency_s})
+    aws.install((None, getattr(sys.modules.get('alert_cams_img_config'), 'AWS_SES_REGION', None)))
+    event = build_scenario(aws, function_name, scenario)
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        lambda_function.lambda_handler(event, local_aws.LocalContext(function_name=function_name))
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    # the metrics record is the last line written (after the logs)
+    return json.loads([line for line in output.splitlines() if line.startswith('{"_aws"')][-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=2000, help="stubbed AWS calls per measure")
+    parser.add_argument('--latency-ms', type=float, default=20, help="fake latency per call (rekognition x10)")
+    parser.add_argument('--check', action='store_true', help="only check the metrics record, exit with status 1 if"
+                                                             " any check fails")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(local_aws.LAYERS_DIR, 'common', 'python'))
+    if args.check:
+        checks = check_emf()
+        for name, passed, detail in checks:
+            print(f"{name:<32} {'OK' if passed else 'FAILED  ' + detail}")
+        sys.exit(0 if all(passed for _, passed, _ in checks) else 1)
+
+    print(f"{'put_object (stubbed)':<28} {'us/call':>9}  calls recorded")
+    results = {hooks: bench_hooks(args.calls, hooks) for hooks in [False, True]}
+    for hooks, (us, calls_recorded) in results.items():
+        print(f"{'with hooks' if hooks else 'without hooks':<28} {us:>9.1f}  {calls_recorded}")
+    print(f"{'overhead':<28} {results[True][0] - results[False][0]:>9.1f}")
+    sys.path.remove(os.path.join(local_aws.LAYERS_DIR, 'common', 'python'))
+
+    for function_name, scenario in SCENARIO_LIST:
+        record = invoke(function_name, scenario, args.latency_ms / 1000)
+        print(f"\n{function_name} ({scenario}): {record['Duration']:.1f} ms, {record['AwsCalls']} AWS calls"
+              f" ({record['AwsLatency']:.1f} ms), {record['AwsRetries']} retries, {record['AwsErrors']} errors,"
+              f" {len(record['_aws']['CloudWatchMetrics'][0]['Metrics'])} metrics")
+        print(f"  {'stage':<14} {'ms':>9} {'AWS calls':>10} {'AWS ms':>9}")
+        for stage, stage_dict in record['Stages'].items():
+            print(f"  {stage:<14} {stage_dict['ms']:>9.1f} {stage_dict['aws_calls']:>10} {stage_dict['aws_ms']:>9.1f}")
+        print(f"  {'AWS call':<28} {'calls':>6} {'ms':>9} {'max ms':>9}")
+        for name, call in record['AwsCallsDetail'].items():
+            print(f"  {name:<28} {call['calls']:>6} {call['latency_ms']:>9.1f} {call['latency_max_ms']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
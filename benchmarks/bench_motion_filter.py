@@ -0,0 +1,108 @@
+"""
+Motion pre-filter of class_cam_img (see motion_filter) on sample snapshots: latency per frame (decode and score)
+and share of the rekognition api calls avoided (frames without motion), per motion threshold (area_min).
+
+usage:
+    python benchmarks/bench_motion_filter.py [samples_dir] [--area-mins 0.005,0.01,0.02] [--mask x0,y0,x1,y1]
+
+samples_dir must contain the snapshots of a single camera (sorted by filename, i.e. by date). If it is not given,
+synthetic jpeg snapshots are generated (global lighting changes, noise and an intruder in some of them), and the
+intrusions missed are reported too. Pillow and NumPy are required.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'aws_lambda_functions', 'class_cam_img'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'aws_lambda_layers', 'common', 'python'))
+
+import motion_filter  # noqa: E402
+from motion_filter import MotionFilter  # noqa: E402
+
+
+def load_samples(samples_dir):
+    samples = []
+    for filename in sorted(os.listdir(samples_dir)):
+        path = os.path.join(samples_dir, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                samples.append((filename, f.read(), None))
+    return samples
+
+
+def build_samples(n=120, width=1280, height=720, intrusion_share=0.2):
+    """
+    :return: list of tuples (filename, jpeg bytes, intrusion), with lighting changes in every frame
+             and an intruder (a moving dark figure) in intrusion_share of them
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    background = rng.integers(40, 216, size=(height // 40, width // 40), dtype=np.uint8)
+    background = np.kron(background, np.ones((40, 40), dtype=np.uint8)).astype(np.int16)
+    samples = []
+    for i in range(n):
+        frame = background + int(rng.integers(-40, 41)) + rng.integers(-6, 7, size=background.shape)
+        intrusion = rng.random() < intrusion_share
+        if intrusion:
+            x, y = int(rng.integers(0, width - 160)), int(rng.integers(0, height - 360))
+            frame[y:y + 360, x:x + 160] = rng.integers(0, 30)
+        stream = io.BytesIO()
+        Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).convert('RGB').save(stream, format='JPEG', quality=85)
+        samples.append((f"2022-05-24-21-{i // 60:02d}-{i % 60:02d}-cam.jpg", stream.getvalue(), intrusion))
+    return samples
+
+
+def bench_area_min(samples, area_min, mask_regions):
+    motion_filter._references_local.clear()
+    mf = MotionFilter(table_name=None, area_min=area_min, mask_regions=mask_regions)
+    latencies = []
+    motions = []
+    for filename, data, _ in samples:
+        record = {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': f"cam/{filename}"}}}
+        t_start = time.perf_counter()
+        motions.extend(mf.filter([record], [data]))
+        latencies.append(time.perf_counter() - t_start)
+        mf.save()
+
+    skipped = [motion is not None and not motion['motion'] for motion in motions]
+    intrusions = [intrusion for _, _, intrusion in samples]
+    result = {
+        'area_min': area_min,
+        'latency_ms_median': statistics.median(latencies) * 1000,
+        'latency_ms_p95': sorted(latencies)[int(0.95 * (len(latencies) - 1))] * 1000,
+        'calls_avoided': sum(skipped) / len(samples),
+        'intrusions_missed': None,
+    }
+    if all(intrusion is not None for intrusion in intrusions):
+        result['intrusions_missed'] = sum(1 for skip, intrusion in zip(skipped, intrusions) if skip and intrusion)
+        result['intrusions'] = sum(intrusions)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('samples_dir', nargs='?')
+    parser.add_argument('--area-mins', default='0.005,0.01,0.02,0.05')
+    parser.add_argument('--mask', action='append', help="region x0,y0,x1,y1 (relative, 0-1), may be repeated")
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples_dir) if args.samples_dir else build_samples()
+    mask_regions = [[float(x) for x in mask.split(',')] for mask in args.mask] if args.mask else None
+    print(f"{len(samples)} samples, {sum(len(data) for _, data, _ in samples)} bytes, mask {mask_regions}")
+    print(f"{'area_min':>9} {'ms/frame median':>16} {'ms/frame p95':>13} {'calls avoided':>14} {'intrusions missed':>18}")
+    for area_min in [float(area_min) for area_min in args.area_mins.split(',')]:
+        result = bench_area_min(samples, area_min, mask_regions)
+        missed = f"{result['intrusions_missed']} of {result['intrusions']}" if result['intrusions_missed'] is not None \
+            else '-'
+        print(f"{result['area_min']:>9} {result['latency_ms_median']:>16.2f} {result['latency_ms_p95']:>13.2f}"
+              f" {result['calls_avoided']:>13.1%} {missed:>18}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""
+End-to-end pipeline of the lambda functions (class_cam_img, alert_cams_img, zipper_multiple) on a synthetic burst of
+snapshots, with the AWS services replaced by the local stand-ins of local_aws with fake latencies: throughput,
+p50 / p99 latency per invocation, peak memory (max RSS) and AWS calls per scenario, compared against a stored
+baseline (benchmarks/baseline_pipeline.json).
+
+Every scenario runs in a fresh python process (a single container, invoked sequentially), REPEAT times; the invocations
+its input depends on (e.g. the snapshots classified before alerting) run before it and are not measured:
+    - classify_s3: class_cam_img, an s3 event per snapshot
+    - classify_sqs: class_cam_img, sqs events of SQS_BATCH_SIZE snapshots (classified concurrently)
+    - alert: alert_cams_img, an s3 event per processed record (one alert per camera and alert period)
+    - zip: zipper_multiple, the snapshots of the previous month zipped (ZIP_FILES snapshots)
+    - compact: zipper_multiple, the processed records of a day compacted and the detection index updated
+
+The first invocation of a scenario is the cold one (imports, clients): its latency is reported (cold ms) but not in
+the throughput and p50 / p99 of the warm invocations. Every measure is the median of the repeated processes, and the
+results are only compared with a baseline of the same parameters (latencies, runs, repeat, burst).
+
+The burst is CAMERAS cameras taking SNAPSHOTS_PER_CAMERA snapshots every SNAPSHOT_INTERVAL_SECONDS: mostly the same
+static scene (near-identical frames, see snapshot_dedup, enabled for the benchmark) with an intruder in INTRUSION_SHARE
+of them (a Person for the local rekognition). Pillow and NumPy generate the snapshots (random bytes without them,
+no dedup).
+
+usage:
+    python benchmarks/bench_pipeline.py [--scenarios classify_s3,alert] [--latency s3=10,rekognition=100]
+                                        [--runs 3] [--repeat 3] [--save-baseline] [--check] [--tolerance 0.2]
+"""
+import argparse
+from datetime import datetime as dt, timedelta as td
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, 'baseline_pipeline.json')
+
+SCENARIO_LIST = ['classify_s3', 'classify_sqs', 'alert', 'zip', 'compact']
+
+# burst
+CAMERAS = 3
+SNAPSHOTS_PER_CAMERA = 20
+SNAPSHOT_INTERVAL_SECONDS = 10
+INTRUSION_SHARE = 0.3
+SNAPSHOT_WIDTH, SNAPSHOT_HEIGHT = 640, 360
+SQS_BATCH_SIZE = 10
+ZIP_FILES = 100
+ZIP_FILE_SIZE = 200 * 1024
+
+# fake latencies (ms per call)
+LATENCY_MS_DEFAULT = {'s3': 10, 'dynamodb': 5, 'rekognition': 100, 'ses': 30, 'sns': 20}
+
+BUCKET_INPUT = 'bucket-input'
+LABELS_INTRUSION = [{'Name': 'Person', 'Confidence': 98.5, 'Parents': [],
+                     'Instances': [{'BoundingBox': {'Width': 0.12, 'Height': 0.4, 'Left': 0.44, 'Top': 0.3},
+                                    'Confidence': 98.5}]}]
+LABELS_STATIC = [{'Name': 'Tree', 'Confidence': 91.2, 'Instances': [], 'Parents': [{'Name': 'Plant'}]},
+                 {'Name': 'Plant', 'Confidence': 91.2, 'Instances': [], 'Parents': []}]
+
+# a relative change of a measure worse than tolerance (higher, throughput lower) is a regression, the AWS calls are
+# deterministic (no tolerance), the cold invocation (cold_ms) is reported only
+MEASURES = [('throughput', 'higher'), ('p50_ms', 'lower'), ('p99_ms', 'lower'), ('peak_rss_mb', 'lower'),
+            ('aws_calls', 'lower')]
+MEASURES_EXACT = ['aws_calls']
+
+
+# ------------------------------------------------------------------------------
+# child process: a single scenario
+# ------------------------------------------------------------------------------
+
+def build_snapshots(dt_start, seed=0):
+    """
+    :return: list of tuples (key, event time, jpeg bytes, intrusion) of the burst, sorted by time
+    """
+    rng = random.Random(seed)
+    try:
+        import numpy as np
+        from PIL import Image
+    except ImportError:
+        np = None
+
+    snapshots = []
+    for c in range(CAMERAS):
+        camera = f"cam{c}"
+        if np is not None:
+            rng_np = np.random.default_rng(seed + c)
+            background = rng_np.integers(40, 216, size=(SNAPSHOT_HEIGHT // 40, SNAPSHOT_WIDTH // 40), dtype=np.uint8)
+            background = np.kron(background, np.ones((40, 40), dtype=np.uint8)).astype(np.int16)
+        for i in range(SNAPSHOTS_PER_CAMERA):
+            dt_snapshot = dt_start + td(seconds=i * SNAPSHOT_INTERVAL_SECONDS + c)
+            intrusion = rng.random() < INTRUSION_SHARE
+            if np is not None:
+                frame = background + rng_np.integers(-3, 4, size=background.shape)
+                if intrusion:
+                    x = rng.randrange(0, SNAPSHOT_WIDTH - 80)
+                    frame[SNAPSHOT_HEIGHT // 4:SNAPSHOT_HEIGHT // 4 + 180, x:x + 80] = rng.randrange(0, 30)
+                stream = io.BytesIO()
+                Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).convert('RGB').save(stream, format='JPEG',
+                                                                                             quality=85)
+                data = stream.getvalue()
+            else:
+                data = os.urandom(100 * 1024)
+            key = f"{camera}/{dt_snapshot.strftime('%Y-%m-%d-%H-%M-%S')}-{camera}.jpg"
+            snapshots.append((key, f"{dt_snapshot.isoformat()}Z", data, intrusion))
+    return sorted(snapshots, key=lambda snapshot: snapshot[1])
+
+
+def seed_params(aws):
+    date_suffix = dt.now().strftime(sys.modules['rekognition_api_calls_config'].DATE_SUFFIX_FORMAT)
+    aws.dynamodb.put_params('PARAMS', {
+        'alert_cams_img_period': {'N': '3600'},
+        'alert_cams_img_last': {'S': (dt.now() - td(days=1)).strftime('%Y-%m-%d %H:%M:%S')},
+        'class_cam_img_disable_until_alert_period': {'BOOL': False},
+        'rekognition_api_calls_month_max_50': {'N': '50000'},
+        'rekognition_api_calls_month_max_100': {'N': '100000'},
+        f"rekognition_api_calls{date_suffix}": {'N': '10'},
+    })
+
+
+def build_s3_event(bucket, key, event_time=None, size=0):
+    from bench_processed_records import build_s3_record
+    return {'Records': [build_s3_record(bucket, key, event_time or f"{dt.utcnow().isoformat()}Z", size)]}
+
+
+def build_sqs_event(s3_events):
+    return {'Records': [{'eventSource': 'aws:sqs', 'messageId': f"message-{i}", 'body': json.dumps(s3_event)}
+                        for i, s3_event in enumerate(s3_events)]}
+
+
+def invoke(lambda_function, event):
+    """
+    :return: tuple (seconds, response), the logs and metrics record of the function written to os.devnull
+    """
+    import local_aws
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            t_start = time.perf_counter()
+            response = lambda_function.lambda_handler(event, local_aws.LocalContext())
+            return time.perf_counter() - t_start, response
+        finally:
+            sys.stdout = stdout
+
+
+def load(aws, function_name):
+    import local_aws
+    lambda_function = local_aws.load_lambda(function_name)
+    aws.install((None, getattr(sys.modules.get('alert_cams_img_config'), 'AWS_SES_REGION', None)))
+    return lambda_function
+
+
+def classify(aws, snapshots, batch_size=None):
+    """
+    Uploads and classifies the snapshots (class_cam_img), an s3 event per snapshot or sqs events of batch_size.
+    :return: list of tuples (seconds, response) per invocation
+    """
+    lambda_function = load(aws, 'class_cam_img')
+    lambda_function.DEDUP_ENABLED = True  # disabled by default (config), the burst is mostly near-identical frames
+    seed_params(aws)
+    events = []
+    for key, event_time, data, intrusion in snapshots:
+        aws.s3.put_bytes(BUCKET_INPUT, key, data)
+        aws.rekognition.labels_by_key[key] = LABELS_INTRUSION if intrusion else LABELS_STATIC
+        events.append(build_s3_event(BUCKET_INPUT, key, event_time, len(data)))
+    if batch_size is not None:
+        events = [build_sqs_event(events[i:i + batch_size]) for i in range(0, len(events), batch_size)]
+    return [invoke(lambda_function, event) for event in events]
+
+
+def run_child(scenario, runs):
+    import local_aws
+
+    latency_ms = json.loads(os.environ['BENCH_PIPELINE_LATENCY_MS'])
+    aws = local_aws.LocalAWS(latency={service: ms / 1000 for service, ms in latency_ms.items()})
+    dt_day = (dt.utcnow() - td(days=1)).replace(hour=12, minute=0, second=0, microsecond=0)
+    snapshots = build_snapshots(dt_day)
+
+    results, units = [], 0
+    if scenario in ('classify_s3', 'classify_sqs'):
+        batch_size = SQS_BATCH_SIZE if scenario == 'classify_sqs' else None
+        results = classify(aws, snapshots, batch_size)
+        units = len(snapshots)
+
+    elif scenario == 'alert':
+        classify(aws, snapshots)
+        config = sys.modules['config']
+        keys = sorted(key for bucket, key in aws.s3.objects if bucket == config.BUCKET_OUTPUT and key.endswith('.json'))
+        lambda_function = load(aws, 'alert_cams_img')
+        lambda_function.ALERT_PER_CAMERA = True  # global by default (alert_cams_img_config), an alert per camera
+        aws.reset_calls()
+        results = [invoke(lambda_function, build_s3_event(config.BUCKET_OUTPUT, key)) for key in keys]
+        units = len(keys)
+
+    elif scenario == 'zip':
+        lambda_function = load(aws, 'zipper_multiple')
+        custom_event = sys.modules['config'].VALID_CUSTOM_EVENT_LIST[0]
+        dt_month_previous = dt.now().replace(day=1) - td(days=1)
+        aws.reset_calls()
+        for _ in range(runs + 1):
+            for i in range(ZIP_FILES):
+                filename = f"{dt_month_previous.strftime('%Y-%m')}-01-00-{i // 60:02d}-{i % 60:02d}-cam.jpg"
+                aws.s3.put_bytes(custom_event['bucket_name'], f"{custom_event['main_dir']}/{filename}",
+                                 os.urandom(ZIP_FILE_SIZE))
+            results.append(invoke(lambda_function, {'custom_event': custom_event}))
+        units = ZIP_FILES * (runs + 1)
+
+    elif scenario == 'compact':
+        classify(aws, snapshots)
+        lambda_function = load(aws, 'zipper_multiple')
+        compact_event = {**sys.modules['config'].VALID_COMPACT_EVENT_LIST[0], 'day_ago': 1}
+        bucket, main_dir = compact_event['bucket_name'], compact_event['main_dir']
+        records = {key: data for (bucket_key, key), data in aws.s3.objects.items()
+                   if bucket_key == bucket and key.startswith(f"{main_dir}/") and key.endswith('.json')}
+        aws.reset_calls()
+        for _ in range(runs + 1):
+            for key, data in records.items():
+                aws.s3.put_bytes(bucket, key, data)
+            results.append(invoke(lambda_function, {'compact_event': compact_event}))
+        units = len(records) * (runs + 1)
+
+    else:
+        raise ValueError(f"scenario '{scenario}' NOT valid, one of {SCENARIO_LIST}")
+
+    import resource
+    # the first invocation is the cold one, the units are evenly split among the invocations
+    latencies_ms = sorted(seconds * 1000 for seconds, _ in results[1:])
+    calls = aws.get_calls()
+    return {
+        'invocations': len(results),
+        'units': units,
+        'throughput': units * (len(results) - 1) / len(results) / sum(seconds for seconds, _ in results[1:]),
+        'cold_ms': results[0][0] * 1000,
+        'p50_ms': statistics.median(latencies_ms),
+        'p99_ms': latencies_ms[min(int(round(0.99 * (len(latencies_ms) - 1))), len(latencies_ms) - 1)],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'aws_calls': sum(calls.values()),
+        'aws_calls_detail': calls,
+        'status_codes': {str(code): sum(1 for _, response in results if response['statusCode'] == code)
+                         for code in sorted({response['statusCode'] for _, response in results})},
+    }
+
+
+# ------------------------------------------------------------------------------
+# parent process
+# ------------------------------------------------------------------------------
+
+def run_scenario(scenario, runs, latency_ms, repeat=1):
+    """
+    Runs scenario in repeat fresh python processes.
+    :return: dict result of the first process, with the median of the processes for every measure (and cold_ms)
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', scenario, '--runs', str(runs)]
+    env = {**os.environ, 'BENCH_PIPELINE_LATENCY_MS': json.dumps(latency_ms)}
+    results = []
+    for _ in range(repeat):
+        process = subprocess.run(cmd, cwd=BENCHMARKS_DIR, capture_output=True, text=True, env=env)
+        if process.returncode != 0:
+            raise RuntimeError(f"scenario '{scenario}' failed:\n{process.stderr}")
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    result = dict(results[0])
+    for measure in [measure for measure, _ in MEASURES] + ['cold_ms']:
+        result[measure] = statistics.median(result_process[measure] for result_process in results)
+    return result
+
+
+def parse_latency(latency):
+    """
+    :param latency: str 'service=ms,...' (the services not given keep their default latency)
+    :return: dict {service: ms}
+    """
+    latency_ms = dict(LATENCY_MS_DEFAULT)
+    for item in filter(None, latency.split(',')):
+        service, ms = item.split('=')
+        if service not in latency_ms:
+            raise ValueError(f"service '{service}' NOT valid, one of {list(latency_ms)}")
+        latency_ms[service] = float(ms)
+    return latency_ms
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of tuples (scenario, measure, value, value baseline, relative change, regression)
+    """
+    comparison = []
+    for scenario, result in results.items():
+        result_baseline = baseline['results'].get(scenario)
+        if result_baseline is None:
+            continue
+        for measure, better in MEASURES:
+            value, value_baseline = result[measure], result_baseline[measure]
+            change = (value - value_baseline) / value_baseline if value_baseline else 0.0
+            tolerance_measure = 0.0 if measure in MEASURES_EXACT else tolerance
+            regression = change < -tolerance_measure if better == 'higher' else change > tolerance_measure
+            comparison.append((scenario, measure, value, value_baseline, change, regression))
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=','.join(SCENARIO_LIST))
+    parser.add_argument('--latency', default='', help="fake latencies, 'service=ms,...' (default: "
+                        + ','.join(f"{service}={ms}" for service, ms in LATENCY_MS_DEFAULT.items()) + ")")
+    parser.add_argument('--runs', type=int, default=3,
+                        help="warm invocations of the zip and compact scenarios (after the cold one)")
+    parser.add_argument('--repeat', type=int, default=3, help="processes per scenario, the median is reported")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="save the results as the baseline")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 if there are regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative change allowed vs the baseline")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        sys.path.insert(0, BENCHMARKS_DIR)
+        print(json.dumps(run_child(args.child, args.runs)))
+        return
+
+    latency_ms = parse_latency(args.latency)
+    params = {'latency_ms': latency_ms, 'runs': args.runs, 'repeat': args.repeat, 'cameras': CAMERAS,
+              'snapshots_per_camera': SNAPSHOTS_PER_CAMERA, 'zip_files': ZIP_FILES}
+    results = {}
+    print(f"{'scenario':<14} {'invocations':>11} {'cold ms':>9} {'units/s':>9} {'p50 ms':>9} {'p99 ms':>9}"
+          f" {'peak MB':>8} {'AWS calls':>10}  status codes")
+    for scenario in args.scenarios.split(','):
+        result = results[scenario] = run_scenario(scenario, args.runs, latency_ms, args.repeat)
+        print(f"{scenario:<14} {result['invocations']:>11} {result['cold_ms']:>9.1f} {result['throughput']:>9.1f}"
+              f" {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['peak_rss_mb']:>8.1f}"
+              f" {result['aws_calls']:>10}  {result['status_codes']}")
+    print("\nAWS calls per scenario")
+    for scenario, result in results.items():
+        print(f"{scenario:<14} " + ', '.join(f"{name} {calls}" for name, calls in result['aws_calls_detail'].items()))
+
+    regressions = []
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nvs baseline ({baseline['date']}, {baseline['python']})")
+        if baseline['params'] != params:
+            # different latencies, runs or burst: the measures are not comparable, neither are the regressions
+            print(f"ERROR: NOT compared, the baseline parameters differ: {baseline['params']}"
+                  f"\n(save a baseline of these parameters with --save-baseline --baseline <path>)")
+            if args.check:
+                sys.exit(1)
+        else:
+            print(f"{'scenario':<14} {'measure':<12} {'value':>10} {'baseline':>10} {'change':>8}")
+            for scenario, measure, value, value_baseline, change, regression in compare(results, baseline,
+                                                                                         args.tolerance):
+                print(f"{scenario:<14} {measure:<12} {value:>10.1f} {value_baseline:>10.1f} {change:>+8.1%}"
+                      + ("  REGRESSION" if regression else ""))
+                if regression:
+                    regressions.append((scenario, measure))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'date': dt.now().strftime('%Y-%m-%d'), 'python': platform.python_version(), 'params': params,
+                       'results': results}, f, indent=2)
+            f.write('\n')
+        print(f"\nbaseline saved to '{args.baseline}'")
+
+    if args.check and len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
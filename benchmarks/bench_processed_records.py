@@ -0,0 +1,129 @@
+"""
+Processed records of class_cam_img in processed_bucket (a day of snapshots): objects, bytes and listing time of the full
+records (RECORD_COMPACT False), of the compact ones (see processed_record) and of the day compacted into a single
+json lines file by zipper_multiple (compact event, see jsonl_compactor).
+
+The records are built and saved by class_cam_img (get_json_data, save_json_dict) and compacted by zipper_multiple,
+with the AWS services replaced by the local stand-ins of local_aws. The listing time is modelled with a fake latency
+per ListObjectsV2 request (1000 keys per page).
+
+usage:
+    python benchmarks/bench_processed_records.py [--snapshots 2880] [--labels 8] [--list-latency-ms 30]
+"""
+import argparse
+import contextlib
+from datetime import datetime as dt, timedelta as td
+import os
+import random
+import sys
+import time
+
+import local_aws
+
+
+def build_s3_record(bucket, key, event_time, size):
+    # s3 event record as sent by s3 (all the fields of the full records)
+    return {
+        'eventVersion': '2.1', 'eventSource': 'aws:s3', 'awsRegion': 'eu-west-1', 'eventTime': event_time,
+        'eventName': 'ObjectCreated:Put', 'userIdentity': {'principalId': 'AWS:AIDAEXAMPLEPRINCIPALID'},
+        'requestParameters': {'sourceIPAddress': '203.0.113.10'},
+        'responseElements': {'x-amz-request-id': 'C3D13FE58DE4C810',
+                             'x-amz-id-2': 'FMyUVURIY8/IgAtTv8xRjskZQpcIZ9KG4V5Wp6S7S/JRWeUWerMUE5JgHvANOjpD'},
+        's3': {'s3SchemaVersion': '1.0', 'configurationId': 'class_cam_img_trigger',
+               'bucket': {'name': bucket, 'ownerIdentity': {'principalId': 'A3NL1KOZZKExample'},
+                          'arn': f"arn:aws:s3:::{bucket}"},
+               'object': {'key': key, 'size': size, 'eTag': f"{random.getrandbits(128):032x}",
+                          'sequencer': '0055AED6DCD90281E5'}},
+    }
+
+
+def build_response_labels(labels):
+    # detect_labels response as returned by boto3 (all the fields of the full records)
+    names = ['Person', 'Human', 'Car', 'Vehicle', 'Transportation', 'Automobile', 'Tree', 'Plant', 'Yard', 'Nature',
+             'Outdoors', 'Building', 'Housing', 'Grass', 'Path', 'Walkway']
+    response_labels = {'Labels': [], 'LabelModelVersion': '3.0', 'ResponseMetadata': {
+        'RequestId': 'f1c4c0f0-6b7a-4bb6-9d4c-0e6e6c2b6d8e', 'HTTPStatusCode': 200, 'RetryAttempts': 0,
+        'HTTPHeaders': {'x-amzn-requestid': 'f1c4c0f0-6b7a-4bb6-9d4c-0e6e6c2b6d8e',
+                        'content-type': 'application/x-amz-json-1.1', 'content-length': '2231',
+                        'date': 'Mon, 24 May 2022 21:03:05 GMT'}}}
+    for name in random.sample(names, labels):
+        instances = [{'BoundingBox': {'Width': random.random() / 4, 'Height': random.random() / 2,
+                                      'Left': random.random() / 2, 'Top': random.random() / 2},
+                      'Confidence': random.uniform(75, 100)}
+                     for _ in range(random.choice([0, 0, 1, 2]))]
+        response_labels['Labels'].append({
+            'Name': name, 'Confidence': random.uniform(75, 100), 'Instances': instances,
+            'Parents': [{'Name': parent} for parent in random.sample(names, random.choice([0, 1, 2]))],
+            'Aliases': [], 'Categories': [{'Name': 'Person Description'}]})
+    return response_labels
+
+
+def measure(aws, bucket, prefix):
+    """
+    :return: tuple (objects, bytes, ListObjectsV2 requests, listing ms)
+    """
+    aws.reset_calls()
+    t_start = time.perf_counter()
+    objects, size, token = 0, 0, None
+    while True:
+        kwargs = {'ContinuationToken': token} if token is not None else {}
+        response = aws.s3.list_objects_v2(Bucket=bucket, Prefix=prefix, **kwargs)
+        objects += response['KeyCount']
+        size += sum(content['Size'] for content in response['Contents'])
+        if not response['IsTruncated']:
+            break
+        token = response['NextContinuationToken']
+    t_list = time.perf_counter() - t_start
+    return objects, size, aws.get_calls()['s3.ListObjectsV2'], t_list * 1000
+
+
+def save_records(aws, snapshots, labels, record_compact, dt_day):
+    class_cam_img = local_aws.load_lambda('class_cam_img')
+    aws.install()
+    class_cam_img.RECORD_COMPACT = record_compact
+    random.seed(0)
+    for i in range(snapshots):
+        dt_snapshot = dt_day + td(seconds=i * 86400 // snapshots)
+        key = f"main_dir_example_00/{dt_snapshot.strftime('%Y-%m-%d-%H-%M-%S')}-cam.jpg"
+        event_time = f"{dt_snapshot.isoformat()}Z"
+        event = {'Records': [build_s3_record('bucket-input', key, event_time, 200 * 1024)]}
+        json_dict = class_cam_img.get_json_data(event, build_response_labels(labels), 'bucket-input', key, event_time)
+        class_cam_img.save_json_dict(json_dict)
+    config = sys.modules['config']
+    return config.BUCKET_OUTPUT, config.FOLDER_OUTPUT
+
+
+def compact_records(aws):
+    zipper_multiple = local_aws.load_lambda('zipper_multiple')
+    aws.install()
+    compact_event = sys.modules['config'].VALID_COMPACT_EVENT_LIST[0]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        t_start = time.perf_counter()
+        response = zipper_multiple.lambda_handler({'compact_event': {**compact_event, 'day_ago': 1}},
+                                                  local_aws.LocalContext())
+        return response, (time.perf_counter() - t_start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshots', type=int, default=2880, help="snapshots of the day (every 30 s by default)")
+    parser.add_argument('--labels', type=int, default=8, help="labels per snapshot")
+    parser.add_argument('--list-latency-ms', type=float, default=30.0, help="fake latency per ListObjectsV2")
+    args = parser.parse_args()
+
+    dt_day = (dt.now() - td(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    print(f"{'processed records':<28} {'objects':>8} {'bytes':>12} {'list requests':>14} {'list ms':>9}")
+    for name, record_compact in [('full (per snapshot)', False), ('compact (per snapshot)', True)]:
+        aws = local_aws.LocalAWS(latency={'s3': {'ListObjectsV2': args.list_latency_ms / 1000}})
+        bucket, folder = save_records(aws, args.snapshots, args.labels, record_compact, dt_day)
+        objects, size, requests, t_list = measure(aws, bucket, folder)
+        print(f"{name:<28} {objects:>8} {size:>12} {requests:>14} {t_list:>9.1f}")
+
+        response, t_compact = compact_records(aws)
+        objects, size, requests, t_list = measure(aws, bucket, folder)
+        print(f"{'  compacted (jsonl.gz)':<28} {objects:>8} {size:>12} {requests:>14} {t_list:>9.1f}"
+              f"  (compact event {response['statusCode']}, {t_compact:.0f} ms)")
+
+
+if __name__ == '__main__':
+    main()
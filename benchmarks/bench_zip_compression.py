@@ -0,0 +1,79 @@
+"""
+Compares the ZipperMultiple compression policies (see zip_compression_policy) on sample snapshots:
+bytes saved and cpu time per policy and compress level.
+
+usage:
+    python benchmarks/bench_zip_compression.py [samples_dir] [--levels 1,6,9]
+
+if samples_dir is not given, synthetic jpeg snapshots are generated (Pillow and NumPy required).
+"""
+import argparse
+import io
+import os
+import sys
+import zipfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'aws_lambda_layers', 'zipper_multiple', 'python'))
+
+from zip_compression_policy import ZipCompressionPolicy, COMPRESSION_POLICY_LIST  # noqa: E402
+
+
+def load_samples(samples_dir):
+    samples = []
+    for filename in sorted(os.listdir(samples_dir)):
+        path = os.path.join(samples_dir, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                samples.append((filename, f.read()))
+    return samples
+
+
+def build_samples(n=50, width=1280, height=720):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8)
+    background = np.kron(background, np.ones((16, 16, 1), dtype=np.uint8))
+    samples = []
+    for i in range(n):
+        noise = rng.integers(-8, 9, size=background.shape)
+        frame = np.clip(background.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        stream = io.BytesIO()
+        Image.fromarray(frame).save(stream, format='JPEG', quality=85)
+        samples.append((f"2022-05-24-21-03-{i:02d}-cam.jpg", stream.getvalue()))
+    return samples
+
+
+def bench_policy(samples, policy, compress_level):
+    compression = ZipCompressionPolicy(policy, compress_level)
+    with zipfile.ZipFile(io.BytesIO(), 'w') as zip_archive:
+        for filename, data in samples:
+            compression.writestr(zip_archive, filename, data)
+    return compression.get_stats_summary()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('samples_dir', nargs='?')
+    parser.add_argument('--levels', default='1,6,9')
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples_dir) if args.samples_dir else build_samples()
+    compress_level_list = [int(level) for level in args.levels.split(',')]
+    print(f"samples: {len(samples)} files, {sum(len(data) for _, data in samples)} bytes")
+    print(f"{'policy':<10} {'level':>5} {'stored':>7} {'deflated':>8} {'bytes_out':>12} {'saved':>10}"
+          f" {'saved_%':>7} {'cpu_s':>8}")
+    for policy in COMPRESSION_POLICY_LIST:
+        for compress_level in compress_level_list:
+            summary = bench_policy(samples, policy, compress_level)
+            by_type = summary['by_compress_type']
+            saved_pct = 100 * summary['bytes_saved'] / max(summary['bytes_in'], 1)
+            print(f"{policy:<10} {compress_level:>5} {by_type['stored']['entries']:>7}"
+                  f" {by_type['deflated']['entries']:>8} {summary['bytes_out']:>12} {summary['bytes_saved']:>10}"
+                  f" {saved_pct:>7.2f} {summary['cpu_seconds']:>8.4f}")
+
+
+if __name__ == '__main__':
+    main()
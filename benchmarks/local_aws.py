@@ -0,0 +1,578 @@
+"""
+Local, in-process stand-ins of the AWS services used by the lambda functions (S3, DynamoDB, Rekognition, SES, SNS),
+with per-operation call counts and configurable fake latencies, and helpers to load a lambda function with its layers.
+
+They implement only the subset of every API used by this repo, and are installed through aws_clients.set_client,
+so the lambda functions and layers run unchanged:
+
+    import local_aws
+    lambda_function = local_aws.load_lambda('class_cam_img')
+    aws = local_aws.LocalAWS()
+    aws.install()
+    lambda_function.lambda_handler(event, local_aws.LocalContext())
+"""
+from decimal import Decimal
+import hashlib
+import importlib
+import io
+import os
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(ROOT_DIR, 'aws_lambda_functions')
+LAYERS_DIR = os.path.join(ROOT_DIR, 'aws_lambda_layers')
+
+# lambda layers of every lambda function (in sys.path order, after the function directory), at most 5 per function
+# on AWS, numpy and Pillow layer included (class_cam_img)
+LAMBDA_LAYERS = {
+    'class_cam_img': ['logger_builder', 'common', 'rekognition_api_calls_service', 'alert_cams_img_service'],
+    'alert_cams_img': ['logger_builder', 'common', 'alert_cams_img_service'],
+    'zipper_multiple': ['logger_builder', 'common', 'zipper_multiple'],
+}
+
+_sys_path_loaded = []
+
+
+# ------------------------------------------------------------------------------
+# lambda loading
+# ------------------------------------------------------------------------------
+
+def load_lambda(function_name):
+    """
+    Imports (again) the module lambda_function of function_name, with its layers in sys.path (function first, as in
+    /var/task, so its module config is the function one; the layer configs have their own module names).
+    :return: lambda_function module
+    """
+    # unload the modules of the repo previously loaded (another function may have been loaded)
+    for module_name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None) or ''
+        if module_name == 'config' or module_file.startswith(FUNCTIONS_DIR) or module_file.startswith(LAYERS_DIR):
+            del sys.modules[module_name]
+    for path in _sys_path_loaded:
+        sys.path.remove(path)
+    _sys_path_loaded.clear()
+
+    function_dir = os.path.join(FUNCTIONS_DIR, function_name)
+    layer_dirs = [os.path.join(LAYERS_DIR, layer, 'python') for layer in LAMBDA_LAYERS[function_name]]
+    _sys_path_loaded.extend([function_dir] + layer_dirs)
+    sys.path[:0] = _sys_path_loaded
+
+    return importlib.import_module('lambda_function')
+
+
+class LocalContext:
+
+    def __init__(self, timeout_ms=900000, function_name=None):
+        self.aws_request_id = uuid.uuid4().hex
+        self.function_name = function_name
+        self.t_deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.t_deadline - time.monotonic()) * 1000)
+
+
+# ------------------------------------------------------------------------------
+# services
+# ------------------------------------------------------------------------------
+
+class LocalService:
+    """
+    Base of the local services: counts the calls per operation and sleeps latency seconds per call
+    (latency may be a number or a dict {operation: seconds}). The calls are recorded in the metrics of the current
+    invocation too (aws_metrics of the lambda function loaded), with their latency, as the botocore hooks would.
+    """
+
+    service_name = None
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.RLock()
+
+    def _call(self, operation):
+        t_start = time.perf_counter()
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        latency = self.latency.get(operation, 0.0) if isinstance(self.latency, dict) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+        aws_metrics = sys.modules.get('aws_metrics')
+        if aws_metrics is not None:
+            aws_metrics.record_call(self.service_name, operation, (time.perf_counter() - t_start) * 1000)
+
+    @staticmethod
+    def _client_error(code, operation, message='', **extra):
+        # lazy import, so loading this module does not load botocore (see bench_cold_start)
+        from botocore.exceptions import ClientError
+        return ClientError({'Error': {'Code': code, 'Message': message}, **extra}, operation)
+
+
+class LocalS3(LocalService):
+
+    service_name = 's3'
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.objects = {}
+        self.uploads = {}
+
+    def put_bytes(self, bucket, key, data):
+        self.objects[(bucket, key)] = bytes(data)
+
+    def get_bytes(self, bucket, key):
+        return self.objects[(bucket, key)]
+
+    def _get(self, bucket, key, operation):
+        if (bucket, key) not in self.objects:
+            raise self._client_error('NoSuchKey', operation, f"'{bucket}/{key}' not found")
+        return self.objects[(bucket, key)]
+
+    @staticmethod
+    def _etag(data):
+        return f"\"{hashlib.md5(data).hexdigest()}\""
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._call('GetObject')
+        data = self._get(Bucket, Key, 'GetObject')
+        if Range is not None:
+            range_start, range_end = Range[len('bytes='):].split('-')
+            data = data[int(range_start):int(range_end) + 1]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': self._etag(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('HeadObject')
+        data = self._get(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(data), 'ETag': self._etag(data)}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self._call('GetObject')
+        Fileobj.write(self._get(Bucket, Key, 'GetObject'))
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self._call('PutObject')
+        data = Body.encode('utf-8') if isinstance(Body, str) else Body.read() if hasattr(Body, 'read') else Body
+        self.objects[(Bucket, Key)] = bytes(data)
+        return {'ETag': self._etag(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('DeleteObject')
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call('DeleteObjects')
+        for obj in Delete['Objects']:
+            self.objects.pop((Bucket, obj['Key']), None)
+        return {'Errors': []}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        self._call('ListObjectsV2')
+        start_after = ContinuationToken if ContinuationToken is not None else StartAfter
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix)
+                      and key > start_after)
+        contents = [{'Key': key, 'Size': len(self.objects[(Bucket, key)]),
+                     'ETag': self._etag(self.objects[(Bucket, key)])} for key in keys[:MaxKeys]]
+        response = {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = keys[MaxKeys - 1]
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call('UploadPart')
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': self._etag(self.uploads[UploadId][PartNumber])}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._call('CompleteMultipartUpload')
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {'ETag': self._etag(self.objects[(Bucket, Key)])}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call('AbortMultipartUpload')
+        self.uploads.pop(UploadId, None)
+        return {}
+
+
+class LocalS3Resource:
+    """
+    s3 resource subset: Bucket(name).objects.filter(Prefix=...).all(), backed by a LocalS3.
+    """
+
+    def __init__(self, local_s3):
+        self.local_s3 = local_s3
+        self.meta = types.SimpleNamespace(client=local_s3)
+
+    def Bucket(self, name):
+        local_s3 = self.local_s3
+
+        class _Objects:
+            @staticmethod
+            def filter(Prefix=''):
+                return types.SimpleNamespace(all=lambda: _list(Prefix))
+
+        def _list(prefix):
+            local_s3._call('ListObjectsV2')
+            return [types.SimpleNamespace(key=key, size=len(local_s3.objects[(bucket, key)]))
+                    for bucket, key in sorted(local_s3.objects) if bucket == name and key.startswith(prefix)]
+
+        return types.SimpleNamespace(name=name, objects=_Objects)
+
+
+class LocalDynamoDB(LocalService):
+    """
+    Tables keyed by the string attribute 'id'. Supports get_item, batch_get_item, put_item, update_item and
+    delete_item, with the condition and update expressions subset used by this repo (see _Expression).
+    """
+
+    service_name = 'dynamodb'
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.tables = {}
+
+    def put_params(self, table_name, params):
+        """
+        :param params: dict {id: typed value}, e.g. {'alert_cams_img_period': {'N': '3600'}}
+        """
+        table = self.tables.setdefault(table_name, {})
+        for _id, value in params.items():
+            table[_id] = {'id': {'S': _id}, 'value': value}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call('GetItem')
+        item = self.tables.get(TableName, {}).get(Key['id']['S'])
+        return {'Item': item} if item is not None else {}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self._call('BatchGetItem')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.tables.get(table_name, {})
+            responses[table_name] = [table[key['id']['S']] for key in request['Keys'] if key['id']['S'] in table]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self._call('PutItem')
+        with self._lock:
+            table = self.tables.setdefault(TableName, {})
+            item_old = table.get(Item['id']['S'])
+            self._check_condition('PutItem', item_old, ConditionExpression, ExpressionAttributeNames,
+                                  ExpressionAttributeValues, kwargs.get('ReturnValuesOnConditionCheckFailure'))
+            table[Item['id']['S']] = Item
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self._call('UpdateItem')
+        with self._lock:
+            table = self.tables.setdefault(TableName, {})
+            item_old = table.get(Key['id']['S'])
+            self._check_condition('UpdateItem', item_old, ConditionExpression, ExpressionAttributeNames,
+                                  ExpressionAttributeValues, kwargs.get('ReturnValuesOnConditionCheckFailure'))
+            item_new = dict(item_old) if item_old is not None else dict(Key)
+            updated = _Expression(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues)\
+                .update(item_new)
+            table[Key['id']['S']] = item_new
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': item_new}
+        elif ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {name: item_new[name] for name in updated if name in item_new}}
+        elif ReturnValues == 'ALL_OLD':
+            return {'Attributes': item_old} if item_old is not None else {}
+        return {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        self._call('DeleteItem')
+        with self._lock:
+            table = self.tables.setdefault(TableName, {})
+            item_old = table.get(Key['id']['S'])
+            self._check_condition('DeleteItem', item_old, ConditionExpression, ExpressionAttributeNames,
+                                  ExpressionAttributeValues, kwargs.get('ReturnValuesOnConditionCheckFailure'))
+            table.pop(Key['id']['S'], None)
+        return {'Attributes': item_old} if ReturnValues == 'ALL_OLD' and item_old is not None else {}
+
+    def _check_condition(self, operation, item, condition_expression, names, values, return_values_on_failure):
+        if condition_expression is None:
+            return
+        if not _Expression(condition_expression, names, values).evaluate(item or {}):
+            extra = {'Item': item} if return_values_on_failure == 'ALL_OLD' and item is not None else {}
+            raise self._client_error('ConditionalCheckFailedException', operation,
+                                     'The conditional request failed', **extra)
+
+
+class LocalRekognition(LocalService):
+    """
+    detect_labels returns the labels of labels_by_key (by s3 object key), or default_labels,
+    filtered by MinConfidence and MaxLabels.
+    """
+
+    service_name = 'rekognition'
+
+    def __init__(self, latency=0.0, default_labels=None):
+        super().__init__(latency)
+        self.default_labels = default_labels if default_labels is not None else []
+        self.labels_by_key = {}
+
+    def detect_labels(self, Image, MaxLabels=1000, MinConfidence=55, **kwargs):
+        self._call('DetectLabels')
+        labels = self.labels_by_key.get(Image['S3Object']['Name'], self.default_labels)
+        labels = [label for label in labels if label['Confidence'] >= MinConfidence][:MaxLabels]
+        return {'Labels': labels, 'LabelModelVersion': '3.0'}
+
+
+class LocalSES(LocalService):
+
+    service_name = 'ses'
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.messages = []
+
+    def send_raw_email(self, Source, Destinations, RawMessage, **kwargs):
+        self._call('SendRawEmail')
+        self.messages.append({'Source': Source, 'Destinations': Destinations, 'Size': len(RawMessage['Data'])})
+        return {'MessageId': uuid.uuid4().hex}
+
+
+class LocalSNS(LocalService):
+
+    service_name = 'sns'
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.messages = []
+
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        self._call('Publish')
+        self.messages.append({'TopicArn': TopicArn, 'Subject': Subject, 'Message': Message})
+        return {'MessageId': uuid.uuid4().hex}
+
+
+class LocalAWS:
+    """
+    All the local services, installed as the aws_clients shared clients with install().
+    """
+
+    def __init__(self, latency=None):
+        latency = latency if latency is not None else {}
+        self.s3 = LocalS3(latency.get('s3', 0.0))
+        self.dynamodb = LocalDynamoDB(latency.get('dynamodb', 0.0))
+        self.rekognition = LocalRekognition(latency.get('rekognition', 0.0))
+        self.ses = LocalSES(latency.get('ses', 0.0))
+        self.sns = LocalSNS(latency.get('sns', 0.0))
+        self.services = {'s3': self.s3, 'dynamodb': self.dynamodb, 'rekognition': self.rekognition,
+                         'ses': self.ses, 'sns': self.sns}
+
+    def install(self, region_names=(None,)):
+        """
+        Installs the local services in aws_clients (the module of the lambda function currently loaded),
+        for every region in region_names (clients are cached per service and region).
+        """
+        aws_clients = importlib.import_module('aws_clients')
+        aws_clients.clear()
+        for region_name in region_names:
+            for service_name, service in self.services.items():
+                aws_clients.set_client(service_name, service, region_name=region_name)
+            aws_clients.set_resource('s3', LocalS3Resource(self.s3), region_name=region_name)
+
+    def get_calls(self):
+        """
+        :return: dict {'service.Operation': calls}
+        """
+        return {f"{service_name}.{operation}": calls for service_name, service in self.services.items()
+                for operation, calls in sorted(service.calls.items())}
+
+    def reset_calls(self):
+        for service in self.services.values():
+            service.calls = {}
+
+
+# ------------------------------------------------------------------------------
+# dynamodb expressions
+# ------------------------------------------------------------------------------
+
+class _Expression:
+    """
+    Minimal parser and evaluator of dynamodb expressions (top level attributes only):
+      - condition: OR, AND, NOT, parentheses, =, <>, <, <=, >, >=, attribute_exists, attribute_not_exists,
+        begins_with, size(path)
+      - update: SET path = operand [+|- operand] (operands: path, :value, if_not_exists(path, operand),
+        list_append(operand, operand)), ADD path :value, REMOVE path or path[index] (list)
+    """
+
+    TOKEN_PATTERN = re.compile(r"\s*(#\w+|:\w+|[A-Za-z_][\w.]*|\d+|<>|<=|>=|[=<>+\-,()\[\]])")
+
+    def __init__(self, expression, names=None, values=None):
+        self.tokens = self.TOKEN_PATTERN.findall(expression)
+        self.names = names or {}
+        self.values = values or {}
+        self.i = 0
+
+    # tokens
+
+    def _peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def _next(self, expected=None):
+        token = self._peek()
+        if expected is not None and (token is None or token.upper() != expected.upper()):
+            raise ValueError(f"expected '{expected}' but found '{token}' in {self.tokens}")
+        self.i += 1
+        return token
+
+    def _name(self, token):
+        return self.names[token] if token.startswith('#') else token
+
+    # condition
+
+    def evaluate(self, item):
+        self.i = 0
+        result = self._or(item)
+        if self._peek() is not None:
+            raise ValueError(f"unexpected '{self._peek()}' in {self.tokens}")
+        return result
+
+    def _or(self, item):
+        result = self._and(item)
+        while self._peek() is not None and self._peek().upper() == 'OR':
+            self._next()
+            result = self._and(item) or result
+        return result
+
+    def _and(self, item):
+        result = self._not(item)
+        while self._peek() is not None and self._peek().upper() == 'AND':
+            self._next()
+            result = self._not(item) and result
+        return result
+
+    def _not(self, item):
+        if self._peek() is not None and self._peek().upper() == 'NOT':
+            self._next()
+            return not self._not(item)
+        return self._primary(item)
+
+    def _primary(self, item):
+        token = self._peek()
+        if token == '(':
+            self._next()
+            result = self._or(item)
+            self._next(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists', 'begins_with'):
+            self._next()
+            self._next('(')
+            name = self._name(self._next())
+            if token == 'begins_with':
+                self._next(',')
+                prefix = self._operand(item)
+                self._next(')')
+                return name in item and _plain(item[name]).startswith(_plain(prefix))
+            self._next(')')
+            return (name in item) == (token == 'attribute_exists')
+        left = self._operand(item)
+        comparator = self._next()
+        right = self._operand(item)
+        if left is None or right is None:
+            return False
+        left, right = _plain(left), _plain(right)
+        return {'=': left == right, '<>': left != right, '<': left < right, '<=': left <= right,
+                '>': left > right, '>=': left >= right}[comparator]
+
+    def _operand(self, item):
+        token = self._next()
+        if token.startswith(':'):
+            return self.values[token]
+        if token == 'if_not_exists':
+            self._next('(')
+            name = self._name(self._next())
+            self._next(',')
+            default = self._value(item)
+            self._next(')')
+            return item.get(name, default)
+        if token == 'size':
+            self._next('(')
+            name = self._name(self._next())
+            self._next(')')
+            return {'N': str(len(next(iter(item[name].values()))))} if name in item else None
+        if token == 'list_append':
+            self._next('(')
+            first = self._value(item)
+            self._next(',')
+            second = self._value(item)
+            self._next(')')
+            return {'L': first['L'] + second['L']}
+        return item.get(self._name(token))
+
+    def _value(self, item):
+        value = self._operand(item)
+        while self._peek() in ('+', '-'):
+            sign = 1 if self._next() == '+' else -1
+            other = self._operand(item)
+            value = {'N': str(Decimal(value['N']) + sign * Decimal(other['N']))}
+        return value
+
+    # update
+
+    def update(self, item):
+        """
+        Applies the update expression to item (in place).
+        :return: list of the names of the attributes updated
+        """
+        self.i = 0
+        updated = []
+        item_old = dict(item)
+        indexes_removed = {}  # {name: indexes of the list elements removed}
+        action = None
+        while self._peek() is not None:
+            if self._peek().upper() in ('SET', 'ADD', 'REMOVE'):
+                action = self._next().upper()
+            name = self._name(self._next())
+            if action == 'SET':
+                self._next('=')
+                item[name] = self._value(item_old)
+            elif action == 'ADD':
+                value = self._operand(item_old)
+                if 'N' in value:
+                    item[name] = {'N': str(Decimal(item_old.get(name, {'N': '0'})['N']) + Decimal(value['N']))}
+                else:
+                    key_type = next(iter(value))
+                    item[name] = {key_type: sorted(set(item_old.get(name, {key_type: []})[key_type]) |
+                                                   set(value[key_type]))}
+            elif action == 'REMOVE' and self._peek() == '[':
+                # element of a list, the indexes are those of the list before the update
+                self._next('[')
+                index = int(self._next())
+                self._next(']')
+                indexes_removed.setdefault(name, set()).add(index)
+            elif action == 'REMOVE':
+                item.pop(name, None)
+            else:
+                raise ValueError(f"update action expected in {self.tokens}")
+            updated.append(name)
+            if self._peek() == ',':
+                self._next()
+        for name, indexes in indexes_removed.items():
+            if name in item:
+                item[name] = {'L': [value for i, value in enumerate(item[name]['L']) if i not in indexes]}
+        return updated
+
+
+def _plain(value):
+    if 'N' in value:
+        return Decimal(value['N'])
+    return next(iter(value.values()))